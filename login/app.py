@@ -1,26 +1,312 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, session, g, \
+    make_response, send_from_directory, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 from werkzeug.utils import secure_filename
-import uuid
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import safe_join
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
 from functools import wraps
+from collections import Counter
+import click
+import mimetypes
+from markupsafe import Markup, escape
 from sqlalchemy.sql import func
+from sqlalchemy import or_, and_, inspect, text, select, update, case, bindparam
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.exc import IntegrityError
+from timeline import SqlTimelineStore, MemoryTimelineStore
+from media import ImagePipeline, VARIANTS, variant_name, sniff_image_type, strip_metadata
+from storage import BlobStore, UploadSink
+from caching import MemoryCache, SqliteCache
+from database import PROFILES, AsyncReader, RoutingSession, add_math_functions, apply_pragmas, engine_options, \
+    is_replica, read_only, replica_binds, retry_on_busy
+from likequeue import LikeQueue
+from live import LiveHub, LiveServer, SqliteBroker, format_event, parse_post_ids, thread_stream
+from notifications import ActivityAggregator, collapse, describe, merged_count
+from ranking import TopK, group_logsumexp, trend_point
+from graph import FollowGraph
+from instrumentation import RequestMetrics, SamplingProfiler, TimedTemplate, timed
+from passwords import HasherBusy, PasswordHasher
+from ratelimit import MemoryBuckets, SqliteBuckets
+from search import HASHTAG, FtsSearchIndex, LikeSearchIndex, extract_hashtags, has_fts5, query_terms
+import migrations
+import base64
+import hmac
+import math
+import atexit
+import time
+
+# Stream file uploads straight into the blob store instead of Werkzeug's spooled buffers
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        sink = UploadSink(blob_store, inspect_upload)
+        self.__dict__.setdefault('upload_sinks', []).append(sink)
+        return sink
+    
+    def _load_form_data(self):
+        if self.mimetype == 'multipart/form-data':
+            # Reading the body is where uploads stream to disk
+            with timed('upload'):
+                return super()._load_form_data()
+        return super()._load_form_data()
+    
+    def close(self):
+        # Also covers sinks the parser abandoned because the upload was rejected
+        super().close()
+        for sink in self.__dict__.get('upload_sinks', []):
+            sink.close()
+
+def inspect_upload(head):
+    """Rejects an upload as soon as its first bytes show it is not an allowed image"""
+    file_ext = sniff_image_type(head)
+    if file_ext is None or file_ext[1:] not in app.config['ALLOWED_EXTENSIONS']:
+        raise UnsupportedMediaType()
+    return file_ext
+
+def strip_upload(source, destination):
+    """Drops EXIF/GPS and other metadata from a new upload before it is stored, since originals are public"""
+    try:
+        strip_metadata(source, destination)
+    except ValueError:
+        raise UnsupportedMediaType()
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///photogram.db'
+app.request_class = UploadRequest
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///photogram.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Database profile (see database.py): 'development' keeps SQLite's defaults and
+# 'production' enables WAL, relaxed fsync, bigger caches and a sized pool.
+# DATABASE_URL may also point at PostgreSQL (pip install psycopg2-binary)
+app.config['DB_PROFILE'] = os.environ.get('DB_PROFILE', 'development')
+app.config['DB_BUSY_RETRIES'] = 5  # times a write view is re-run when the database is locked
+app.config['DB_BUSY_BACKOFF'] = 0.02  # seconds before the first retry, doubling after each
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['DB_PROFILE'],
+                                                         app.config['SQLALCHEMY_DATABASE_URI'])
+
+# Read replicas for @read_only views, as comma-separated DATABASE_REPLICA_URLS.
+# DB_READ_ONLY_POOL=1 adds read-only connections to the SQLite file as a replica.
+# After a write, that visitor reads from the primary for DB_STICKY_SECONDS
+app.config['DB_REPLICA_URLS'] = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+app.config['DB_READ_ONLY_POOL'] = os.environ.get('DB_READ_ONLY_POOL') == '1'
+if app.config['DB_READ_ONLY_POOL'] and app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['DB_REPLICA_URLS'].append(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['DB_STICKY_SECONDS'] = 5  # longer than the replication lag you expect
+app.config['SQLALCHEMY_BINDS'] = replica_binds(app.config['DB_REPLICA_URLS'])
 app.config['SECRET_KEY'] = 'dev-key-change-in-production'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
+app.config['IMAGE_WORKERS'] = 2  # background threads resizing uploads
+
+# Uploaded media: None serves bytes from Python, 'sendfile' emits X-Sendfile for
+# Apache/lighttpd and 'nginx' emits X-Accel-Redirect to MEDIA_ACCEL_PREFIX, an
+# internal location aliased to the upload folder
+app.config['MEDIA_ACCEL'] = os.environ.get('MEDIA_ACCEL') or None
+app.config['MEDIA_ACCEL_PREFIX'] = '/protected-uploads/'
+app.config['MEDIA_MAX_AGE'] = 365 * 24 * 3600
+app.config['USE_X_SENDFILE'] = app.config['MEDIA_ACCEL'] == 'sendfile'
+
+# Rendered HTML cache (see caching.py): 'memory' is per process, 'sqlite' is
+# shared by every worker on the host, and an empty value turns caching off
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_MAX_ENTRIES'] = 5000
+app.config['PAGE_CACHE_TTL'] = 30  # whole pages for anonymous visitors
+app.config['FRAGMENT_CACHE_TTL'] = 600  # individual post cards
+
+# Instrumentation (see instrumentation.py): per-request SQL, template and upload
+# timings exported at /metrics. SERVER_TIMING=1 also sends them to the browser
+# in a Server-Timing header, and PROFILE_SLOW_MS=<ms> writes the sampled stacks
+# of slower requests to PROFILE_DIR for flame graphs
+app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION', '1') == '1'
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING') == '1'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # without one, /metrics answers nobody
+app.config['SLOW_QUERY_SECONDS'] = 0.1
+app.config['SLOW_QUERY_SAMPLES'] = 200  # most recent slow queries kept for /metrics/slow-queries
+app.config['PROFILE_SLOW_MS'] = float(os.environ['PROFILE_SLOW_MS']) if os.environ.get('PROFILE_SLOW_MS') else None
+app.config['PROFILE_INTERVAL'] = 0.005  # seconds between stack samples
+app.config['PROFILE_DIR'] = os.path.join(app.instance_path, 'profiles')
+
+# Authentication (see passwords.py): password hashes run on a small thread pool
+# so a burst of logins cannot tie up every request thread, and hashes made with
+# other settings are redone when their owner next logs in. The logged-in user's
+# profile fields are cached for IDENTITY_CACHE_TTL seconds between requests
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+app.config['PASSWORD_SALT_LENGTH'] = 16
+app.config['PASSWORD_HASH_WORKERS'] = 2
+# Hashes allowed to wait before logins are turned away. Each waiting login holds a
+# view thread, so None keeps running plus waiting hashes to a quarter of ASGI_THREADS
+app.config['PASSWORD_HASH_QUEUE'] = None
+app.config['IDENTITY_CACHE_TTL'] = 60
+
+# Rate limits (see ratelimit.py): token buckets per client IP, per logged-in user
+# and, for logins, per submitted username. Each rule is (scope, requests per
+# minute, burst). 'memory' keeps buckets per process, 'sqlite' shares them
+# between the workers on a host, and an empty value turns limiting off. Behind
+# a proxy, wrap the app in werkzeug's ProxyFix so remote_addr is the client's
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+app.config['RATE_LIMIT_MAX_BUCKETS'] = 100000  # per process with 'memory'
+app.config['RATE_LIMITS'] = {
+    'login': [('ip', 20, 10), ('username', 10, 5)],
+    'register': [('ip', 5, 5)],
+    'like': [('user', 120, 60), ('ip', 600, 120)],
+    'comment': [('user', 30, 10), ('ip', 120, 30)],
+    'create': [('user', 10, 5), ('ip', 30, 10)],
+}
+
+# Likes: with LIKE_WRITE_BEHIND=1 a like is queued in a local SQLite file and
+# written to the database in batches by a background thread (see likequeue.py)
+app.config['LIKE_WRITE_BEHIND'] = os.environ.get('LIKE_WRITE_BEHIND') == '1'
+app.config['LIKE_QUEUE_PATH'] = os.environ.get('LIKE_QUEUE_PATH',
+                                               os.path.join(app.instance_path, 'like_queue.db'))
+app.config['LIKE_FLUSH_INTERVAL'] = 0.5  # seconds between flushes
+app.config['LIKE_FLUSH_BATCH'] = 500  # queued likes written per transaction
+app.config['FEED_PAGE_SIZE'] = 10  # posts per page in feeds
+app.config['FEED_PREVIEW_COMMENTS'] = 2  # comments shown under each post in feeds
+app.config['COMMENT_PAGE_SIZE'] = 20  # comments per page on post pages and in the API
+app.config['API_MAX_BATCH'] = 100  # post ids accepted by one /api/likes request
+
+# Follow graph (see graph.py): following/follower lists cached per process and
+# checked against version counters on every lookup. GRAPH_VERSIONS 'sqlite'
+# keeps the counters in a local file every process on the host sees (or in
+# the page cache when that is SQLite already); 'memory' keeps them in the page
+# cache, or per process without one. serve.py picks 'sqlite' for more than one worker
+app.config['GRAPH_VERSIONS'] = os.environ.get('GRAPH_VERSIONS', 'memory')
+app.config['GRAPH_MAX_LISTS'] = 100000
+app.config['GRAPH_TTL'] = 300  # seconds, for version counters other processes cannot see
+app.config['FOLLOW_SUGGESTIONS'] = 5  # "who to follow" entries on the home feed
+app.config['SUGGESTIONS_TTL'] = 600  # seconds a user's suggestions are reused while they follow no one new
+app.config['FEED_INLINE_FOLLOWS'] = 500  # above this many follows the feed filters with a subquery
+
+# Trending on explore (see ranking.py): posts, likes and comments add weighted
+# points that halve in value every TRENDING_HALF_LIFE seconds. The best
+# TRENDING_TOP_K posts are kept in memory and reloaded from the index every
+# TRENDING_RELOAD seconds to pick up other processes' writes
+app.config['TRENDING_HALF_LIFE'] = 6 * 3600
+app.config['TRENDING_WEIGHTS'] = {'post': 1.0, 'like': 1.0, 'comment': 2.0}
+app.config['TRENDING_TOP_K'] = 500
+app.config['TRENDING_RELOAD'] = 60
+app.config['TRENDING_WINDOW_DAYS'] = 7  # activity the recompute-trending job looks at
+
+# Search (see search.py): 'fts5' indexes captions, comments and users with
+# SQLite FTS5, 'like' scans the tables with LIKE, and 'auto' picks FTS5 when
+# the database supports it
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')
+app.config['SEARCH_MAX_CANDIDATES'] = 1000  # newest matches ranked per query
+app.config['SEARCH_PAGE_SIZE'] = 12
+app.config['AUTOCOMPLETE_LIMIT'] = 8
+
+# Notifications (see notifications.py): likes, comments and follows append to an
+# activity log, and a background thread folds the log into inboxes every
+# NOTIFICATION_INTERVAL seconds, collapsing a burst on one post into a single
+# "alice and 41 others liked your post". NOTIFICATION_AGGREGATOR=0 leaves the
+# folding to `flask aggregate-notifications`
+app.config['NOTIFICATION_AGGREGATOR'] = os.environ.get('NOTIFICATION_AGGREGATOR', '1') == '1'
+app.config['NOTIFICATION_INTERVAL'] = 2.0  # seconds between batches
+app.config['NOTIFICATION_BATCH'] = 1000  # events folded in per transaction
+app.config['NOTIFICATION_PAGE_SIZE'] = 20
+app.config['ACTIVITY_RETENTION_DAYS'] = 30  # folded-in events kept by prune-activity
+
+# Live updates (see live.py): pages follow like counts and new comments on the
+# posts they show over server-sent events. 'memory' only reaches streams in the
+# process that made the change; 'sqlite' relays events through a local file to
+# every process on the host, including `flask live-server`, which holds streams
+# on an event loop rather than a thread each. Point LIVE_URL at that server
+# (e.g. '/api/live' routed to it by the proxy); an empty LIVE_BROKER turns
+# live updates off. Pages only open streams that an event loop holds: those of
+# asgi.py or of the server at LIVE_URL
+app.config['LIVE_BROKER'] = os.environ.get('LIVE_BROKER', 'memory')
+app.config['LIVE_URL'] = os.environ.get('LIVE_URL')  # None: this app's own /api/live
+app.config['LIVE_MAX_POSTS'] = 100  # posts one stream may follow
+app.config['LIVE_ON_LOOP'] = False  # set by asgi.py, which answers /api/live before Flask does
+# /api/live streams per process served by Flask itself. Each holds a request
+# thread for as long as its page stays open, so plain WSGI serves none unless
+# this is raised, and then it should stay well below the server's thread count
+app.config['LIVE_MAX_STREAMS'] = int(os.environ.get('LIVE_MAX_STREAMS', 0))
+app.config['LIVE_KEEPALIVE'] = 15  # seconds between keepalive comments
+
+# Serving (see serve.py and asgi.py): under an ASGI server the event loop
+# receives request bodies, holds /api/live streams and answers anonymous like
+# counts, and Flask views run on ASGI_THREADS threads per worker process
+app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 32))
+app.config['ASGI_SPOOL_BYTES'] = 1024 * 1024  # request bodies past this size are spooled to a temporary file
+app.config['ASGI_MAX_STREAMS'] = 10000  # /api/live streams per worker on the event loop
+app.config['ASYNC_READ_THREADS'] = 4  # async reads run on these when no async database driver is installed
+
+# Home feed assembly: 'read' queries followed authors on every request, 'write'
+# pushes new posts into each follower's materialized timeline, and 'hybrid'
+# does the same except for authors with more than FANOUT_FOLLOWER_LIMIT
+# followers, whose posts are merged in at read time
+app.config['FEED_MODE'] = os.environ.get('FEED_MODE', 'read')
+app.config['TIMELINE_BACKEND'] = os.environ.get('TIMELINE_BACKEND', 'sql')  # 'sql' or 'memory'
+app.config['FANOUT_FOLLOWER_LIMIT'] = 10000
+app.config['TIMELINE_BACKFILL_POSTS'] = 200  # posts copied into a timeline on follow
 
 # Check that upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'), exist_ok=True)
 
-db = SQLAlchemy(app)
+# Uploads are stored under the hash of their contents (see storage.py) and
+# resized variants are generated in the background (see media.py)
+blob_store = BlobStore(app.config['UPLOAD_FOLDER'], rewrite=strip_upload)
+image_pipeline = ImagePipeline(app.config['UPLOAD_FOLDER'], app.config['IMAGE_WORKERS'])
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+if app.config['INSTRUMENTATION']:
+    profiler = None
+    if app.config['PROFILE_SLOW_MS'] is not None:
+        profiler = SamplingProfiler(app.config['PROFILE_DIR'], app.config['PROFILE_SLOW_MS'] / 1000,
+                                    app.config['PROFILE_INTERVAL'])
+    request_metrics = RequestMetrics(app.config['SLOW_QUERY_SECONDS'], app.config['SLOW_QUERY_SAMPLES'], profiler)
+    app.jinja_env.template_class = TimedTemplate
+else:
+    request_metrics = None
+
+with app.app_context():
+    for bind_key, engine in db.engines.items():
+        apply_pragmas(engine, PROFILES[app.config['DB_PROFILE']]['pragmas'], read_only=is_replica(bind_key))
+        add_math_functions(engine)
+        if request_metrics is not None:
+            request_metrics.instrument_engine(engine)
+
+# Re-runs a write view when SQLite reports the database is locked
+write_retry = retry_on_busy(db.session, app.config['DB_BUSY_RETRIES'], app.config['DB_BUSY_BACKOFF'])
+
+if app.config['CACHE_BACKEND'] == 'sqlite':
+    os.makedirs(app.instance_path, exist_ok=True)
+    cache = SqliteCache(os.path.join(app.instance_path, 'cache.db'), app.config['CACHE_MAX_ENTRIES'])
+elif app.config['CACHE_BACKEND'] == 'memory':
+    cache = MemoryCache(app.config['CACHE_MAX_ENTRIES'])
+else:
+    cache = None
+
+# Shares the page cache when there is one, so edits reach every process at once
+identity_cache = cache if cache is not None else MemoryCache(app.config['CACHE_MAX_ENTRIES'])
+
+if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+    os.makedirs(app.instance_path, exist_ok=True)
+    # Keep idle buckets until the slowest of them has refilled
+    idle = max(burst * 60 / per_minute for rules in app.config['RATE_LIMITS'].values() for _, per_minute, burst in rules)
+    rate_limiter = SqliteBuckets(os.path.join(app.instance_path, 'ratelimit.db'), idle)
+elif app.config['RATE_LIMIT_BACKEND'] == 'memory':
+    rate_limiter = MemoryBuckets(app.config['RATE_LIMIT_MAX_BUCKETS'])
+else:
+    rate_limiter = None
+
+if app.config['LIVE_BROKER'] == 'sqlite':
+    os.makedirs(app.instance_path, exist_ok=True)
+    live_updates = SqliteBroker(os.path.join(app.instance_path, 'live.db'), LiveHub())
+elif app.config['LIVE_BROKER'] == 'memory':
+    live_updates = LiveHub()
+else:
+    live_updates = None
+
+if app.config['PASSWORD_HASH_QUEUE'] is None:
+    app.config['PASSWORD_HASH_QUEUE'] = max(0, app.config['ASGI_THREADS'] // 4 - app.config['PASSWORD_HASH_WORKERS'])
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'],
+                                 app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
 
 # Create User Model
 class User(db.Model):
@@ -32,6 +318,20 @@ class User(db.Model):
     bio = db.Column(db.String(250), default='')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Denormalized counters, kept in step with the rows they count (see bump_counters)
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    # Notifications newer than notifications_read_at are unread; the aggregator
+    # counts them as it creates them and opening the inbox resets the count
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    notifications_read_at = db.Column(db.DateTime)
+    
+    # Set once any of this user's posts skipped fan-out (FEED_MODE=hybrid); feeds
+    # then merge their posts at read time, even after they drop below the limit
+    fanout_skipped = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    
     # Relationships
     posts = db.relationship('Post', backref='author', lazy=True, cascade="all, delete-orphan")
     comments = db.relationship('Comment', backref='author', lazy=True, cascade="all, delete-orphan")
@@ -58,21 +358,27 @@ class User(db.Model):
         return f'<User {self.username}>'
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Checks a password, rehashing it if the stored hash uses older settings (the caller commits)"""
+        matches, outdated = password_hasher.verify(self.password_hash, password)
+        if outdated:
+            self.set_password(password)
+        return matches
     
     def is_following(self, user):
-        return Follow.query.filter_by(
-            follower_id=self.id,
-            followed_id=user.id
-        ).count() > 0
+        return follow_graph.is_following(self.id, user.id)
     
     def follow(self, user):
-        if not self.is_following(user):
+        # Writes check the database itself; the cached graph may lag another process
+        if not Follow.query.filter_by(follower_id=self.id, followed_id=user.id).first():
             follow = Follow(follower_id=self.id, followed_id=user.id)
             db.session.add(follow)
+            bump_counters(User, self.id, following_count=1)
+            bump_counters(User, user.id, follower_count=1)
+            backfill_timeline(self.id, user)
+            record_activity('follow', self.id, user.id)
     
     def unfollow(self, user):
         follow = Follow.query.filter_by(
@@ -81,6 +387,9 @@ class User(db.Model):
         ).first()
         if follow:
             db.session.delete(follow)
+            bump_counters(User, self.id, following_count=-1)
+            bump_counters(User, user.id, follower_count=-1)
+            prune_timeline(self.id, user)
 
 # Create Follow Model (for user following relationship)
 class Follow(db.Model):
@@ -88,6 +397,26 @@ class Follow(db.Model):
     follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # The unique index doubles as the lookup for "who does X follow"
+    __table_args__ = (
+        db.Index('uq_follow_follower_followed', 'follower_id', 'followed_id', unique=True),
+        db.Index('ix_follow_followed_follower', 'followed_id', 'follower_id'),
+    )
+
+# Create TimelineEntry Model (materialized home feeds, see timeline.py)
+class TimelineEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id'),
+        db.Index('ix_timeline_entry_user_created', 'user_id', 'created_at', 'post_id'),
+        db.Index('ix_timeline_entry_user_author', 'user_id', 'author_id'),
+    )
 
 # Create Like Model
 class Like(db.Model):
@@ -97,7 +426,10 @@ class Like(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Add unique constraint to prevent multiple likes from same user
-    __table_args__ = (db.UniqueConstraint('user_id', 'post_id'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id'),
+        db.Index('ix_like_post_user', 'post_id', 'user_id'),
+    )
 
 # Create Comment Model
 class Comment(db.Model):
@@ -107,6 +439,9 @@ class Comment(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    # A post's comments in display order
+    __table_args__ = (db.Index('ix_comment_post_created', 'post_id', 'created_at', 'id'),)
+    
     def time_since(self):
         """Returns a human-readable time string like '2 hours ago'"""
         delta = datetime.utcnow() - self.created_at
@@ -122,6 +457,11 @@ class Comment(db.Model):
         else:
             return "just now"
 
+def initial_trend_score(context):
+    """Column default: the post's own point, so new posts start out trending"""
+    created_at = context.get_current_parameters().get('created_at') or datetime.utcnow()
+    return trend_point(created_at, app.config['TRENDING_WEIGHTS']['post'], app.config['TRENDING_HALF_LIFE'])
+
 # Create Post Model
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -130,8 +470,24 @@ class Post(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    # Denormalized counters, kept in step with the rows they count (see bump_counters)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    # Log-space, time-decayed popularity (see ranking.py and bump_trend)
+    trend_score = db.Column(db.Float, nullable=False, default=initial_trend_score, server_default='0')
+    
+    # Feeds page newest-first by (created_at, id), globally or per author. SQLite
+    # walks these ascending indexes backwards for ORDER BY ... DESC
+    __table_args__ = (
+        db.Index('ix_post_created_at_id', 'created_at', 'id'),
+        db.Index('ix_post_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_post_trend_score', 'trend_score', 'id'),
+    )
+    
     # Relationships
-    comments = db.relationship('Comment', backref='post', lazy=True, cascade="all, delete-orphan")
+    # A post can have any number of comments; page through them with paginate_comments()
+    comments = db.relationship('Comment', backref='post', lazy='dynamic', cascade="all, delete-orphan")
     likes = db.relationship('Like', backref='post', lazy=True, cascade="all, delete-orphan")
     
     def __repr__(self):
@@ -151,9 +507,695 @@ class Post(db.Model):
             return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
         else:
             return "just now"
+
+# Create Hashtag Model (tags are extracted from captions, see index_post)
+class Hashtag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+# Create PostHashtag Model
+class PostHashtag(db.Model):
+    # The primary key pages a tag's posts newest first by post id
+    hashtag_id = db.Column(db.Integer, db.ForeignKey('hashtag.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+
+# Create ActivityEvent Model (append-only log the notification aggregator reads)
+class ActivityEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # 'like', 'comment' or 'follow'
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Set by the aggregator in the transaction that folds the event into an inbox
+    folded = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    
+    # The aggregator reads unfolded events by id; pruning reads by age
+    __table_args__ = (
+        db.Index('ix_activity_event_folded', 'folded', 'id'),
+        db.Index('ix_activity_event_created', 'created_at'),
+    )
+
+# Create Notification Model (one inbox entry, standing for one or more collapsed events)
+class Notification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # the most recent actor
+    actor_count = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    # An inbox pages newest first by (updated_at, id)
+    __table_args__ = (db.Index('ix_notification_user_updated', 'user_id', 'updated_at', 'id'),)
+    
+    actor = db.relationship('User', foreign_keys=[actor_id])
+    post = db.relationship('Post')
+    
+    def describe(self):
+        return describe(self.kind, self.actor.username, self.actor_count)
+    
+    def time_since(self):
+        """Returns a human-readable time string like '2 hours ago'"""
+        delta = datetime.utcnow() - self.updated_at
+        
+        if delta.days > 0:
+            return f"{delta.days} days ago"
+        elif delta.seconds >= 3600:
+            hours = delta.seconds // 3600
+            return f"{hours} hour{'s' if hours != 1 else ''} ago"
+        elif delta.seconds >= 60:
+            minutes = delta.seconds // 60
+            return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
+        else:
+            return "just now"
+
+# Counter maintenance
+def bump_counters(model, row_id, **deltas):
+    """Adds deltas to counter columns with a single UPDATE in the current transaction"""
+    values = {getattr(model, name): getattr(model, name) + delta for name, delta in deltas.items()}
+    model.query.filter_by(id=row_id).update(values, synchronize_session=False)
+
+def reconcile_counters():
+    """Recomputes every counter column from the underlying rows in bulk"""
+    def count_of(model, column, owner):
+        return select(func.count(model.id)).where(column == owner.id).scalar_subquery()
+    
+    Post.query.update({
+        Post.like_count: count_of(Like, Like.post_id, Post),
+        Post.comment_count: count_of(Comment, Comment.post_id, Post),
+    }, synchronize_session=False)
+    User.query.update({
+        User.follower_count: count_of(Follow, Follow.followed_id, User),
+        User.following_count: count_of(Follow, Follow.follower_id, User),
+        User.post_count: count_of(Post, Post.user_id, User),
+        User.unread_notifications: select(func.count(Notification.id)).where(
+            Notification.user_id == User.id,
+            or_(User.notifications_read_at.is_(None), Notification.updated_at > User.notifications_read_at),
+        ).scalar_subquery(),
+    }, synchronize_session=False)
+    db.session.commit()
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Repair drift in the denormalized like/comment/follow/post/unread counters"""
+    reconcile_counters()
+    print('Counters reconciled')
+
+# Follow graph (see graph.py)
+def load_follow_lists(kind, user_ids):
+    """Returns {user_id: [ids]} of who each user follows, or who follows them"""
+    if kind == 'following':
+        owner, other = Follow.follower_id, Follow.followed_id
+    else:
+        owner, other = Follow.followed_id, Follow.follower_id
+    lists = {}
+    for start in range(0, len(user_ids), 500):
+        for owner_id, other_id in db.session.query(owner, other).filter(owner.in_(user_ids[start:start + 500])):
+            lists.setdefault(owner_id, []).append(other_id)
+    return lists
+
+# Version counters only see the writes of processes sharing their store, and
+# GRAPH_TTL covers the rest
+if app.config['GRAPH_VERSIONS'] == 'sqlite' and not isinstance(cache, SqliteCache):
+    os.makedirs(app.instance_path, exist_ok=True)
+    graph_versions = SqliteCache(os.path.join(app.instance_path, 'graph.db'))
+else:
+    graph_versions = cache if cache is not None else MemoryCache()
+follow_graph = FollowGraph(load_follow_lists, graph_versions.versions,
+                           app.config['GRAPH_MAX_LISTS'], app.config['GRAPH_TTL'])
+
+def invalidate_follow(follower_id, followed_id):
+    graph_versions.bump(f'following:{follower_id}', f'followers:{followed_id}')
+
+def suggested_users(user_id, limit=None):
+    """Returns [(user, mutual count)] to suggest following, best first"""
+    limit = limit or app.config['FOLLOW_SUGGESTIONS']
+    # Friends of friends walk every followed account's list, so the result is
+    # kept until the user follows or unfollows someone, or SUGGESTIONS_TTL passes
+    version, = graph_versions.versions([f'following:{user_id}'])
+    key = f'suggestions:{user_id}:{limit}:{version}'
+    suggestions = graph_versions.get(key)
+    if suggestions is None:
+        suggestions = follow_graph.suggestions([user_id], limit)[user_id]
+        if len(suggestions) < limit:
+            # Not enough friends of friends yet: fill up with the most followed accounts
+            exclude = {user_id, *follow_graph.following(user_id), *(candidate for candidate, _ in suggestions)}
+            popular = db.session.query(User.id).filter(User.id.notin_(exclude)) \
+                .order_by(User.follower_count.desc(), User.id).limit(limit - len(suggestions))
+            suggestions += [(candidate, 0) for (candidate,) in popular]
+        graph_versions.set(key, suggestions, app.config['SUGGESTIONS_TTL'])
+    users = {user.id: user for user in User.query.filter(User.id.in_([candidate for candidate, _ in suggestions]))}
+    return [(users[candidate], mutual) for candidate, mutual in suggestions if candidate in users]
+
+@app.cli.command('suggest-follows')
+@click.argument('username')
+def suggest_follows_command(username):
+    """Show who-to-follow suggestions for a user"""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter(f'No user named {username}')
+    for suggestion, mutual in suggested_users(user.id, 20):
+        print(f'{suggestion.username:<20} {mutual} mutual')
+
+# Trending scores (see ranking.py)
+trending = TopK(app.config['TRENDING_TOP_K'])
+
+def event_point(kind, at=None):
+    return trend_point(at or datetime.utcnow(), app.config['TRENDING_WEIGHTS'][kind],
+                       app.config['TRENDING_HALF_LIFE'])
+
+def bump_trend(post_id, point, remove=False):
+    """Adds (or takes back) an event's point to a post's score in one UPDATE; returns the new score"""
+    score = Post.trend_score
+    if remove:
+        # log(e^score - e^point), left alone if rounding leaves nothing to take away
+        value = case((score > point + 1e-9, score + func.ln(1 - func.exp(point - score))), else_=score)
+    else:
+        # log(e^score + e^point), factored around the larger term so exp() cannot overflow
+        value = case((score >= point, score + func.ln(1 + func.exp(point - score))),
+                     else_=point + func.ln(1 + func.exp(score - point)))
+    Post.query.filter_by(id=post_id).update({Post.trend_score: value}, synchronize_session=False)
+    return db.session.query(Post.trend_score).filter_by(id=post_id).scalar()
+
+def trending_page(offset=0, limit=None):
+    """Returns one page of posts ranked by trend score and the offset of the next page"""
+    limit = limit or app.config['FEED_PAGE_SIZE']
+    now = time.monotonic()
+    if trending.loaded_at is None or now - trending.loaded_at > app.config['TRENDING_RELOAD']:
+        top = db.session.query(Post.id, Post.trend_score) \
+            .order_by(Post.trend_score.desc(), Post.id.desc()) \
+            .limit(app.config['TRENDING_TOP_K'])
+        trending.reload(top, now)
+    
+    post_ids = trending.page(offset, limit + 1)
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(post_ids[:limit]))}
+    next_offset = offset + limit if len(post_ids) > limit else None
+    return [posts[post_id] for post_id in post_ids[:limit] if post_id in posts], next_offset
+
+def recompute_trending(window_days=None):
+    """Rebuilds the scores of posts active in the last window_days in bulk; returns posts updated"""
+    since = datetime.utcnow() - timedelta(days=window_days or app.config['TRENDING_WINDOW_DAYS'])
+    weights = app.config['TRENDING_WEIGHTS']
+    half_life = app.config['TRENDING_HALF_LIFE']
+    
+    post_ids, points = [], []
+    for kind, post_id_column, created_at_column in [
+        ('post', Post.id, Post.created_at),
+        ('like', Like.post_id, Like.created_at),
+        ('comment', Comment.post_id, Comment.created_at),
+    ]:
+        for post_id, created_at in db.session.query(post_id_column, created_at_column) \
+                .filter(created_at_column >= since):
+            post_ids.append(post_id)
+            points.append(trend_point(created_at, weights[kind], half_life))
+    
+    scores = group_logsumexp(post_ids, points)
+    rows = [{'id': post_id, 'trend_score': score} for post_id, score in scores.items()]
+    for start in range(0, len(rows), 1000):
+        db.session.bulk_update_mappings(Post, rows[start:start + 1000])
+    db.session.commit()
+    trending.loaded_at = None  # Reload the top posts on the next request
+    return len(rows)
+
+@app.cli.command('recompute-trending')
+@click.option('--window-days', type=float, default=None, help='Activity to score (default TRENDING_WINDOW_DAYS)')
+def recompute_trending_command(window_days):
+    """Recompute trending scores from recent posts, likes and comments"""
+    print(f'{recompute_trending(window_days)} posts rescored')
+
+# Likes
+def toggle_like(user_id, post):
+    """Likes or unlikes a post for a user; returns whether it is now liked"""
+    if like_queue is not None:
+        # Write-behind: flip the state the user currently sees and queue it
+        liked = not like_queue.pending(user_id, [post.id]).get(
+            post.id, Like.query.filter_by(user_id=user_id, post_id=post.id).count() > 0)
+        like_queue.put(user_id, post.id, liked)
+        return liked
+    
+    existing_like = Like.query.filter_by(user_id=user_id, post_id=post.id).first()
+    
+    score = None
+    if existing_like:
+        # Unlike; only count the row if a concurrent unlike did not remove it first
+        removed = Like.query.filter_by(id=existing_like.id).delete(synchronize_session=False)
+        if removed:
+            bump_counters(Post, post.id, like_count=-1)
+            if existing_like.created_at:
+                score = bump_trend(post.id, event_point('like', existing_like.created_at), remove=True)
+        db.session.commit()
+        liked = False
+    else:
+        # Like
+        try:
+            new_like = Like(user_id=user_id, post_id=post.id)
+            db.session.add(new_like)
+            db.session.flush()
+            bump_counters(Post, post.id, like_count=1)
+            record_activity('like', user_id, post.user_id, post.id)
+            score = bump_trend(post.id, event_point('like'))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # A concurrent request liked it first
+            score = None
+        liked = True
+    if score is not None:
+        trending.offer(post.id, score)
+    invalidate(f'post:{post.id}')
+    publish_likes([post.id])
+    return liked
+
+def apply_like_batch(states):
+    """Writes queued (user_id, post_id, liked) states and their counters in one transaction"""
+    with app.app_context():
+        user_ids = {user_id for user_id, _, _ in states}
+        post_ids = {post_id for _, post_id, _ in states}
+        existing = {
+            (user_id, post_id): (like_id, created_at)
+            for like_id, user_id, post_id, created_at
+            in db.session.query(Like.id, Like.user_id, Like.post_id, Like.created_at)
+                .filter(Like.user_id.in_(user_ids), Like.post_id.in_(post_ids))
+        }
+        
+        # Counters move by what each statement actually changed, not by the snapshot
+        # above: another process flushing the same rows may have got there first
+        deltas = Counter()
+        added = []
+        added_points, removed_points = ([], []), ([], [])  # (post ids, trend points)
+        for user_id, post_id, liked in states:
+            if liked and (user_id, post_id) not in existing:
+                try:
+                    with db.session.begin_nested():
+                        db.session.add(Like(user_id=user_id, post_id=post_id))
+                except IntegrityError:
+                    continue  # Liked concurrently
+                added.append((user_id, post_id))
+                deltas[post_id] += 1
+                added_points[0].append(post_id)
+                added_points[1].append(event_point('like'))
+            elif not liked and (user_id, post_id) in existing:
+                like_id, created_at = existing[(user_id, post_id)]
+                if not Like.query.filter_by(id=like_id).delete(synchronize_session=False):
+                    continue  # Unliked concurrently
+                deltas[post_id] -= 1
+                if created_at:
+                    removed_points[0].append(post_id)
+                    removed_points[1].append(event_point('like', created_at))
+        if added:
+            authors = dict(db.session.query(Post.id, Post.user_id).filter(Post.id.in_({post_id for _, post_id in added})))
+            for user_id, post_id in added:
+                if post_id in authors:
+                    record_activity('like', user_id, authors[post_id], post_id)
+        for post_id, delta in deltas.items():
+            if delta:
+                bump_counters(Post, post_id, like_count=delta)
+        
+        # One score update per post and direction: the batch's points combined by log-sum-exp
+        scores = {}
+        for points, remove in [(added_points, False), (removed_points, True)]:
+            for post_id, point in group_logsumexp(*points).items():
+                scores[post_id] = bump_trend(post_id, point, remove=remove)
+        db.session.commit()
+        for post_id, score in scores.items():
+            trending.offer(post_id, score)
+        invalidate(*[f'post:{post_id}' for post_id in deltas])
+        publish_likes([post_id for post_id, delta in deltas.items() if delta])
+
+# Like counts of some posts, for live streams; a Core statement so async readers can run it too
+LIKE_COUNTS = select(Post.id, Post.like_count).where(Post.id.in_(bindparam('post_ids', expanding=True)))
+
+def like_count_events(rows):
+    return [format_event('likes', {'post_id': post_id, 'like_count': count}) for post_id, count in rows]
+
+def publish_likes(post_ids):
+    """Pushes the current like counts of posts to live streams"""
+    if live_updates is None or not post_ids:
+        return
+    for post_id, count in db.session.execute(LIKE_COUNTS, {'post_ids': list(post_ids)}):
+        live_updates.publish(post_id, 'likes', {'post_id': post_id, 'like_count': count})
+
+if app.config['LIKE_WRITE_BEHIND']:
+    os.makedirs(os.path.dirname(app.config['LIKE_QUEUE_PATH']), exist_ok=True)
+    like_queue = LikeQueue(app.config['LIKE_QUEUE_PATH'], apply_like_batch,
+                           app.config['LIKE_FLUSH_INTERVAL'], app.config['LIKE_FLUSH_BATCH'])
+    like_queue.start()
+    atexit.register(like_queue.stop)
+else:
+    like_queue = None
+
+@app.cli.command('flush-likes')
+def flush_likes_command():
+    """Write every queued like to the database now"""
+    if like_queue is None:
+        print('LIKE_WRITE_BEHIND is off; there is no queue to flush')
+        return
+    print(f'{like_queue.flush()} queued likes written')
+
+# Comments
+def create_comment(post, user_id, content):
+    """Adds a comment and bumps the post's counter; returns None for a blank comment"""
+    if not content.strip():
+        return None
+    comment = Comment(content=content, post_id=post.id, user_id=user_id)
+    db.session.add(comment)
+    db.session.flush()
+    search_index.index_comment(comment.id, post.id, content)
+    bump_counters(Post, post.id, comment_count=1)
+    record_activity('comment', user_id, post.user_id, post.id)
+    score = bump_trend(post.id, event_point('comment'))
+    db.session.commit()
+    trending.offer(post.id, score)
+    invalidate(f'post:{post.id}', 'search')
+    if live_updates is not None:
+        live_updates.publish(post.id, 'comment', {'post_id': post.id, 'comment': comment_json(comment)})
+    return comment
+
+# Notifications (see notifications.py)
+def record_activity(kind, actor_id, recipient_id, post_id=None):
+    """Appends an event to the activity log in the current transaction; nobody is told about their own actions"""
+    if actor_id != recipient_id:
+        db.session.add(ActivityEvent(kind=kind, actor_id=actor_id, recipient_id=recipient_id, post_id=post_id))
+
+def aggregate_activity(batch_size=None):
+    """Folds the next batch of logged events into inboxes; returns how many it folded in"""
+    batch_size = batch_size or app.config['NOTIFICATION_BATCH']
+    with app.app_context():
+        # Look before claiming, so an idle tick does not take the write lock
+        idle = db.session.query(ActivityEvent.id).filter(ActivityEvent.folded == False).first() is None
+        db.session.rollback()  # Ends the read, so the claim starts from a fresh snapshot
+        if idle:
+            return 0
+        
+        # Claim the batch by flagging it before reading inboxes. A concurrent
+        # aggregator's UPDATE waits for this one and then skips the flagged rows,
+        # and an event committed late with a lower id is still unflagged next
+        # tick. On SQLite the write lock also keeps inboxes from being marked
+        # read between reading the open notifications and updating them
+        pending = select(ActivityEvent.id).filter(ActivityEvent.folded == False) \
+            .order_by(ActivityEvent.id).limit(batch_size).scalar_subquery()
+        events = sorted(db.session.execute(
+            update(ActivityEvent).where(ActivityEvent.folded == False, ActivityEvent.id.in_(pending))
+            .values(folded=True)
+            .returning(ActivityEvent.id, ActivityEvent.recipient_id, ActivityEvent.actor_id,
+                       ActivityEvent.kind, ActivityEvent.post_id, ActivityEvent.created_at)
+            .execution_options(synchronize_session=False)
+        ).all())
+        if not events:
+            db.session.rollback()
+            return 0
+        
+        recipient_ids = {event.recipient_id for event in events}
+        post_ids = {event.post_id for event in events if event.post_id is not None}
+        open_notifications = {
+            (notification.user_id, notification.kind, notification.post_id): notification
+            for notification in Notification.query.join(User, User.id == Notification.user_id).filter(
+                Notification.user_id.in_(recipient_ids),
+                or_(Notification.post_id.in_(post_ids), Notification.post_id.is_(None)),
+                or_(User.notifications_read_at.is_(None), Notification.updated_at > User.notifications_read_at),
+            )
+        }
+        
+        # updated_at is the time of folding rather than of the events, so anything
+        # folded in after the owner last opened their inbox shows as unread
+        now = datetime.utcnow()
+        unread = Counter()
+        for key, group in collapse(event[1:] for event in events).items():
+            notification = open_notifications.get(key)
+            if notification is None:
+                recipient_id, kind, post_id = key
+                db.session.add(Notification(user_id=recipient_id, kind=kind, post_id=post_id,
+                                            actor_id=group.actor_ids[-1], actor_count=len(group.actor_ids),
+                                            created_at=group.first_at, updated_at=now))
+                unread[recipient_id] += 1
+            else:
+                notification.actor_count = merged_count(notification.actor_count, notification.actor_id,
+                                                        group.actor_ids)
+                notification.actor_id = group.actor_ids[-1]
+                notification.updated_at = now
+        for user_id, count in unread.items():
+            bump_counters(User, user_id, unread_notifications=count)
+        db.session.commit()
+        return len(events)
+
+# Started by the first request rather than on import, so CLI commands and scripts run without it
+activity_aggregator = ActivityAggregator(aggregate_activity, app.config['NOTIFICATION_INTERVAL'],
+                                         app.config['NOTIFICATION_BATCH'])
+atexit.register(activity_aggregator.stop)
+
+@app.before_request
+def start_activity_aggregator():
+    if app.config['NOTIFICATION_AGGREGATOR']:
+        activity_aggregator.start()
+
+@app.cli.command('aggregate-notifications')
+def aggregate_notifications_command():
+    """Fold every pending activity event into inboxes now"""
+    print(f'{activity_aggregator.drain()} activity events folded in')
+
+@app.cli.command('prune-activity')
+@click.option('--days', type=float, default=None, help='keep events this recent (default ACTIVITY_RETENTION_DAYS)')
+def prune_activity_command(days):
+    """Delete old activity events that have been folded into inboxes"""
+    days = app.config['ACTIVITY_RETENTION_DAYS'] if days is None else days
+    removed = ActivityEvent.query.filter(
+        ActivityEvent.folded == True,
+        ActivityEvent.created_at < datetime.utcnow() - timedelta(days=days)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    print(f'{removed} activity events removed')
+
+def paginate_notifications(user_id, cursor=None, limit=None):
+    """Returns one page of an inbox (most recently updated first) and the cursor for the next page
+    
+    Actors and posts are joined in, so a page is a single query on ix_notification_user_updated.
+    """
+    limit = limit or app.config['NOTIFICATION_PAGE_SIZE']
+    query = Notification.query.options(
+        joinedload(Notification.actor), joinedload(Notification.post)
+    ).filter(Notification.user_id == user_id)
+    position = decode_cursor(cursor)
+    if position:
+        updated_at, notification_id = position
+        query = query.filter(or_(
+            Notification.updated_at < updated_at,
+            and_(Notification.updated_at == updated_at, Notification.id < notification_id)
+        ))
+    notifications = query.order_by(Notification.updated_at.desc(), Notification.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(notifications) > limit:
+        next_cursor = encode_cursor(notifications[limit - 1], notifications[limit - 1].updated_at)
+    return notifications[:limit], next_cursor
+
+def mark_notifications_read(user_id):
+    """Marks everything in a user's inbox as read"""
+    User.query.filter_by(id=user_id).update(
+        {User.unread_notifications: 0, User.notifications_read_at: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+# Search (see search.py)
+def choose_search_index():
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'auto':
+        with db.engine.connect() as connection:
+            backend = 'fts5' if db.engine.dialect.name == 'sqlite' and has_fts5(connection) else 'like'
+    index_class = FtsSearchIndex if backend == 'fts5' else LikeSearchIndex
+    return index_class(db.session, app.config['SEARCH_MAX_CANDIDATES'])
+
+with app.app_context():
+    search_index = choose_search_index()
+
+def hashtag_ids(names):
+    """Returns {name: id} for hashtag names, creating the ones that do not exist yet"""
+    ids = dict(db.session.query(Hashtag.name, Hashtag.id).filter(Hashtag.name.in_(names)))
+    for name in names:
+        if name not in ids:
+            try:
+                with db.session.begin_nested():
+                    tag = Hashtag(name=name)
+                    db.session.add(tag)
+                ids[name] = tag.id
+            except IntegrityError:
+                # Another post created the same tag first
+                ids[name] = db.session.query(Hashtag.id).filter_by(name=name).scalar()
+    return ids
+
+def index_post(post):
+    """Adds a new post to the search index and links its hashtags, in the current transaction"""
+    search_index.index_post(post.id, post.caption)
+    names = extract_hashtags(post.caption)
+    if names:
+        tag_ids = list(hashtag_ids(names).values())
+        db.session.add_all([PostHashtag(hashtag_id=tag_id, post_id=post.id) for tag_id in tag_ids])
+        Hashtag.query.filter(Hashtag.id.in_(tag_ids)) \
+            .update({Hashtag.post_count: Hashtag.post_count + 1}, synchronize_session=False)
+
+def index_user(user):
+    search_index.index_user(user.id, user.username, user.bio)
+
+def rebuild_search():
+    """Re-indexes everything and re-extracts hashtags from every caption"""
+    search_index.rebuild()
+    PostHashtag.query.delete()
+    Hashtag.query.delete()
+    tags = {}
+    for post_id, caption in db.session.query(Post.id, Post.caption).yield_per(1000):
+        for name in extract_hashtags(caption):
+            tags.setdefault(name, []).append(post_id)
+    db.session.bulk_insert_mappings(Hashtag, [
+        {'name': name, 'post_count': len(post_ids)} for name, post_ids in tags.items()
+    ])
+    ids = dict(db.session.query(Hashtag.name, Hashtag.id))
+    db.session.bulk_insert_mappings(PostHashtag, [
+        {'hashtag_id': ids[name], 'post_id': post_id} for name, post_ids in tags.items() for post_id in post_ids
+    ])
+    db.session.commit()
+    invalidate('search')
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the search index and hashtags from posts, comments and users"""
+    rebuild_search()
+    print(f'Search index rebuilt ({type(search_index).__name__}), {Hashtag.query.count()} hashtags')
+
+def search_posts(query, offset=0, limit=None):
+    """Returns one page of posts matching a search and the offset of the next page"""
+    limit = limit or app.config['SEARCH_PAGE_SIZE']
+    post_ids = search_index.posts(query, offset, limit + 1)
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(post_ids[:limit]))}
+    next_offset = offset + limit if len(post_ids) > limit else None
+    return [posts[post_id] for post_id in post_ids[:limit] if post_id in posts], next_offset
+
+def users_by_id(user_ids):
+    """Loads users in the order of user_ids"""
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+def hashtag_posts(tag, cursor=None, limit=None):
+    """Returns one page of a hashtag's posts, newest first, and the post id to continue from"""
+    limit = limit or app.config['SEARCH_PAGE_SIZE']
+    query = db.session.query(PostHashtag.post_id).filter(PostHashtag.hashtag_id == tag.id)
+    if cursor:
+        query = query.filter(PostHashtag.post_id < cursor)
+    post_ids = [post_id for (post_id,) in query.order_by(PostHashtag.post_id.desc()).limit(limit + 1)]
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(post_ids[:limit]))}
+    next_cursor = post_ids[limit - 1] if len(post_ids) > limit else None
+    return [posts[post_id] for post_id in post_ids[:limit] if post_id in posts], next_cursor
+
+# Request instrumentation (see instrumentation.py)
+@app.before_request
+def start_request_metrics():
+    if request_metrics is not None:
+        request_metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    if request_metrics is not None:
+        response = request_metrics.finish_request(response, app.config['SERVER_TIMING'])
+    return response
+
+@app.teardown_request
+def discard_request_metrics(error=None):
+    if request_metrics is not None:
+        request_metrics.discard_request()
+
+def metrics_access(f):
+    """Limits a view to requests bearing METRICS_TOKEN, and to nobody when no token is set"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request_metrics is None:
+            abort(404)
+        # No localhost exception: behind a proxy on the same host every request comes from localhost
+        token = app.config['METRICS_TOKEN']
+        if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/metrics')
+@metrics_access
+def metrics():
+    """This process's request, SQL, template and upload metrics for Prometheus"""
+    return app.response_class(request_metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/slow-queries')
+@metrics_access
+def slow_queries():
+    """The most recent queries slower than SLOW_QUERY_SECONDS, with the endpoint that ran them"""
+    return jsonify(queries=request_metrics.slow_query_samples())
+
+# Current user
+IDENTITY_FIELDS = ('id', 'username', 'email', 'profile_image', 'bio', 'created_at')
+
+def get_current_user():
+    """The logged-in User, loaded once per request; None for visitors"""
+    if 'current_user' not in g:
+        g.current_user = load_identity(session['user_id']) if 'user_id' in session else None
+    return g.current_user
+
+def load_identity(user_id):
+    """Attaches a user to the session from the identity cache, querying only on a miss
     
-    def is_liked_by(self, user):
-        return Like.query.filter_by(user_id=user.id, post_id=self.id).count() > 0
+    Counters and the password hash are not cached; they load on first access.
+    """
+    fields = identity_cache.get(f'identity:{user_id}')
+    if fields is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            identity_cache.set(f'identity:{user_id}', {name: getattr(user, name) for name in IDENTITY_FIELDS},
+                               app.config['IDENTITY_CACHE_TTL'])
+        return user
+    user = User(**fields)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def forget_identity(user_id):
+    identity_cache.delete(f'identity:{user_id}')
+
+@app.errorhandler(HasherBusy)
+def password_hasher_busy(error):
+    flash('We are handling a lot of sign-ins right now. Please try again in a moment', 'warning')
+    return redirect(request.url)
+
+# Rate limiting
+def rate_limit_key(scope):
+    if scope == 'ip':
+        return request.remote_addr
+    if scope == 'user':
+        return session.get('user_id')
+    return (request.form.get('username') or '').lower() or None  # 'username'
+
+def too_many_requests(wait):
+    if request.path.startswith('/api/'):
+        response = jsonify(error='Too many requests, please slow down')
+    else:
+        response = app.response_class('Too many requests, please slow down\n', mimetype='text/plain')
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
+def rate_limit(name):
+    """Answers 429 once a client has used up its RATE_LIMITS[name] budget
+    
+    Goes directly under @app.route so a refused request costs no database,
+    hashing or upload work. Only submissions count, not GETs of the form.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if rate_limiter is not None and request.method not in ('GET', 'HEAD'):
+                for scope, per_minute, burst in app.config['RATE_LIMITS'][name]:
+                    key = rate_limit_key(scope)
+                    if key is None:
+                        continue
+                    wait = rate_limiter.take(f'{name}:{scope}:{key}', per_minute / 60, burst)
+                    if wait:
+                        return too_many_requests(wait)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
 
 # Login decorator
 def login_required(f):
@@ -165,17 +1207,474 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Page and fragment caching
+#
+# Cache keys embed version counters ('posts', 'post:<id>', 'user:<id>',
+# 'profile:<username>', 'search'); writes bump the counters they affect after committing.
+# Anonymous feed and explore pages are only invalidated by new posts, so their
+# like and comment counts may lag by up to PAGE_CACHE_TTL seconds.
+def invalidate(*names):
+    if cache is not None:
+        cache.bump(*names)
+
+def cache_page(version_names):
+    """Caches a page for anonymous visitors; version_names(**view_args) names its versions"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # Logged-in pages are personal, and pending flash messages are rendered into the page
+            if cache is None or 'user_id' in session or session.get('_flashes'):
+                return f(*args, **kwargs)
+            
+            versions = cache.versions(version_names(**kwargs))
+            key = f"page:{request.full_path}:{':'.join(map(str, versions))}"
+            cached = cache.get(key)
+            if cached is not None:
+                body, mimetype = cached
+                return app.response_class(body, mimetype=mimetype)
+            
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                cache.set(key, (response.get_data(as_text=True), response.mimetype),
+                          app.config['PAGE_CACHE_TTL'])
+            return response
+        return decorated_function
+    return decorator
+
+def post_card(post):
+    """Renders a feed card for a PostView, reusing the cached HTML when nothing it shows changed"""
+    if cache is None:
+        return Markup(render_template('_post_card.html', post=post))
+    
+    post_version, author_version = cache.versions([f'post:{post.id}', f'user:{post.user_id}'])
+    key = ':'.join(map(str, (
+        'card', post.id, post_version, author_version, post.like_count, post.comment_count,
+        int(post.liked), len(image_pipeline.available(post.image_filename))
+    )))
+    html = cache.get(key)
+    if html is None:
+        html = render_template('_post_card.html', post=post)
+        cache.set(key, html, app.config['FRAGMENT_CACHE_TTL'])
+    return Markup(html)
+
 # Check for allowed image file extensions
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-# Create the database
+# Upload storage
+def save_upload(file):
+    """Stores an uploaded file and returns its blob name"""
+    with timed('upload'):
+        if isinstance(file.stream, UploadSink):
+            # Already on disk and hashed while the request was parsed
+            name = file.stream.save()
+        else:
+            file_ext = os.path.splitext(secure_filename(file.filename))[1]
+            name = blob_store.put(file.stream, file_ext)
+    if not image_pipeline.done(name):
+        image_pipeline.submit(name)
+    return name
+
+def blob_references():
+    """Returns {blob name: number of posts and users referencing it}"""
+    references = Counter()
+    for column in (Post.image_filename, User.profile_image):
+        references.update(dict(db.session.query(column, func.count()).group_by(column)))
+    return references
+
+def sweep_uploads(grace_seconds, dry_run=False):
+    """Deletes uploads (and their variants) that no post or user references"""
+    references = blob_references()
+    removed = []
+    for name in list(image_pipeline.originals()):
+        # Skip recent files so uploads whose row is not committed yet survive
+        if references[name] or blob_store.age(name) < grace_seconds:
+            continue
+        if not dry_run:
+            for stored in [name] + [variant_name(name, variant) for variant in VARIANTS]:
+                blob_store.delete(stored)
+            image_pipeline.ready.discard(name)
+            image_pipeline.kept.discard(name)
+        removed.append(name)
+    return removed
+
+@app.errorhandler(UnsupportedMediaType)
+def unsupported_upload(error):
+    flash('Invalid file type. Allowed types: png, jpg, jpeg, gif', 'danger')
+    return redirect(request.url)
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    flash('That file is too large. The limit is 16MB', 'danger')
+    return redirect(request.url)
+
+@app.cli.command('sweep-uploads')
+@click.option('--grace-hours', default=24.0, help='Keep unreferenced files younger than this.')
+@click.option('--dry-run', is_flag=True, help='List orphaned files without deleting them.')
+def sweep_uploads_command(grace_hours, dry_run):
+    """Garbage-collect uploaded files no longer referenced by any post or user"""
+    removed = sweep_uploads(grace_hours * 3600, dry_run)
+    for name in removed:
+        print(f"{'Would remove' if dry_run else 'Removed'} {name}")
+    print(f'{len(removed)} orphaned uploads')
+
+# Keyset pagination: a cursor is the (created_at, id) of the last post on a page,
+# or another sort time in place of created_at (inboxes sort by updated_at)
+def encode_cursor(post, at=None):
+    raw = f"{(at or post.created_at).isoformat()}|{post.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Returns (created_at, id) for a cursor, or None if it is missing or malformed"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, post_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(post_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def paginate_posts(query, cursor=None, limit=None):
+    """Returns one page of posts (newest first) and the cursor for the next page"""
+    limit = limit or app.config['FEED_PAGE_SIZE']
+    position = decode_cursor(cursor)
+    if position:
+        created_at, post_id = position
+        query = query.filter(or_(
+            Post.created_at < created_at,
+            and_(Post.created_at == created_at, Post.id < post_id)
+        ))
+    
+    # Fetch one extra row to know whether there is another page
+    posts = query.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+    return posts[:limit], next_cursor
+
+def paginate_comments(post_id, cursor=None, limit=None):
+    """Returns one page of a post's comments (newest first) and the cursor for older ones"""
+    limit = limit or app.config['COMMENT_PAGE_SIZE']
+    query = Comment.query.options(joinedload(Comment.author)).filter(Comment.post_id == post_id)
+    position = decode_cursor(cursor)
+    if position:
+        created_at, comment_id = position
+        query = query.filter(or_(
+            Comment.created_at < created_at,
+            and_(Comment.created_at == created_at, Comment.id < comment_id)
+        ))
+    comments = query.order_by(Comment.created_at.desc(), Comment.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(comments[limit - 1]) if len(comments) > limit else None
+    return comments[:limit], next_cursor
+
+def home_feed_query(user_id):
+    """Posts by the user and everyone they follow"""
+    followed_ids = follow_graph.following(user_id)
+    if len(followed_ids) > app.config['FEED_INLINE_FOLLOWS']:
+        # Too many to inline as parameters; let the database resolve them
+        followed_ids = db.session.query(Follow.followed_id).filter(Follow.follower_id == user_id)
+        return Post.query.filter(or_(Post.user_id == user_id, Post.user_id.in_(followed_ids)))
+    return Post.query.filter(Post.user_id.in_([user_id, *followed_ids]))
+
+def feed_query():
+    if 'user_id' in session:
+        # Show posts from followed users for logged-in users
+        return home_feed_query(session['user_id'])
+    # Show all posts for non-logged in users
+    return Post.query
+
+# Fan-out-on-write timelines
+if app.config['TIMELINE_BACKEND'] == 'memory':
+    timeline_store = MemoryTimelineStore(db.session)
+else:
+    timeline_store = SqlTimelineStore(db.session, TimelineEntry)
+
+def uses_timelines():
+    return app.config['FEED_MODE'] in ('write', 'hybrid')
+
+def skips_fanout(user):
+    """Whether new posts by this user are merged at read time instead of fanned out"""
+    return app.config['FEED_MODE'] == 'hybrid' and \
+        user.follower_count >= app.config['FANOUT_FOLLOWER_LIMIT']
+
+def merged_at_read(user):
+    """Whether feeds pull this user's posts at read time: new ones skip fan-out, or older ones did"""
+    return app.config['FEED_MODE'] == 'hybrid' and (user.fanout_skipped or skips_fanout(user))
+
+def pulled_authors(user_id):
+    """The followed authors whose posts a hybrid feed merges in at read time"""
+    return db.session.query(User.id) \
+        .join(Follow, Follow.followed_id == User.id) \
+        .filter(Follow.follower_id == user_id,
+                or_(User.fanout_skipped, User.follower_count >= app.config['FANOUT_FOLLOWER_LIMIT']))
+
+def fan_out_post(post, author):
+    """Pushes a new post into its author's timeline and, unless skipped, their followers'"""
+    if not uses_timelines():
+        return
+    owners = select(Follow.follower_id).where(Follow.followed_id == author.id)
+    if skips_fanout(author):
+        owners = select(User.id).where(User.id == author.id)
+        if not author.fanout_skipped:
+            User.query.filter_by(id=author.id).update({User.fanout_skipped: True}, synchronize_session=False)
+    else:
+        owners = owners.union_all(select(User.id).where(User.id == author.id))
+    timeline_store.push(owners, post.id, author.id, post.created_at)
+
+def backfill_timeline(user_id, author):
+    """Copies an author's recent posts into a new follower's timeline"""
+    if not uses_timelines() or merged_at_read(author):
+        return
+    posts = Post.query.filter_by(user_id=author.id) \
+        .order_by(Post.created_at.desc(), Post.id.desc()) \
+        .limit(app.config['TIMELINE_BACKFILL_POSTS']).all()
+    timeline_store.backfill(user_id, posts)
+
+def prune_timeline(user_id, author):
+    if uses_timelines():
+        timeline_store.prune(user_id, author.id)
+
+def load_timeline(user_id):
+    """Builds a user's timeline from the posts their feed would show"""
+    query = home_feed_query(user_id)
+    if app.config['FEED_MODE'] == 'hybrid':
+        query = query.filter(Post.user_id.notin_(pulled_authors(user_id)))
+    posts = query.order_by(Post.created_at.desc(), Post.id.desc()) \
+        .limit(app.config['TIMELINE_BACKFILL_POSTS']).all()
+    timeline_store.load(user_id, posts)
+
+def timeline_feed(user_id, cursor=None, limit=None):
+    """Reads a page of the home feed from the materialized timeline"""
+    limit = limit or app.config['FEED_PAGE_SIZE']
+    if not timeline_store.has(user_id):
+        load_timeline(user_id)  # First read since this process started
+    position = decode_cursor(cursor)
+    keys = timeline_store.page(user_id, position, limit + 1)
+    
+    if app.config['FEED_MODE'] == 'hybrid':
+        # Posts that were never fanned out are merged in here
+        merged, _ = paginate_posts(Post.query.filter(Post.user_id.in_(pulled_authors(user_id))), cursor, limit + 1)
+        keys = sorted(set(keys) | {(post.created_at, post.id) for post in merged}, reverse=True)[:limit + 1]
+    
+    posts_by_id = {post.id: post for post in Post.query.filter(Post.id.in_([post_id for _, post_id in keys]))}
+    posts = [posts_by_id[post_id] for _, post_id in keys if post_id in posts_by_id]
+    next_cursor = encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+    return posts[:limit], next_cursor
+
+def load_feed(cursor=None):
+    """Returns one page of the current visitor's feed and the next cursor"""
+    if 'user_id' in session and uses_timelines():
+        return timeline_feed(session['user_id'], cursor)
+    return paginate_posts(feed_query(), cursor)
+
+def rebuild_timelines():
+    """Repopulates every timeline from the follow graph, e.g. after enabling FEED_MODE=write"""
+    # Rebuilt timelines hold every post of authors below the limit, so only those above it stay merged at read time
+    skipped = User.follower_count >= app.config['FANOUT_FOLLOWER_LIMIT'] if app.config['FEED_MODE'] == 'hybrid' else False
+    User.query.update({User.fanout_skipped: skipped}, synchronize_session=False)
+    timeline_store.clear()
+    for (user_id,) in db.session.query(User.id).order_by(User.id):
+        load_timeline(user_id)
+        db.session.commit()
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild the materialized home timelines from scratch"""
+    rebuild_timelines()
+    print('Timelines rebuilt')
+
+# Feed hydration: load everything a page of posts needs in a fixed number of queries
+class PostView:
+    """A post plus the precomputed data its templates render"""
+    
+    def __init__(self, post, author, like_count=0, liked=False, comment_count=0, comments=None):
+        self.post = post
+        self.id = post.id
+        self.image_filename = post.image_filename
+        self.caption = post.caption
+        self.created_at = post.created_at
+        self.user_id = post.user_id
+        self.author = author
+        self.like_count = like_count
+        self.liked = liked
+        self.comment_count = comment_count
+        self.comments = comments or []
+    
+    def time_since(self):
+        return self.post.time_since()
+
+def preview_comments(post_ids, limit):
+    """Returns {post_id: [first `limit` comments]} with their authors loaded"""
+    ranked = db.session.query(
+        Comment.id.label('id'),
+        func.row_number().over(
+            partition_by=Comment.post_id,
+            order_by=(Comment.created_at, Comment.id)
+        ).label('position')
+    ).filter(Comment.post_id.in_(post_ids)).subquery()
+    
+    comments = Comment.query \
+        .options(joinedload(Comment.author)) \
+        .join(ranked, ranked.c.id == Comment.id) \
+        .filter(ranked.c.position <= limit) \
+        .order_by(Comment.created_at, Comment.id) \
+        .all()
+    
+    by_post = {}
+    for comment in comments:
+        by_post.setdefault(comment.post_id, []).append(comment)
+    return by_post
+
+def like_states(posts, viewer_id=None):
+    """Returns {post_id: (like_count, liked by the viewer)} with one query for the viewer's likes"""
+    post_ids = [post.id for post in posts]
+    liked = set()
+    pending = {}
+    if viewer_id:
+        liked = {post_id for (post_id,) in db.session.query(Like.post_id).filter(
+            Like.user_id == viewer_id,
+            Like.post_id.in_(post_ids)
+        )}
+        if like_queue is not None:
+            # The viewer's own queued likes show straight away, before they are flushed
+            pending = like_queue.pending(viewer_id, post_ids)
+    
+    states = {}
+    for post in posts:
+        was_liked = post.id in liked
+        is_liked = pending.get(post.id, was_liked)
+        states[post.id] = (post.like_count + is_liked - was_liked, is_liked)
+    return states
+
+def hydrate_posts(posts, viewer_id=None, preview_limit=None):
+    """Wraps posts in PostViews using a constant number of queries per page"""
+    if not posts:
+        return []
+    if preview_limit is None:
+        preview_limit = app.config['FEED_PREVIEW_COMMENTS']
+    post_ids = [post.id for post in posts]
+    
+    author_ids = {post.user_id for post in posts}
+    authors = {user.id: user for user in User.query.filter(User.id.in_(author_ids))}
+    
+    likes = like_states(posts, viewer_id)
+    previews = preview_comments(post_ids, preview_limit) if preview_limit else {}
+    
+    return [
+        PostView(
+            post,
+            author=authors.get(post.user_id),
+            like_count=likes[post.id][0],
+            liked=likes[post.id][1],
+            comment_count=post.comment_count,
+            comments=previews.get(post.id, [])
+        )
+        for post in posts
+    ]
+
+# Create the database, or upgrade an existing one in place (see migrations.py)
+def init_database():
+    with db.engine.begin() as connection:
+        # Locked before looking, so workers starting together create and stamp a new database once
+        migrations.lock(connection)
+        fresh = not inspect(connection).has_table('post')
+        db.metadata.create_all(connection)  # Replicas receive the schema from the primary
+        if fresh:
+            migrations.stamp(connection)
+    if not fresh:
+        migrations.upgrade(db.engine, log=app.logger.info)
+    if search_index.create():
+        app.logger.info('Building the search index')
+        search_index.rebuild()
+    db.session.commit()
+
 with app.app_context():
-    db.create_all()
+    init_database()
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations to the database"""
+    version = migrations.upgrade(db.engine)
+    print(f'Database is at schema version {version}')
+
+# Queries the feed, profile and post pages run on every request
+def hot_queries():
+    viewer_id, post_ids = 1, [1, 2, 3]
+    cursor = encode_cursor(Post(id=1, created_at=datetime.utcnow()))
+    position = decode_cursor(cursor)
+    
+    def page(query):
+        return query.filter(or_(
+            Post.created_at < position[0],
+            and_(Post.created_at == position[0], Post.id < position[1])
+        )).order_by(Post.created_at.desc(), Post.id.desc()).limit(11)
+    
+    ranked = db.session.query(
+        Comment.id.label('id'),
+        func.row_number().over(partition_by=Comment.post_id,
+                               order_by=(Comment.created_at, Comment.id)).label('position')
+    ).filter(Comment.post_id.in_(post_ids)).subquery()
+    
+    return {
+        'home feed': page(home_feed_query(viewer_id)),
+        'explore': page(Post.query),
+        'profile posts': Post.query.filter_by(user_id=viewer_id).order_by(Post.created_at.desc()),
+        'timeline page': db.session.query(TimelineEntry.post_id).filter(TimelineEntry.user_id == viewer_id)
+            .order_by(TimelineEntry.created_at.desc(), TimelineEntry.post_id.desc()).limit(11),
+        'comment previews': db.session.query(Comment).join(ranked, ranked.c.id == Comment.id)
+            .filter(ranked.c.position <= 2),
+        'trending': db.session.query(Post.id, Post.trend_score)
+            .order_by(Post.trend_score.desc(), Post.id.desc()).limit(500),
+        'post comments': Comment.query.filter(Comment.post_id == 1, or_(
+            Comment.created_at < position[0],
+            and_(Comment.created_at == position[0], Comment.id < position[1])
+        )).order_by(Comment.created_at.desc(), Comment.id.desc()).limit(21),
+        'hashtag posts': db.session.query(PostHashtag.post_id).filter(PostHashtag.hashtag_id == 1,
+                                                                      PostHashtag.post_id < 100)
+            .order_by(PostHashtag.post_id.desc()).limit(13),
+        'viewer likes': db.session.query(Like.post_id).filter(Like.user_id == viewer_id, Like.post_id.in_(post_ids)),
+        'likes of post': Like.query.filter_by(post_id=1),
+        'is following': Follow.query.filter_by(follower_id=viewer_id, followed_id=2),
+        'followers': db.session.query(Follow.follower_id).filter(Follow.followed_id == viewer_id),
+        'pending activity': db.session.query(ActivityEvent.id).filter(ActivityEvent.folded == False)
+            .order_by(ActivityEvent.id).limit(500),
+    }
+
+def explain_hot_queries():
+    """Returns {name: (plan lines, problems)} from SQLite's EXPLAIN QUERY PLAN"""
+    indexed_tables = {table.name for table in db.metadata.sorted_tables}
+    results = {}
+    for name, query in hot_queries().items():
+        sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+        # A full scan of a real table. The home feed still sorts in a temp b-tree because it
+        # merges many authors' index ranges; FEED_MODE=write avoids that merge entirely
+        problems = [
+            line for line in plan
+            if line.startswith('SCAN ') and 'USING' not in line and line.split()[1] in indexed_tables
+        ]
+        results[name] = (plan, problems)
+    return results
+
+@app.cli.command('explain-queries')
+def explain_queries_command():
+    """Check that every hot query is answered from an index"""
+    if db.engine.dialect.name != 'sqlite':
+        print('explain-queries reads SQLite query plans; use EXPLAIN in psql for other databases')
+        return
+    failed = False
+    for name, (plan, problems) in explain_hot_queries().items():
+        print(f"{'FAIL' if problems else 'ok  '} {name}")
+        for line in plan:
+            print(f'       {line}')
+        failed = failed or bool(problems)
+    if failed:
+        raise SystemExit(1)
 
 # Auth routes
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limit('register')
+@write_retry
 def register():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -206,7 +1705,10 @@ def register():
         new_user.set_password(password)
         
         db.session.add(new_user)
+        db.session.flush()
+        index_user(new_user)
         db.session.commit()
+        invalidate('search')
         
         flash('Your account has been created! You can now log in', 'success')
         return redirect(url_for('login'))
@@ -215,6 +1717,8 @@ def register():
 
 # Create a route for login 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit('login')
+@write_retry
 def login():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -223,6 +1727,7 @@ def login():
         user = User.query.filter_by(username=username).first()
         
         if user and user.check_password(password):
+            db.session.commit()  # Saves the new hash if check_password redid it
             session['user_id'] = user.id
             session['username'] = user.username
             
@@ -244,81 +1749,141 @@ def logout():
 
 # Create a route for viewing a profile 
 @app.route('/profile/<username>')
+@read_only
+@cache_page(lambda username: ['posts', f'profile:{username}'])
 def profile(username):
     user = User.query.filter_by(username=username).first_or_404()
     posts = Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).all()
+    posts = hydrate_posts(posts, session.get('user_id'), preview_limit=0)
     
     is_following = False
     if 'user_id' in session:
-        current_user = User.query.get(session['user_id'])
-        if current_user:
-            is_following = current_user.is_following(user)
-    
-    follower_count = Follow.query.filter_by(followed_id=user.id).count()
-    following_count = Follow.query.filter_by(follower_id=user.id).count()
+        is_following = follow_graph.is_following(session['user_id'], user.id)
     
     return render_template('profile.html', 
                           user=user, 
                           posts=posts, 
                           is_following=is_following,
-                          follower_count=follower_count, 
-                          following_count=following_count)
+                          follower_count=user.follower_count, 
+                          following_count=user.following_count)
 
 @app.route('/follow/<username>', methods=['POST'])
 @login_required
+@write_retry
 def follow(username):
     user_to_follow = User.query.filter_by(username=username).first_or_404()
-    current_user = User.query.get(session['user_id'])
+    current_user = get_current_user()
     
     if current_user.id == user_to_follow.id:
         flash('You cannot follow yourself', 'danger')
     else:
         current_user.follow(user_to_follow)
         db.session.commit()
+        invalidate(f'profile:{username}', f'profile:{current_user.username}')
+        invalidate_follow(current_user.id, user_to_follow.id)
         flash(f'You are now following {username}', 'success')
     
     return redirect(url_for('profile', username=username))
 
 @app.route('/unfollow/<username>', methods=['POST'])
 @login_required
+@write_retry
 def unfollow(username):
     user_to_unfollow = User.query.filter_by(username=username).first_or_404()
-    current_user = User.query.get(session['user_id'])
+    current_user = get_current_user()
     
     current_user.unfollow(user_to_unfollow)
     db.session.commit()
+    invalidate(f'profile:{username}', f'profile:{current_user.username}')
+    invalidate_follow(current_user.id, user_to_unfollow.id)
     flash(f'You have unfollowed {username}', 'info')
     
     return redirect(url_for('profile', username=username))
 
 # Updated routes
 @app.route('/')
+@read_only
+@cache_page(lambda: ['posts'])
 def index():
-    if 'user_id' in session:
-        # Show posts from followed users for logged-in users
-        current_user = User.query.get(session['user_id'])
-        followed_users = [follow.followed_id for follow in current_user.followed.all()]
-        followed_users.append(current_user.id)  # Include user's own posts
-        
-        posts = Post.query.filter(Post.user_id.in_(followed_users)).order_by(Post.created_at.desc()).all()
-    else:
-        # Show all posts for non-logged in users
-        posts = Post.query.order_by(Post.created_at.desc()).all()
-    
-    return render_template('index.html', posts=posts)
+    posts, next_cursor = load_feed(request.args.get('cursor'))
+    posts = hydrate_posts(posts, session.get('user_id'))
+    suggestions = suggested_users(session['user_id']) if 'user_id' in session else []
+    return render_template('index.html', posts=posts, next_cursor=next_cursor, suggestions=suggestions)
+
+@app.route('/feed/page')
+@read_only
+@cache_page(lambda: ['posts'])
+def feed_page():
+    """Next page of the feed as an HTML fragment, used by infinite scroll"""
+    posts, next_cursor = load_feed(request.args.get('cursor'))
+    posts = hydrate_posts(posts, session.get('user_id'))
+    return render_template('_feed_page.html', posts=posts, next_cursor=next_cursor)
 
 @app.route('/explore')
+@read_only
+@cache_page(lambda: ['posts'])
 def explore():
-    posts = Post.query.order_by(Post.created_at.desc()).all()
-    return render_template('explore.html', posts=posts)
+    sort = request.args.get('sort')
+    if sort == 'trending':
+        # Ranked pages are positions in the top list, which moves too much for keyset cursors
+        offset = request.args.get('cursor', 0, type=int)
+        posts, next_cursor = trending_page(max(offset, 0))
+    else:
+        posts, next_cursor = paginate_posts(Post.query, request.args.get('cursor'))
+    posts = hydrate_posts(posts, session.get('user_id'), preview_limit=0)
+    return render_template('explore.html', posts=posts, next_cursor=next_cursor, sort=sort)
 
 @app.route('/post/<int:post_id>')
+@read_only
+@cache_page(lambda post_id: ['posts', f'post:{post_id}'])
 def post_detail(post_id):
     post = Post.query.get_or_404(post_id)
-    return render_template('post_detail.html', post=post)
+    # Only the newest page of comments; older ones load on demand from post_comments
+    comments, next_cursor = paginate_comments(post.id, request.args.get('cursor'))
+    post = hydrate_posts([post], session.get('user_id'), preview_limit=0)[0]
+    return render_template('post_detail.html', post=post, comments=comments[::-1], next_cursor=next_cursor)
+
+@app.route('/post/<int:post_id>/comments')
+@read_only
+@cache_page(lambda post_id: ['posts', f'post:{post_id}'])
+def post_comments(post_id):
+    """Comments older than the cursor as an HTML fragment, for the "Load older comments" link"""
+    post = Post.query.get_or_404(post_id)
+    comments, next_cursor = paginate_comments(post.id, request.args.get('cursor'))
+    return render_template('_comments_page.html', post=post, comments=comments[::-1], next_cursor=next_cursor)
+
+@app.route('/search')
+@read_only
+@cache_page(lambda: ['posts', 'search'])
+def search():
+    query = request.args.get('q', '').strip()
+    if HASHTAG.fullmatch(query):
+        return redirect(url_for('hashtag', name=query[1:].lower()))
+    
+    offset = max(request.args.get('cursor', 0, type=int), 0)
+    posts, next_cursor = search_posts(query, offset)
+    posts = hydrate_posts(posts, session.get('user_id'), preview_limit=0)
+    users, tags = [], []
+    if offset == 0:
+        users = users_by_id(search_index.users(query, limit=app.config['FOLLOW_SUGGESTIONS']))
+        tags = Hashtag.query.filter(Hashtag.name.in_(query_terms(query))).order_by(Hashtag.post_count.desc()).all()
+    return render_template('search.html', query=query, posts=posts, users=users, tags=tags,
+                           next_cursor=next_cursor)
+
+@app.route('/tags/<name>')
+@read_only
+@cache_page(lambda name: ['posts'])
+def hashtag(name):
+    tag = Hashtag.query.filter_by(name=name.lower()).first_or_404()
+    posts, next_cursor = hashtag_posts(tag, request.args.get('cursor', type=int))
+    posts = hydrate_posts(posts, session.get('user_id'), preview_limit=0)
+    return render_template('search.html', query=f'#{tag.name}', tag=tag, posts=posts, users=[], tags=[],
+                           next_cursor=next_cursor)
 
 @app.route('/create', methods=['GET', 'POST'])
+@rate_limit('create')
 @login_required
+@write_retry
 def create_post():
     if request.method == 'POST':
         # Check if image file exists in the request
@@ -335,14 +1900,8 @@ def create_post():
             
         # Process file if it exists and has allowed extension
         if file and allowed_file(file.filename):
-            # Create unique filename to avoid collisions
-            filename = secure_filename(file.filename)
-            file_ext = os.path.splitext(filename)[1]
-            unique_filename = f"{uuid.uuid4().hex}{file_ext}"
-            
-            # Save the file
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(file_path)
+            # Save the file under its content hash; a duplicate upload reuses the stored blob
+            unique_filename = save_upload(file)
             
             # Get caption from form
             caption = request.form.get('caption', '')
@@ -355,7 +1914,14 @@ def create_post():
             )
             
             db.session.add(new_post)
+            bump_counters(User, session['user_id'], post_count=1)
+            db.session.flush()
+            index_post(new_post)
+            author = get_current_user()
+            fan_out_post(new_post, author)
             db.session.commit()
+            trending.offer(new_post.id, new_post.trend_score)
+            invalidate('posts', f'profile:{author.username}')
             
             flash('Your post has been created!', 'success')
             return redirect(url_for('post_detail', post_id=new_post.id))
@@ -366,23 +1932,12 @@ def create_post():
     return render_template('create.html')
 
 @app.route('/like/<int:post_id>', methods=['POST'])
+@rate_limit('like')
 @login_required
+@write_retry
 def like_post(post_id):
     post = Post.query.get_or_404(post_id)
-    current_user = User.query.get(session['user_id'])
-    
-    # Check if user already liked the post
-    existing_like = Like.query.filter_by(user_id=current_user.id, post_id=post.id).first()
-    
-    if existing_like:
-        # Unlike
-        db.session.delete(existing_like)
-        db.session.commit()
-    else:
-        # Like
-        new_like = Like(user_id=current_user.id, post_id=post.id)
-        db.session.add(new_like)
-        db.session.commit()
+    toggle_like(session['user_id'], post)
     
     # Redirect back to referring page (either index or post_detail)
     next_page = request.referrer
@@ -391,27 +1946,35 @@ def like_post(post_id):
     return redirect(next_page)
 
 @app.route('/comment/<int:post_id>', methods=['POST'])
+@rate_limit('comment')
 @login_required
+@write_retry
 def add_comment(post_id):
     post = Post.query.get_or_404(post_id)
-    comment_content = request.form.get('content', '')
-    
-    if comment_content.strip():
-        comment = Comment(
-            content=comment_content,
-            post_id=post.id,
-            user_id=session['user_id']
-        )
-        db.session.add(comment)
-        db.session.commit()
+    create_comment(post, session['user_id'], request.form.get('content', ''))
     
     # Redirect back to post detail
     return redirect(url_for('post_detail', post_id=post_id))
 
+@app.route('/notifications')
+@login_required
+@write_retry
+def notifications():
+    current_user = get_current_user()
+    read_at = current_user.notifications_read_at
+    cursor = request.args.get('cursor')
+    
+    # Opening the inbox reads everything in it; later pages just show what was unread
+    if not cursor and current_user.unread_notifications:
+        mark_notifications_read(current_user.id)
+    page, next_cursor = paginate_notifications(current_user.id, cursor)
+    return render_template('notifications.html', notifications=page, next_cursor=next_cursor, read_at=read_at)
+
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
+@write_retry
 def edit_profile():
-    user = User.query.get(session['user_id'])
+    user = get_current_user()
     
     if request.method == 'POST':
         # Update bio
@@ -424,48 +1987,342 @@ def edit_profile():
             
             if file.filename != '':
                 if file and allowed_file(file.filename):
-                    # Create unique filename
-                    filename = secure_filename(file.filename)
-                    file_ext = os.path.splitext(filename)[1]
-                    unique_filename = f"profile_{uuid.uuid4().hex}{file_ext}"
-                    
-                    # Save the file
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'profiles', unique_filename)
-                    file.save(file_path)
-                    
-                    # Update user profile image
-                    user.profile_image = f'profiles/{unique_filename}'
+                    # Save the file and update user profile image
+                    user.profile_image = save_upload(file)
                 else:
                     flash('Invalid file type. Allowed types: png, jpg, jpeg, gif', 'danger')
                     return redirect(url_for('edit_profile'))
         
+        index_user(user)
         db.session.commit()
+        forget_identity(user.id)
+        invalidate(f'user:{user.id}', f'profile:{user.username}', 'search')
         flash('Your profile has been updated', 'success')
         return redirect(url_for('profile', username=user.username))
     
     return render_template('edit_profile.html', user=user)
 
+@app.route('/media/<path:filename>')
+def media(filename):
+    """Serves an upload with headers for content that never changes
+    
+    Every upload name is a fingerprint of its bytes (a content hash, or a
+    one-off uuid for older uploads) and is never rewritten, so browsers and
+    proxies may cache it for a year without revalidating.
+    """
+    # The name's stem is unique per content, so it makes a strong ETag without a stat call
+    etag = os.path.splitext(os.path.basename(filename))[0]
+    
+    if app.config['MEDIA_ACCEL'] == 'nginx':
+        # The proxy trusts the header blindly, so check the name the way
+        # send_from_directory would before handing it over
+        path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        
+        # The proxy streams the file and handles Range/If-None-Match itself
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = app.config['MEDIA_ACCEL_PREFIX'] + filename
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response.set_etag(etag)
+    else:
+        # conditional=True answers If-None-Match with 304 and Range with 206
+        response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True,
+                                       etag=etag, max_age=app.config['MEDIA_MAX_AGE'])
+    
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['MEDIA_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+# JSON API
+#
+# The same data as the HTML pages, for the progressive-enhancement scripts and
+# other clients. It uses the session cookie for auth and answers with JSON
+# errors instead of redirects.
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return jsonify(error='Please log in to access this page'), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+def user_json(user, following=None):
+    has_image = user.profile_image and user.profile_image != 'default.jpg'
+    data = {
+        'username': user.username,
+        'profile_url': url_for('profile', username=user.username),
+        'profile_image_url': file_url(user.profile_image, 'thumb') if has_image else None,
+    }
+    if following is not None:
+        data['following'] = user.id in following
+    return data
+
+def comment_json(comment):
+    return {
+        'id': comment.id,
+        'content': comment.content,
+        'created_at': comment.created_at.isoformat(),
+        'time_since': comment.time_since(),
+        'author': user_json(comment.author),
+    }
+
+def post_json(view, following=None):
+    return {
+        'id': view.id,
+        'url': url_for('post_detail', post_id=view.id),
+        'image_url': file_url(view.image_filename, 'feed'),
+        'thumb_url': file_url(view.image_filename, 'thumb'),
+        'srcset': srcset(view.image_filename),
+        'caption': view.caption,
+        'created_at': view.created_at.isoformat(),
+        'time_since': view.time_since(),
+        'author': user_json(view.author, following),
+        'like_count': view.like_count,
+        'liked': view.liked,
+        'comment_count': view.comment_count,
+        'comments': [comment_json(comment) for comment in view.comments],
+    }
+
+def posts_page_json(posts, next_cursor, preview_limit=None):
+    viewer_id = session.get('user_id')
+    views = hydrate_posts(posts, viewer_id, preview_limit)
+    # Whether the viewer follows each author, from one cached list
+    following = follow_graph.following_among(viewer_id, {view.user_id for view in views}) if viewer_id else None
+    return jsonify(posts=[post_json(view, following) for view in views], next_cursor=next_cursor)
+
+@app.route('/api/feed')
+@read_only
+def api_feed():
+    posts, next_cursor = load_feed(request.args.get('cursor'))
+    return posts_page_json(posts, next_cursor)
+
+@app.route('/api/explore')
+@read_only
+def api_explore():
+    if request.args.get('sort') == 'trending':
+        posts, next_cursor = trending_page(max(request.args.get('cursor', 0, type=int), 0))
+    else:
+        posts, next_cursor = paginate_posts(Post.query, request.args.get('cursor'))
+    return posts_page_json(posts, next_cursor, preview_limit=0)
+
+@app.route('/api/users/<username>/posts')
+@read_only
+def api_user_posts(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    posts, next_cursor = paginate_posts(Post.query.filter_by(user_id=user.id), request.args.get('cursor'))
+    return posts_page_json(posts, next_cursor, preview_limit=0)
+
+@app.route('/api/posts/<int:post_id>/like', methods=['POST'])
+@rate_limit('like')
+@api_login_required
+@write_retry
+def api_like(post_id):
+    """Toggles the viewer's like and returns the post's new like state"""
+    post = Post.query.get_or_404(post_id)
+    toggle_like(session['user_id'], post)
+    like_count, liked = like_states([post], session['user_id'])[post.id]
+    return jsonify(id=post.id, like_count=like_count, liked=liked)
+
+@app.route('/api/likes')
+@read_only
+def api_likes():
+    """Like counts and viewer-liked flags for up to API_MAX_BATCH posts: /api/likes?ids=1,2,3"""
+    try:
+        post_ids = {int(value) for value in request.args.get('ids', '').split(',') if value}
+    except ValueError:
+        return jsonify(error='ids must be a comma-separated list of post ids'), 400
+    if len(post_ids) > app.config['API_MAX_BATCH']:
+        return jsonify(error=f"At most {app.config['API_MAX_BATCH']} ids per request"), 400
+    
+    posts = Post.query.filter(Post.id.in_(post_ids)).all() if post_ids else []
+    states = like_states(posts, session.get('user_id'))
+    return jsonify(posts={
+        str(post_id): {'like_count': like_count, 'liked': liked}
+        for post_id, (like_count, liked) in states.items()
+    })
+
+@app.route('/api/posts/<int:post_id>/comments')
+@read_only
+def api_comments(post_id):
+    """A post's comments, newest first; follow next_cursor for older ones"""
+    post = Post.query.get_or_404(post_id)
+    comments, next_cursor = paginate_comments(post.id, request.args.get('cursor'))
+    return jsonify(comments=[comment_json(comment) for comment in comments], next_cursor=next_cursor)
+
+@app.route('/api/posts/<int:post_id>/comments', methods=['POST'])
+@rate_limit('comment')
+@api_login_required
+@write_retry
+def api_add_comment(post_id):
+    post = Post.query.get_or_404(post_id)
+    data = request.get_json(silent=True) or request.form
+    content = data.get('content', '') if isinstance(data, dict) else None
+    if not isinstance(content, str):
+        return jsonify(error='content must be a string'), 400
+    comment = create_comment(post, session['user_id'], content)
+    if comment is None:
+        return jsonify(error='Comment cannot be empty'), 400
+    return jsonify(comment=comment_json(comment), comment_count=post.comment_count), 201
+
+def notification_json(notification, read_at=None):
+    post = notification.post
+    return {
+        'id': notification.id,
+        'kind': notification.kind,
+        'text': notification.describe(),
+        'actor': user_json(notification.actor),
+        'actor_count': notification.actor_count,
+        'post': {
+            'id': post.id,
+            'url': url_for('post_detail', post_id=post.id),
+            'thumb_url': file_url(post.image_filename, 'thumb'),
+        } if post is not None else None,
+        'updated_at': notification.updated_at.isoformat(),
+        'time_since': notification.time_since(),
+        'unread': read_at is None or notification.updated_at > read_at,
+    }
+
+@app.route('/api/notifications')
+@api_login_required
+@read_only
+def api_notifications():
+    """A page of the viewer's inbox and their unread count; reading it does not mark anything read"""
+    user = db.session.get(User, session['user_id'])
+    page, next_cursor = paginate_notifications(user.id, request.args.get('cursor'))
+    return jsonify(notifications=[notification_json(notification, user.notifications_read_at) for notification in page],
+                   unread_count=user.unread_notifications, next_cursor=next_cursor)
+
+@app.route('/api/notifications/read', methods=['POST'])
+@api_login_required
+@write_retry
+def api_mark_notifications_read():
+    mark_notifications_read(session['user_id'])
+    return jsonify(unread_count=0)
+
+@app.route('/api/live')
+def api_live():
+    """Server-sent events with like counts and new comments: /api/live?posts=1,2,3
+    
+    Each stream holds a request thread, hence LIVE_MAX_STREAMS; asgi.py and `flask live-server` scale further.
+    """
+    if live_updates is None or not app.config['LIVE_MAX_STREAMS']:
+        return jsonify(error='Live updates are turned off'), 404
+    try:
+        post_ids = parse_post_ids(request.args.get('posts', ''), app.config['LIVE_MAX_POSTS'])
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    if len(live_updates) >= app.config['LIVE_MAX_STREAMS']:
+        response = jsonify(error='Too many live streams; try again later')
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['LIVE_KEEPALIVE'])
+        return response
+    snapshot = like_count_events(db.session.execute(LIKE_COUNTS, {'post_ids': list(post_ids)}))
+    return app.response_class(thread_stream(live_updates, post_ids, app.config['LIVE_KEEPALIVE'], snapshot=snapshot),
+                              mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.cli.command('live-server')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8081, type=int)
+@click.option('--max-streams', default=10000, type=int, help='open streams before new ones get 503s')
+@click.option('--allow-origin', default=None, help='Access-Control-Allow-Origin, when pages come from another origin')
+def live_server_command(host, port, max_streams, allow_origin):
+    """Serve /api/live streams from an event loop, fed by the web workers through LIVE_BROKER=sqlite"""
+    if app.config['LIVE_BROKER'] != 'sqlite':
+        raise click.UsageError('Set LIVE_BROKER=sqlite here and in the web workers so their events reach this server')
+    reader = make_async_reader()
+    
+    async def snapshot(post_ids):
+        return like_count_events(await reader.fetch_all(LIKE_COUNTS, {'post_ids': list(post_ids)}))
+    
+    print(f'Serving live updates on http://{host}:{port}/api/live (database reads: {reader.mode})')
+    LiveServer(live_updates, max_posts=app.config['LIVE_MAX_POSTS'], max_streams=max_streams,
+               keepalive=app.config['LIVE_KEEPALIVE'], allow_origin=allow_origin, snapshot=snapshot).run(host, port)
+
+def make_async_reader():
+    """An AsyncReader for coroutines, on the first replica if there is one"""
+    with app.app_context():
+        replicas = [engine for key, engine in sorted(db.engines.items(), key=lambda item: str(item[0]))
+                    if is_replica(key)]
+        engine = replicas[0] if replicas else db.engine
+    return AsyncReader(engine, PROFILES[app.config['DB_PROFILE']]['pragmas'], app.config['ASYNC_READ_THREADS'])
+
+@app.route('/api/search/users')
+@read_only
+def api_complete_usernames():
+    """Username autocomplete: users whose name starts with ?q=, most followed first"""
+    user_ids = search_index.complete_username(request.args.get('q', ''), app.config['AUTOCOMPLETE_LIMIT'])
+    return jsonify(users=[user_json(user) for user in users_by_id(user_ids)])
+
+@app.route('/api/search')
+@read_only
+def api_search():
+    """Posts matching ?q=, best first; follow next_cursor for more"""
+    posts, next_cursor = search_posts(request.args.get('q', ''), max(request.args.get('cursor', 0, type=int), 0))
+    return posts_page_json(posts, next_cursor, preview_limit=0)
+
 @app.template_filter('file_url')
-def file_url(filename):
-    """Template filter to generate URL for uploaded files"""
-    return url_for('static', filename=f'uploads/{filename}')
+def file_url(filename, variant=None):
+    """Template filter to generate URL for uploaded files, or one of their resized variants"""
+    if variant:
+        filename = image_pipeline.available(filename).get(variant, filename)
+    return url_for('media', filename=filename)
 
-@app.template_filter('like_count')
-def like_count(post):
-    """Template filter to count likes for a post"""
-    return Like.query.filter_by(post_id=post.id).count()
+@app.template_filter('srcset')
+def srcset(filename):
+    """Template filter listing the resized variants of an upload for an <img srcset>"""
+    available = image_pipeline.available(filename)
+    return ', '.join(
+        f"{url_for('media', filename=name)} {VARIANTS[variant][0]}w"
+        for variant, name in available.items() if not VARIANTS[variant][1]
+    )
+
+@app.cli.command('process-images')
+def process_images_command():
+    """Generate resized variants for uploads that do not have them yet"""
+    done, failed = image_pipeline.backfill()
+    for name, error in failed:
+        print(f'Skipped {name}: {error}')
+    print(f'Processed {done} images')
+
+@app.cli.command('strip-metadata')
+def strip_metadata_command():
+    """Strip EXIF/GPS and other metadata from originals uploaded before it was stripped on upload"""
+    stripped, failed = 0, 0
+    for name in image_pipeline.originals():
+        try:
+            blob_store.rewrite_file(blob_store.path(name))
+            stripped += 1
+        except (OSError, UnsupportedMediaType):
+            print(f'Skipped {name}: not an image we can read')
+            failed += 1
+    print(f'Stripped {stripped} originals, skipped {failed}')
+
+@app.template_filter('hashtags')
+def link_hashtags(caption):
+    """Template filter that escapes a caption and links its #hashtags to their pages"""
+    caption = caption or ''
+    parts, position = [], 0
+    for match in HASHTAG.finditer(caption):
+        parts.append(escape(caption[position:match.start()]))
+        parts.append(Markup('<a href="{}">#{}</a>').format(url_for('hashtag', name=match.group(1).lower()),
+                                                           match.group(1)))
+        position = match.end()
+    parts.append(escape(caption[position:]))
+    return Markup('').join(parts)
 
 @app.context_processor
 def utility_processor():
-    def is_liked_by_user(post, user_id):
-        """Check if a post is liked by the current user"""
-        return Like.query.filter_by(post_id=post.id, user_id=user_id).count() > 0
-    
-    def get_user(user_id):
-        """Get user by ID"""
-        return User.query.get(user_id)
+    live_url = None
+    if live_updates is not None:
+        if app.config['LIVE_URL']:
+            live_url = app.config['LIVE_URL']
+        elif app.config['LIVE_ON_LOOP'] or app.config['LIVE_MAX_STREAMS']:
+            live_url = url_for('api_live')
     
-    return dict(is_liked_by_user=is_liked_by_user, get_user=get_user)
+    return dict(current_user=get_current_user, post_card=post_card, live_url=live_url)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
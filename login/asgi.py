@@ -0,0 +1,329 @@
+"""ASGI entry point: the Flask app behind an event loop.
+
+    pip install -r requirements-asgi.txt
+    python serve.py --mode asgi --workers 4 --threads 32
+
+Under WSGI a request holds a thread from its first byte to its last: while a
+slow client sends an upload, and for /api/live as long as the page stays
+open. Here the event loop does the waiting and threads only run Flask code:
+
+- Request bodies are received on the loop into a buffer that spills to a
+  temporary file past ASGI_SPOOL_BYTES, and a request only gets a thread once
+  its whole body is in. A body declared larger than MAX_CONTENT_LENGTH is not
+  read at all; Flask refuses it as it does under WSGI. Files in multipart
+  bodies have their first bytes checked as they arrive, and a request with
+  one that is not an allowed image goes to Flask at once with what has
+  arrived, which is enough for it to refuse the upload as under WSGI.
+- Views run on ASGI_THREADS threads per worker, with their blocking
+  SQLAlchemy calls as before. Upload hashing and storage read the spooled
+  body at local-disk speed, and resizing is handed to the image pipeline's
+  own threads as it already was.
+- /api/live streams are served on the loop straight from the live hub, so an
+  open page costs no thread.
+- Anonymous /api/likes, which pages poll for counts, and the snapshot that
+  starts each live stream are read on the loop through an AsyncReader.
+
+Every other request, including any /api/likes with a session cookie, goes
+through the thread pool and behaves exactly as under WSGI.
+"""
+import asyncio
+import json
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, File, MultipartDecoder, NeedData
+
+from app import LIKE_COUNTS, app, inspect_upload, like_count_events, live_updates, make_async_reader
+from live import KEEPALIVE, next_event, parse_post_ids, subscribe_async
+from storage import SNIFF_BYTES
+
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_all(send, messages):
+    for message in messages:
+        await send(message)
+
+
+class UploadCheck:
+    """Follows a multipart body as it arrives and inspects the first bytes of each file in it"""
+
+    def __init__(self, boundary, inspect, sniff_bytes=SNIFF_BYTES):
+        self.decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self.inspect = inspect  # head bytes -> raises to reject, as for UploadSink
+        self.sniff_bytes = sniff_bytes
+        self.head = None  # first bytes of the current file, until inspected
+
+    @classmethod
+    def for_request(cls, scope, inspect):
+        mimetype, options = parse_options_header(header(scope, b'content-type') or '')
+        if mimetype != 'multipart/form-data' or not options.get('boundary'):
+            return None
+        return cls(options['boundary'], inspect)
+
+    def accepts(self, chunk, more=True):
+        """Feeds the next chunk of the body; False if it completes the head of a file that is rejected"""
+        if self.decoder is None:
+            return True
+        self.decoder.receive_data(chunk)
+        if not more:
+            self.decoder.receive_data(None)
+        try:
+            return self.check_events()
+        except ValueError:
+            self.decoder = None  # Malformed; left to Flask's parser to refuse
+            return True
+
+    def check_events(self):
+        event = self.decoder.next_event()
+        while not isinstance(event, NeedData):
+            if isinstance(event, File):
+                self.head = b''
+            elif isinstance(event, Data) and self.head is not None:
+                self.head += event.data[:self.sniff_bytes - len(self.head)]
+                if len(self.head) >= self.sniff_bytes or not event.more_data:
+                    try:
+                        self.inspect(self.head)
+                    except Exception:
+                        return False
+                    self.head = None
+            event = self.decoder.next_event()
+        return True
+
+
+class WsgiBridge:
+    """Runs a WSGI app on a thread pool once each request's body has arrived"""
+
+    def __init__(self, wsgi_app, threads=32, spool_bytes=1024 * 1024, max_body=None, inspect=None):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.spool_bytes = spool_bytes
+        self.max_body = max_body
+        self.inspect = inspect  # checks the head of each uploaded file, see UploadCheck
+
+    async def __call__(self, scope, receive, send):
+        declared = header(scope, b'content-length')
+        declared = int(declared) if declared and declared.isdigit() else None
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        check = UploadCheck.for_request(scope, self.inspect) if self.inspect else None
+        try:
+            size = 0
+            # Leave an oversized body unread: Flask answers from Content-Length alone
+            more = self.max_body is None or declared is None or declared <= self.max_body
+            complete = True
+            while more:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if self.max_body is not None and size > self.max_body:
+                    await send_json(send, 413, {'error': 'Request body too large'})
+                    return
+                body.write(chunk)
+                more = message.get('more_body', False)
+                if check is not None and not check.accepts(chunk, more):
+                    # Flask rejects the file from the same first bytes; the rest is never read
+                    complete = more = False
+            body.seek(0)
+            environ = self.environ(scope, body, declared if declared is not None and complete else size)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.run, environ, send, loop)
+        finally:
+            body.close()
+
+    def environ(self, scope, body, content_length):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        root_path = scope.get('root_path', '')
+        path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+            'PATH_INFO': path.encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(content_length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.input_terminated': True,  # The whole body is in, or none of it will be
+        }
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-length':
+                continue
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+                continue
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def run(self, environ, send, loop):
+        """Calls the WSGI app on a pool thread and sends its response through the loop"""
+        def call(*messages):
+            asyncio.run_coroutine_threadsafe(send_all(send, messages), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            }
+
+        def send_body(body, more):
+            messages = [] if response.get('sent') else [response['start']]
+            response['sent'] = True
+            call(*messages, {'type': 'http.response.body', 'body': body, 'more_body': more})
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            # Each chunk waits for the next, so most responses reach the loop in a single trip
+            held = None
+            for chunk in result:
+                if chunk:
+                    if held is not None:
+                        send_body(held, True)
+                    held = chunk
+            send_body(held or b'', False)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class Application:
+    """Routes the few endpoints served on the loop; hands everything else to the bridge"""
+
+    def __init__(self, flask_app, live, reader):
+        self.config = flask_app.config
+        self.live = live
+        if live is not None:
+            # Streams cost no thread here, so pages may open them
+            self.config['LIVE_ON_LOOP'] = True
+        self.reader = reader
+        self.streams = 0
+        self.bridge = WsgiBridge(flask_app, self.config['ASGI_THREADS'], self.config['ASGI_SPOOL_BYTES'],
+                                 self.config['MAX_CONTENT_LENGTH'], inspect_upload)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'websocket':
+            await send({'type': 'websocket.close'})
+        elif scope['method'] == 'GET' and scope['path'] == '/api/live' and self.live is not None:
+            await self.live_stream(scope, receive, send)
+        elif scope['method'] == 'GET' and scope['path'] == '/api/likes' and not self.has_session(scope):
+            await self.like_counts(scope, send)
+        else:
+            await self.bridge(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.bridge.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def has_session(self, scope):
+        cookies = header(scope, b'cookie')
+        if not cookies:
+            return False
+        try:
+            return self.config['SESSION_COOKIE_NAME'] in SimpleCookie(cookies)
+        except CookieError:
+            return True  # Let Flask make sense of it
+
+    async def like_counts(self, scope, send):
+        """Anonymous /api/likes: the same answer as the Flask view, read without a thread"""
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        try:
+            post_ids = {int(value) for value in query.get('ids', [''])[0].split(',') if value}
+        except ValueError:
+            await send_json(send, 400, {'error': 'ids must be a comma-separated list of post ids'})
+            return
+        if len(post_ids) > self.config['API_MAX_BATCH']:
+            await send_json(send, 400, {'error': f"At most {self.config['API_MAX_BATCH']} ids per request"})
+            return
+        rows = await self.reader.fetch_all(LIKE_COUNTS, {'post_ids': list(post_ids)}) if post_ids else []
+        await send_json(send, 200, {'posts': {
+            str(post_id): {'like_count': like_count, 'liked': False} for post_id, like_count in rows
+        }})
+
+    async def live_stream(self, scope, receive, send):
+        try:
+            post_ids = parse_post_ids(parse_qs(scope['query_string'].decode('latin-1')).get('posts', [''])[0],
+                                      self.config['LIVE_MAX_POSTS'])
+        except ValueError as error:
+            await send_json(send, 400, {'error': str(error)})
+            return
+        if self.streams >= self.config['ASGI_MAX_STREAMS']:
+            await send_json(send, 503, {'error': 'Too many live streams; try again later'},
+                            [(b'retry-after', str(self.config['LIVE_KEEPALIVE']).encode())])
+            return
+
+        self.streams += 1
+        subscription, events = subscribe_async(self.live, post_ids)
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            snapshot = like_count_events(await self.reader.fetch_all(LIKE_COUNTS, {'post_ids': list(post_ids)}))
+            await send({'type': 'http.response.body', 'body': (KEEPALIVE + ''.join(snapshot)).encode(),
+                        'more_body': True})
+            while True:
+                text = await next_event(events, self.config['LIVE_KEEPALIVE'], disconnected)
+                if text is None:
+                    break
+                await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})  # Fell behind; the browser reconnects
+        except OSError:
+            pass  # The client went away mid-write
+        finally:
+            self.streams -= 1
+            self.live.unsubscribe(subscription)
+            disconnected.cancel()
+
+    @staticmethod
+    async def wait_for_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+application = Application(app, live_updates, make_async_reader())
@@ -0,0 +1,125 @@
+"""Concurrency benchmark for the database profiles.
+
+Runs a mix of page reads and like toggles from many threads against a copy of
+instance/photogram.db, once per profile, and prints throughput, latency and
+error counts side by side:
+
+    python bench_db.py --threads 16 --seconds 10 --write-ratio 0.3
+
+Each profile runs in its own process because the profile is read from the
+environment when app.py is imported. Caching is turned off so every request
+reaches the database, and rate limiting so no request is refused.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROFILES = [
+    ('development', {'DB_PROFILE': 'development'}),
+    ('production', {'DB_PROFILE': 'production'}),
+    ('production + read pool', {'DB_PROFILE': 'production', 'DB_READ_ONLY_POOL': '1'}),
+    ('production + queued likes', {'DB_PROFILE': 'production', 'LIKE_WRITE_BEHIND': '1'}),
+]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_worker(args):
+    """Body of one benchmark process; prints its results as JSON"""
+    from app import app, User, Post
+
+    with app.app_context():
+        user_ids = [user.id for user in User.query.all()]
+        post_ids = [post.id for post in Post.query.all()]
+    if not user_ids or not post_ids:
+        raise SystemExit('Seed the database first: python db_seed_script.py')
+
+    latencies = {'read': [], 'write': []}
+    errors = {'read': 0, 'write': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def client_loop(seed):
+        # Threads sharing a user toggle disjoint posts, so two requests never race on one like
+        rng = random.Random(seed)
+        user_id = user_ids[seed % len(user_ids)]
+        sharing = -(-args.threads // len(user_ids))
+        own_posts = post_ids[seed // len(user_ids) % sharing::sharing] or post_ids
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+        while time.perf_counter() < deadline:
+            post_id = rng.choice(own_posts)
+            kind = 'write' if rng.random() < args.write_ratio else 'read'
+            started = time.perf_counter()
+            if kind == 'write':
+                response = client.post(f'/like/{post_id}')
+                ok = response.status_code == 302
+            else:
+                response = client.get(rng.choice(['/', f'/post/{post_id}', '/explore']))
+                ok = response.status_code == 200
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[kind].append(elapsed)
+                if not ok:
+                    errors[kind] += 1
+
+    app.logger.disabled = True  # Failed requests log full tracebacks
+    threads = [threading.Thread(target=client_loop, args=(seed,)) for seed in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({'latencies': latencies, 'errors': errors}))
+
+
+def run_profile(name, env, args, source):
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'photogram.db')
+        shutil.copy(source, database)
+        process_env = dict(os.environ, CACHE_BACKEND='', RATE_LIMIT_BACKEND='',
+                           DATABASE_URL=f'sqlite:///{database}',
+                           LIKE_QUEUE_PATH=os.path.join(directory, 'like_queue.db'), **env)
+        output = subprocess.run(
+            [sys.executable, __file__, '--worker', '--threads', str(args.threads),
+             '--seconds', str(args.seconds), '--write-ratio', str(args.write_ratio)],
+            env=process_env, capture_output=True, text=True, check=True
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def report(name, result, seconds):
+    reads, writes = result['latencies']['read'], result['latencies']['write']
+    total = len(reads) + len(writes)
+    print(f"{name:<24} {total / seconds:>8.1f} req/s  "
+          f"read p50 {percentile(reads, 0.5) * 1000:>6.1f}ms p99 {percentile(reads, 0.99) * 1000:>7.1f}ms  "
+          f"write p50 {percentile(writes, 0.5) * 1000:>6.1f}ms p99 {percentile(writes, 0.99) * 1000:>7.1f}ms  "
+          f"errors {result['errors']['read']}r/{result['errors']['write']}w")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.3)
+    parser.add_argument('--database', default=os.path.join('instance', 'photogram.db'))
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+    else:
+        for name, env in PROFILES:
+            report(name, run_profile(name, env, args, args.database), args.seconds)
@@ -0,0 +1,261 @@
+"""Serving benchmark: serve.py's asgi and threaded modes under many connections.
+
+Starts `serve.py --mode <mode>` for each mode against a copy of --database,
+then holds --connections keep-alive connections open against it, each sending
+its next request as soon as the last one is answered, and prints throughput
+and p50/p99 latency side by side:
+
+    python bench_serving.py --connections 256 --seconds 20
+    python bench_serving.py --connections 512 --idle-streams 1000 --workers 4
+
+Requests are a fixed mix of pages and anonymous /api/likes polls;
+--logged-in of the connections carry the session of a seeded user, logged in
+through the server itself with --password. --idle-streams opens that many
+/api/live streams before the load starts and keeps them open throughout, as
+pages left open in browser tabs would, and reports how many were accepted.
+
+The load comes from one asyncio process, which keeps well ahead of either
+server on one machine. Caching and rate limiting are off in the servers so
+every request reaches the app.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from bench_db import percentile
+from loadtest import sample_ids
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MIX = {'index': 30, 'explore': 15, 'profile': 15, 'post': 20, 'likes': 20}
+
+
+class Connection:
+    """One keep-alive HTTP/1.1 connection; reconnects when the server closes it"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, cookie=None, body=b'', content_type=None):
+        """Returns (status, headers, body)"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', f'Content-Length: {len(body)}']
+        if cookie:
+            lines.append(f'Cookie: {cookie}')
+        if content_type:
+            lines.append(f'Content-Type: {content_type}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        try:
+            head = await self.reader.readuntil(b'\r\n\r\n')
+            status_line, *header_lines = head.decode('latin-1').rstrip('\r\n').split('\r\n')
+            headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                headers.setdefault(name.strip().lower(), []).append(value.strip())
+            if 'content-length' in headers:
+                content = await self.reader.readexactly(int(headers['content-length'][0]))
+            elif 'chunked' in headers.get('transfer-encoding', [''])[0]:
+                content = await self.read_chunked()
+            else:
+                content = await self.reader.read()
+                self.close()
+            if headers.get('connection', [''])[0].lower() == 'close' or status_line.startswith('HTTP/1.0'):
+                self.close()
+            return int(status_line.split(' ', 2)[1]), headers, content
+        except BaseException:
+            self.close()
+            raise
+
+    async def read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            chunks.append(await self.reader.readexactly(size + 2))
+            if size == 0:
+                return b''.join(chunks)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def log_in(host, port, username, password):
+    """The session cookie for a seeded user"""
+    connection = Connection(host, port)
+    try:
+        body = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+        status, headers, _ = await connection.request('POST', '/login', body=body,
+                                                      content_type='application/x-www-form-urlencoded')
+    finally:
+        connection.close()
+    cookies = [value.split(';', 1)[0] for value in headers.get('set-cookie', [])]
+    if status != 302 or not cookies:
+        raise SystemExit(f'Could not log in as {username}')
+    return '; '.join(cookies)
+
+
+async def open_stream(host, port, post_ids):
+    """Opens an /api/live stream; returns its writer if the server accepted it, else None"""
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(f"GET /api/live?posts={','.join(map(str, post_ids))} HTTP/1.1\r\n"
+                     f'Host: {host}:{port}\r\nAccept: text/event-stream\r\n\r\n'.encode())
+        status_line = await asyncio.wait_for(reader.readline(), 10)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if b' 200 ' not in status_line:
+        writer.close()
+        return None
+    return writer
+
+
+async def run_load(args, port, users, post_ids):
+    """Returns {'latencies': [...], 'errors': n, 'streams': accepted}"""
+    host = '127.0.0.1'
+    rng = random.Random(args.seed)
+    logins = users[:max(1, min(len(users), args.sessions))]
+    cookies = [await log_in(host, port, username, args.password) for _, username in logins]
+
+    streams = []
+    for _ in range(args.idle_streams):
+        streams.append(await open_stream(host, port, rng.sample(post_ids, min(20, len(post_ids)))))
+    accepted = sum(1 for writer in streams if writer is not None)
+
+    names, weights = list(MIX), list(MIX.values())
+    latencies, errors = [], [0]
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.seconds
+
+    async def client_loop(number):
+        client_rng = random.Random(f'{args.seed}:{number}')
+        cookie = cookies[number % len(cookies)] if client_rng.random() < args.logged_in else None
+        connection = Connection(host, port)
+        try:
+            while time.perf_counter() < deadline:
+                name = client_rng.choices(names, weights)[0]
+                if name == 'index':
+                    path = '/'
+                elif name == 'explore':
+                    path = '/explore'
+                elif name == 'profile':
+                    path = '/profile/' + urllib.parse.quote(client_rng.choice(users)[1])
+                elif name == 'post':
+                    path = f'/post/{client_rng.choice(post_ids)}'
+                else:
+                    path = '/api/likes?ids=' + ','.join(map(str, client_rng.sample(post_ids, min(20, len(post_ids)))))
+                request_started = time.perf_counter()
+                try:
+                    status, _, _ = await asyncio.wait_for(connection.request('GET', path, cookie), args.timeout)
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ValueError):
+                    status = None
+                elapsed = time.perf_counter() - request_started
+                if request_started >= measure_from:
+                    latencies.append(elapsed)
+                    if status != 200:
+                        errors[0] += 1
+                if status is None:
+                    await asyncio.sleep(0.1)  # Refused or reset; don't spin
+        finally:
+            connection.close()
+
+    await asyncio.gather(*(client_loop(number) for number in range(args.connections)))
+    for writer in streams:
+        if writer is not None:
+            writer.close()
+    return {'latencies': latencies, 'errors': errors[0], 'streams': accepted}
+
+
+def wait_until_up(process, port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'serve.py exited with status {process.returncode}')
+        try:
+            status, _, _ = asyncio.run(Connection('127.0.0.1', port).request('GET', '/'))
+            if status < 500:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'serve.py did not start listening on port {port}')
+
+
+def run_mode(mode, args, users, post_ids):
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'photogram.db')
+        shutil.copy(args.database, database)
+        env = dict(os.environ, CACHE_BACKEND='', RATE_LIMIT_BACKEND='', DATABASE_URL=f'sqlite:///{database}',
+                   LIKE_QUEUE_PATH=os.path.join(directory, 'like_queue.db'))
+        command = [sys.executable, os.path.join(HERE, 'serve.py'), '--mode', mode, '--port', str(args.port)]
+        if mode == 'asgi':
+            command += ['--workers', str(args.workers), '--threads', str(args.threads)]
+        process = subprocess.Popen(command, env=env, cwd=HERE, stdout=subprocess.DEVNULL,
+                                   stderr=None if args.verbose else subprocess.DEVNULL)
+        try:
+            wait_until_up(process, args.port)
+            return asyncio.run(run_load(args, args.port, users, post_ids))
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def report(mode, result, args):
+    latencies = result['latencies']
+    line = (f"{mode:<10} {len(latencies) / args.seconds:>8.1f} req/s  p50 {percentile(latencies, 0.5) * 1000:>7.1f}ms  "
+            f"p99 {percentile(latencies, 0.99) * 1000:>8.1f}ms  errors {result['errors']}")
+    if args.idle_streams:
+        line += f"  streams {result['streams']}/{args.idle_streams}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='asgi,threaded', help='comma-separated serve.py modes to compare')
+    parser.add_argument('--connections', type=int, default=256, help='concurrent keep-alive connections')
+    parser.add_argument('--seconds', type=float, default=20, help='measured duration')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of requests before measuring')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a request counts as failed')
+    parser.add_argument('--logged-in', type=float, default=0.5, help='fraction of connections with a session')
+    parser.add_argument('--sessions', type=int, default=20, help='seeded users to log in as')
+    parser.add_argument('--idle-streams', type=int, default=0, help='/api/live streams held open during the run')
+    parser.add_argument('--workers', type=int, default=1, help='serve.py --workers (asgi)')
+    parser.add_argument('--threads', type=int, default=32, help='serve.py --threads (asgi)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--database', default=os.path.join('instance', 'photogram.db'))
+    parser.add_argument('--password', default='password123', help='password of the seeded users')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the raw latencies to this file')
+    parser.add_argument('--verbose', action='store_true', help="show the servers' output")
+    args = parser.parse_args()
+
+    users, post_ids = sample_ids(args.database, args.seed)
+    results = {}
+    for mode in args.modes.split(','):
+        results[mode] = run_mode(mode, args, users, post_ids)
+        report(mode, results[mode], args)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'args': {key: value for key, value in vars(args).items() if key != 'json'},
+                       'results': results}, output)
+
+
+if __name__ == '__main__':
+    main()
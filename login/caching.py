@@ -0,0 +1,152 @@
+"""Small key/value caches with TTL and LRU eviction for rendered HTML.
+
+Two backends share one interface:
+
+- MemoryCache keeps entries in this process. It is the fastest option but
+  every worker process warms and invalidates its own copy.
+- SqliteCache keeps entries in a local SQLite file, so all worker processes
+  on one host share hits and invalidations.
+
+Besides plain entries each backend keeps named version counters. Callers put
+versions into their keys and bump a version to invalidate every key built
+from it, which avoids having to find and delete those keys.
+"""
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    def __init__(self, max_entries=5000, default_ttl=300):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict()  # key -> (expires at, value), least recently used first
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (ttl or self.default_ttl)
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def versions(self, names):
+        with self.lock:
+            return [self.counters.get(name, 0) for name in names]
+
+    def bump(self, *names):
+        with self.lock:
+            for name in names:
+                self.counters[name] = self.counters.get(name, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.counters.clear()
+
+
+class SqliteCache:
+    def __init__(self, path, max_entries=5000, default_ttl=300, touch_interval=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.touch_interval = touch_interval
+        self.local = threading.local()
+        self.writes = 0
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entry '
+                '(key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_entry_accessed ON cache_entry (accessed)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_version (name TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+            )
+
+    def connect(self):
+        # One connection per thread; sqlite3 connections are not shareable across threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        connection = self.connect()
+        row = connection.execute(
+            'SELECT value, expires, accessed FROM cache_entry WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[1] < now:
+            return None
+        # A write per hit would serialise readers on the database lock; recency
+        # only needs to be good enough for eviction, so refresh it now and then
+        if now - row[2] >= self.touch_interval:
+            connection.execute('UPDATE cache_entry SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        connection = self.connect()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache_entry (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+            (key, pickle.dumps(value), now + (ttl or self.default_ttl), now)
+        )
+        # Evicting on every write would double write cost, so trim every 100 writes
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.evict(now)
+
+    def evict(self, now):
+        connection = self.connect()
+        connection.execute('DELETE FROM cache_entry WHERE expires < ?', (now,))
+        connection.execute(
+            'DELETE FROM cache_entry WHERE key IN ('
+            'SELECT key FROM cache_entry ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def delete(self, key):
+        self.connect().execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+
+    def versions(self, names):
+        rows = dict(self.connect().execute(
+            f"SELECT name, version FROM cache_version WHERE name IN ({','.join('?' * len(names))})",
+            list(names)
+        ))
+        return [rows.get(name, 0) for name in names]
+
+    def bump(self, *names):
+        connection = self.connect()
+        for name in names:
+            connection.execute(
+                'INSERT INTO cache_version (name, version) VALUES (?, 1) '
+                'ON CONFLICT (name) DO UPDATE SET version = version + 1',
+                (name,)
+            )
+
+    def clear(self):
+        connection = self.connect()
+        connection.execute('DELETE FROM cache_entry')
+        connection.execute('DELETE FROM cache_version')
@@ -0,0 +1,258 @@
+"""Database profiles, connection setup and session routing.
+
+A profile bundles the engine options (pool sizing) and the SQLite pragmas
+applied to every new connection:
+
+- 'development' keeps SQLite's defaults, which suit one developer clicking
+  around: rollback journal, fsync on every commit, a tiny page cache.
+- 'production' switches to WAL so readers never block the writer (and the
+  writer never blocks readers), relaxes fsync to once per checkpoint, gives
+  each connection a larger page cache and memory-mapped I/O, and waits for
+  a lock instead of failing with "database is locked" straight away.
+
+Writers can still collide: SQLite allows one writer at a time, and a
+transaction that read before another writer committed gets SQLITE_BUSY
+immediately whatever the timeout. retry_on_busy() re-runs a whole view with
+jittered exponential backoff when that happens.
+
+Reads can be routed to replicas: any number of binds named replica<N>,
+which may be PostgreSQL streaming replicas or, for SQLite, read-only
+connections to the same file. Views mark themselves with @read_only;
+RoutingSession then sends their queries to one replica per request, picked
+round-robin, while flushes and every other view go to the primary. After a
+request writes, the visitor's reads stick to the primary for
+DB_STICKY_SECONDS so they see their own write even if replicas lag.
+
+Coroutines on an event loop (see asgi.py) read through AsyncReader, which
+uses SQLAlchemy's async engine when the database's async driver is installed
+(aiosqlite, asyncpg) and otherwise runs the same queries on a few threads.
+"""
+import asyncio
+import itertools
+import math
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from flask import current_app, g, has_app_context, has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+REPLICA_PREFIX = 'replica'
+READ_ONLY_FLAG = 'db_read_only'
+REPLICA_ENGINE = 'db_replica'
+STICKY_KEY = 'db_primary_until'  # flask session key: read from the primary until this time
+
+PROFILES = {
+    'development': {
+        'pragmas': {},
+        'engine_options': {},
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',  # WAL stays consistent; only the last commits can be lost on power failure
+            'cache_size': -64000,  # KiB when negative: 64 MB of page cache per connection
+            'mmap_size': 256 * 1024 * 1024,
+            'busy_timeout': 5000,  # ms to wait for the write lock before raising SQLITE_BUSY
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 10,
+        },
+    },
+}
+
+# Pragmas that change the database file rather than the connection
+PERSISTENT_PRAGMAS = {'journal_mode'}
+
+# Async drivers by backend, for AsyncReader
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+# Spreads requests over replicas; shared by every session in the process
+replica_counter = itertools.count()
+
+
+def engine_options(profile, uri):
+    """Engine options for a profile, plus connection health checks for server databases"""
+    options = dict(PROFILES[profile]['engine_options'])
+    if options and not uri.startswith('sqlite'):
+        options.setdefault('pool_pre_ping', True)  # Survive server restarts and failovers
+        options.setdefault('pool_recycle', 1800)
+    return options
+
+
+def replica_binds(uris):
+    """SQLALCHEMY_BINDS for replica URIs; SQLite replicas are opened read-only"""
+    return {
+        f'{REPLICA_PREFIX}{number}': read_only_uri(uri) if uri.startswith('sqlite') else uri
+        for number, uri in enumerate(uris)
+    }
+
+
+def is_replica(bind_key):
+    return bool(bind_key) and bind_key.startswith(REPLICA_PREFIX)
+
+
+def read_only_uri(uri):
+    """Turns a sqlite:/// URI into one that opens the same file read-only"""
+    path = uri[len('sqlite:///'):]
+    if path.startswith('file:'):
+        path = path[len('file:'):].split('?')[0]
+    return f'sqlite:///file:{path}?mode=ro&uri=true'
+
+
+def apply_pragmas(engine, pragmas, read_only=False):
+    """Sets pragmas on every new connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = dict(pragmas)
+    if read_only:
+        for name in PERSISTENT_PRAGMAS:
+            pragmas.pop(name, None)
+        pragmas['query_only'] = 'ON'
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def add_math_functions(engine):
+    """Registers ln() and exp() on SQLite builds compiled without its math functions"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def register_functions(dbapi_connection, connection_record):
+        try:
+            dbapi_connection.execute('SELECT ln(1), exp(0)')
+        except sqlite3.OperationalError:
+            dbapi_connection.create_function('ln', 1, math.log, deterministic=True)
+            dbapi_connection.create_function('exp', 1, math.exp, deterministic=True)
+
+
+class RoutingSession(Session):
+    """Sends the queries of read-only views to a replica, everything else to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get(READ_ONLY_FLAG):
+            engine = self.replica()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def replica(self):
+        """The replica engine for this request, chosen round-robin on first use"""
+        if REPLICA_ENGINE not in g:
+            replicas = [engine for key, engine in sorted(self._db.engines.items(), key=lambda item: str(item[0]))
+                        if is_replica(key)]
+            setattr(g, REPLICA_ENGINE, replicas[next(replica_counter) % len(replicas)] if replicas else None)
+        return g.get(REPLICA_ENGINE)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def mark_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def mark_bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def stick_to_primary(session):
+    # Read-your-writes: this visitor's next reads skip replicas until they have caught up
+    if session.info.pop('wrote', False) and has_request_context():
+        flask_session[STICKY_KEY] = time.time() + current_app.config.get('DB_STICKY_SECONDS', 0)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_writes(session):
+    session.info.pop('wrote', None)
+
+
+def read_only(f):
+    """Marks a view as read-only so RoutingSession may serve it from a replica"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        previous = g.get(READ_ONLY_FLAG)
+        setattr(g, READ_ONLY_FLAG, flask_session.get(STICKY_KEY, 0) < time.time())
+        try:
+            return f(*args, **kwargs)
+        finally:
+            setattr(g, READ_ONLY_FLAG, previous)
+    return decorated_function
+
+
+def is_busy(error):
+    message = str(getattr(error, 'orig', error)).lower()
+    return 'database is locked' in message or 'database table is locked' in message or 'busy' in message
+
+
+def retry_on_busy(session, retries=5, base_delay=0.02, max_delay=1.0):
+    """Re-runs a view when SQLite reports the database is locked
+
+    The session is rolled back before each retry so the view starts from a
+    fresh transaction. Delays double per attempt with full jitter, so writers
+    that collided once do not collide again in lockstep.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            for attempt in range(retries + 1):
+                try:
+                    return f(*args, **kwargs)
+                except OperationalError as error:
+                    if attempt == retries or not is_busy(error):
+                        raise
+                    session.rollback()
+                    time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+        return decorated_function
+    return decorator
+
+
+class AsyncReader:
+    """Read-only queries for coroutines, without blocking the event loop"""
+
+    def __init__(self, engine, pragmas=None, threads=4):
+        self.engine = engine
+        self.async_engine = None
+        self.executor = None
+        driver = ASYNC_DRIVERS.get(engine.dialect.name)
+        try:
+            from sqlalchemy.ext.asyncio import create_async_engine
+            import greenlet  # noqa: F401  (the async engine needs it)
+            if driver:
+                self.async_engine = create_async_engine(engine.url.set(drivername=driver))
+                apply_pragmas(self.async_engine.sync_engine, pragmas or {}, read_only=True)
+        except ImportError:
+            self.async_engine = None
+        if self.async_engine is None:
+            self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='async-reads')
+
+    @property
+    def mode(self):
+        return f'async ({self.async_engine.dialect.driver})' if self.async_engine is not None else 'threads'
+
+    async def fetch_all(self, statement, parameters=None):
+        if self.async_engine is not None:
+            async with self.async_engine.connect() as connection:
+                return (await connection.execute(statement, parameters or {})).fetchall()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.fetch_all_blocking, statement, parameters)
+
+    def fetch_all_blocking(self, statement, parameters=None):
+        with self.engine.connect() as connection:
+            return connection.execute(statement, parameters or {}).fetchall()
@@ -1,10 +1,36 @@
-from app import app, db, User, Post, Comment, Like, Follow
-from werkzeug.security import generate_password_hash
-from datetime import datetime, timedelta
+"""Fills the database with sample data.
+
+With no options it creates the seven demo accounts and a handful of posts.
+Given --users it generates a synthetic network instead, large enough to show
+how the app behaves at scale:
+
+    python db_seed_script.py --users 1000000 --posts-per-user 5 --workers 4
+
+Follower counts, posts per user, likes and comments follow power laws: a few
+accounts are followed by a large share of everyone, most by almost nobody,
+and popular authors' posts collect more likes and comments. Rows are built in
+chunks (in a process pool with --workers) and written with bulk inserts, one
+commit per chunk. Every synthetic user's password is `password123`, hashed
+once. Posts share a pool of --images real JPEGs, since uploads are stored by
+content and identical photos would be stored once anyway.
+
+The same --seed produces the same users, posts, follows, likes and comments
+whatever the number of workers; only timestamps move with the current time.
+"""
+import argparse
+import io
+import multiprocessing
 import random
-import os
-import shutil
-import uuid
+import time
+from array import array
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from PIL import Image, ImageDraw, ImageOps
+
+from app import app, db, blob_store, image_pipeline, password_hasher, User, Post, Comment, Like, Follow, \
+    reconcile_counters, rebuild_search, recompute_trending, rebuild_timelines, uses_timelines
+from ranking import trend_point
 
 # Sample data
 users = [
@@ -31,6 +57,9 @@ captions = [
     "Family time ❤️"
 ]
 
+# Sample hashtags, added to some synthetic captions
+hashtags = ['travel', 'food', 'photography', 'nature', 'fitness', 'art', 'coffee', 'books', 'sunset', 'hult']
+
 # Sample comments
 comments = [
     "Love this!",
@@ -45,19 +74,52 @@ comments = [
     "So creative!"
 ]
 
+SYNTHETIC_PASSWORD = 'password123'
+
+# Sample images
+def sample_jpeg(rng, size=640):
+    """Returns a small real JPEG: a random two-colour gradient with a few shapes on it"""
+    def colour():
+        return tuple(rng.randrange(256) for _ in range(3))
+    
+    gradient = Image.linear_gradient('L').rotate(rng.uniform(0, 360)).resize((size, size))
+    image = ImageOps.colorize(gradient, colour(), colour())
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(2, 6)):
+        x, y = rng.randrange(size), rng.randrange(size)
+        radius = rng.randint(size // 20, size // 4)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=colour())
+    
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=80)
+    buffer.seek(0)
+    return buffer
+
+def store_sample_images(count, seed, variants=True):
+    """Writes `count` distinct sample photos to the upload store; returns their blob names"""
+    rng = random.Random(f'{seed}:images')
+    names = [blob_store.put(sample_jpeg(rng), '.jpg') for _ in range(count)]
+    if variants:
+        for future in [image_pipeline.submit(name) for name in names]:
+            future.result()
+    return names
+
 def seed_database():
     with app.app_context():
         # Clear existing data
-        db.drop_all()
-        db.create_all()
+        db.drop_all(bind_key=None)
+        db.create_all(bind_key=None)
         
         print("Creating users...")
+        password_hashes = {}  # Hashing is deliberately slow, so each distinct password is hashed once
         created_users = []
         for user_data in users:
+            if user_data['password'] not in password_hashes:
+                password_hashes[user_data['password']] = password_hasher.hash(user_data['password'])
             user = User(
                 username=user_data['username'],
                 email=user_data['email'],
-                password_hash=generate_password_hash(user_data['password']),
+                password_hash=password_hashes[user_data['password']],
                 bio=user_data['bio']
             )
             db.session.add(user)
@@ -67,35 +129,17 @@ def seed_database():
         
         # Create sample posts
         print("Creating posts...")
-        
-        # Ensure uploads directory exists
-        uploads_dir = os.path.join('static', 'uploads')
-        os.makedirs(uploads_dir, exist_ok=True)
-        
-        # Copy sample images or create placeholders
-        # In a real implementation, you would have sample images to copy
-        # For this example, we'll create text files as placeholders
+        images = store_sample_images(15, seed=0)
         created_posts = []
-        for i in range(15):  # Create 15 posts
+        for image_filename in images:  # Create 15 posts
             user = random.choice(created_users)
             
-            # For a real implementation, copy an image file
-            # Here we're creating a placeholder unique filename
-            unique_filename = f"{uuid.uuid4().hex}.jpg"
-            
-            # In a real implementation, you would copy a real image:
-            # shutil.copy('sample_images/image1.jpg', os.path.join(uploads_dir, unique_filename))
-            
-            # Create a placeholder file for demonstration
-            with open(os.path.join(uploads_dir, unique_filename), 'w') as f:
-                f.write(f"Placeholder for post {i+1}")
-            
             # Create a random timestamp within the last 30 days
             random_days = random.randint(0, 30)
             created_at = datetime.utcnow() - timedelta(days=random_days)
             
             post = Post(
-                image_filename=unique_filename,
+                image_filename=image_filename,
                 caption=random.choice(captions),
                 created_at=created_at,
                 user_id=user.id
@@ -161,7 +205,248 @@ def seed_database():
         
         db.session.commit()
         
-        print("Database seeded successfully!")
+        finish_seeding()
+
+def finish_seeding():
+    # Rows were added directly, so bring the denormalized counters and derived data up to date
+    print("Reconciling counters...")
+    reconcile_counters()
+    
+    print("Scoring trending posts...")
+    recompute_trending()
+    
+    print("Building search index...")
+    rebuild_search()
+    
+    if uses_timelines():
+        print("Building timelines...")
+        rebuild_timelines()
+    
+    print("Database seeded successfully!")
+
+# Synthetic data generation
+#
+# Chunks are generated by the functions below, in worker processes when
+# --workers > 1; only the main process talks to the database. Each chunk gets
+# its own random generator seeded from its position, so the output does not
+# depend on which worker builds it.
+CONTEXT = {}
+UNIX_EPOCH = datetime(1970, 1, 1)  # Post times travel to the workers as seconds since this
+
+def init_generator(context):
+    """Shares the generation settings with a worker and precomputes the popularity weights"""
+    CONTEXT.update(context)
+    # Zipf: the user with id k is followed with weight 1 / k^s
+    CONTEXT['popularity'] = list(accumulate(rank ** -context['zipf'] for rank in range(1, context['users'] + 1)))
+
+def chunk_random(kind, start):
+    return random.Random(f"{CONTEXT['seed']}:{kind}:{start}")
+
+def heavy_tailed(rng, mean, limit):
+    """A Pareto-distributed count averaging about `mean`: mostly small, occasionally huge"""
+    return min(limit, int(rng.paretovariate(2) * mean / 2))
+
+def random_time(rng, after=None):
+    """A random moment within the last --days days, and later than `after` if given"""
+    now = CONTEXT['now']
+    start = now - timedelta(days=CONTEXT['days'])
+    if after and after > start:
+        start = after
+    return start + timedelta(seconds=rng.uniform(0, (now - start).total_seconds()))
+
+def run_chunk(task):
+    function, *args = task
+    return function(*args)
+
+def generate_users(start, count):
+    rng = chunk_random('users', start)
+    return [{
+        'id': user_id,
+        'username': f'user{user_id}',
+        'email': f'user{user_id}@example.com',
+        'password_hash': CONTEXT['password_hash'],
+        'bio': rng.choice(users)['bio'],
+        'created_at': random_time(rng),
+    } for user_id in range(start, start + count)]
+
+def generate_follows(start, count):
+    rng = chunk_random('follows', start)
+    user_ids = range(1, CONTEXT['users'] + 1)
+    rows = []
+    for follower_id in range(start, start + count):
+        wanted = heavy_tailed(rng, CONTEXT['follows_per_user'], (CONTEXT['users'] - 1) // 2)
+        followed = set()
+        for _ in range(10):  # Popular accounts get drawn repeatedly; give up on the rare tail after a few rounds
+            if len(followed) >= wanted:
+                break
+            followed.update(rng.choices(user_ids, cum_weights=CONTEXT['popularity'], k=wanted - len(followed)))
+            followed.discard(follower_id)
+        rows.extend({'follower_id': follower_id, 'followed_id': followed_id, 'created_at': random_time(rng)}
+                    for followed_id in sorted(followed))
+    return rows
+
+def generate_posts(start, count):
+    """Posts by users start..start+count-1, without ids (the main process numbers them in order)"""
+    rng = chunk_random('posts', start)
+    images = CONTEXT['images']
+    rows = []
+    for user_id in range(start, start + count):
+        for _ in range(heavy_tailed(rng, CONTEXT['posts_per_user'], 10000)):
+            caption = rng.choice(captions)
+            if rng.random() < 0.4:
+                caption += ' ' + ' '.join(f'#{tag}' for tag in rng.sample(hashtags, rng.randint(1, 3)))
+            created_at = random_time(rng)
+            rows.append({
+                'image_filename': rng.choice(images),
+                'caption': caption,
+                'created_at': created_at,
+                'user_id': user_id,
+                'trend_score': trend_point(created_at, CONTEXT['post_weight'], CONTEXT['half_life']),
+            })
+    return rows
+
+def generate_engagement(start, authors, times):
+    """Likes and comments for posts start..start+len(authors)-1, given their authors and timestamps"""
+    rng = chunk_random('engagement', start)
+    followers, mean_followers = CONTEXT['followers'], CONTEXT['mean_followers']
+    likes, post_comments = [], []
+    for post_id, author_id, timestamp in zip(range(start, start + len(authors)), authors, times):
+        posted_at = UNIX_EPOCH + timedelta(seconds=timestamp)
+        reach = (1 + followers[author_id]) / (1 + mean_followers)  # Popular authors get more engagement
+        for user_id in rng.sample(range(1, CONTEXT['users'] + 1),
+                                  heavy_tailed(rng, CONTEXT['likes_per_post'] * reach, CONTEXT['users'])):
+            likes.append({'user_id': user_id, 'post_id': post_id, 'created_at': random_time(rng, posted_at)})
+        for _ in range(heavy_tailed(rng, CONTEXT['comments_per_post'] * reach, 1000)):
+            post_comments.append({
+                'content': rng.choice(comments),
+                'created_at': random_time(rng, posted_at),
+                'post_id': post_id,
+                'user_id': rng.randint(1, CONTEXT['users']),
+            })
+    return likes, post_comments
+
+def generated_chunks(tasks, context, workers):
+    """Yields the result of each (function, *args) task in order, from a process pool if workers > 1"""
+    if workers > 1:
+        with multiprocessing.Pool(workers, init_generator, (context,)) as pool:
+            yield from pool.imap(run_chunk, tasks)
+    else:
+        init_generator(context)
+        yield from map(run_chunk, tasks)
+
+def insert_chunk(model, rows):
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+
+class Progress:
+    def __init__(self, label):
+        self.label = label
+        self.rows = 0
+        self.started = time.perf_counter()
+    
+    def add(self, rows):
+        self.rows += rows
+        elapsed = time.perf_counter() - self.started
+        print(f"\r{self.label}: {self.rows:,} rows, {self.rows / max(elapsed, 1e-9):,.0f}/s", end='', flush=True)
+    
+    def done(self):
+        self.add(0)
+        print()
+
+def generate_database(options):
+    context = {
+        'seed': options.seed,
+        'users': options.users,
+        'zipf': options.zipf,
+        'days': options.days,
+        'now': datetime.utcnow(),
+        'follows_per_user': options.follows_per_user,
+        'posts_per_user': options.posts_per_user,
+        'likes_per_post': options.likes_per_post,
+        'comments_per_post': options.comments_per_post,
+        'post_weight': app.config['TRENDING_WEIGHTS']['post'],
+        'half_life': app.config['TRENDING_HALF_LIFE'],
+    }
+    chunk = options.chunk_size
+    
+    with app.app_context():
+        db.drop_all(bind_key=None)
+        db.create_all(bind_key=None)
+        
+        print(f"Writing {options.images} sample images...")
+        context['images'] = store_sample_images(options.images, options.seed, variants=not options.skip_variants)
+        context['password_hash'] = password_hasher.hash(SYNTHETIC_PASSWORD)
+        
+        progress = Progress("Users")
+        tasks = [(generate_users, start, min(chunk, options.users + 1 - start))
+                 for start in range(1, options.users + 1, chunk)]
+        for rows in generated_chunks(tasks, context, options.workers):
+            insert_chunk(User, rows)
+            progress.add(len(rows))
+        progress.done()
+        
+        # Follows are spread over more, smaller chunks: a chunk holds follows_per_user rows per user
+        per_chunk = max(1, int(chunk // max(1, options.follows_per_user)))
+        followers = array('i', bytes(4 * (options.users + 1)))
+        progress = Progress("Follows")
+        tasks = [(generate_follows, start, min(per_chunk, options.users + 1 - start))
+                 for start in range(1, options.users + 1, per_chunk)]
+        for rows in generated_chunks(tasks, context, options.workers):
+            insert_chunk(Follow, rows)
+            for row in rows:
+                followers[row['followed_id']] += 1
+            progress.add(len(rows))
+        progress.done()
+        
+        # Posts are numbered here, in chunk order, and their authors and times kept for the engagement pass
+        per_chunk = max(1, int(chunk // max(1, options.posts_per_user)))
+        authors, times = array('i'), array('d')
+        progress = Progress("Posts")
+        tasks = [(generate_posts, start, min(per_chunk, options.users + 1 - start))
+                 for start in range(1, options.users + 1, per_chunk)]
+        for rows in generated_chunks(tasks, context, options.workers):
+            for post_id, row in enumerate(rows, start=len(authors) + 1):
+                row['id'] = post_id
+                authors.append(row['user_id'])
+                times.append((row['created_at'] - UNIX_EPOCH).total_seconds())
+            insert_chunk(Post, rows)
+            progress.add(len(rows))
+        progress.done()
+        
+        context['followers'] = followers
+        context['mean_followers'] = sum(followers) / max(1, options.users)
+        per_chunk = max(1, int(chunk // max(1, options.likes_per_post + options.comments_per_post)))
+        progress = Progress("Likes and comments")
+        tasks = [(generate_engagement, start, authors[start - 1:start - 1 + per_chunk],
+                  times[start - 1:start - 1 + per_chunk]) for start in range(1, len(authors) + 1, per_chunk)]
+        for like_rows, comment_rows in generated_chunks(tasks, context, options.workers):
+            insert_chunk(Like, like_rows)
+            insert_chunk(Comment, comment_rows)
+            progress.add(len(like_rows) + len(comment_rows))
+        progress.done()
+        
+        finish_seeding()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, help='generate this many synthetic users instead of the demo data')
+    parser.add_argument('--posts-per-user', type=float, default=5, help='average posts per user')
+    parser.add_argument('--follows-per-user', type=float, default=50, help='average accounts each user follows')
+    parser.add_argument('--likes-per-post', type=float, default=10, help='average likes per post')
+    parser.add_argument('--comments-per-post', type=float, default=2, help='average comments per post')
+    parser.add_argument('--zipf', type=float, default=1.0, help='exponent of the follower distribution')
+    parser.add_argument('--days', type=float, default=90, help='spread activity over this many past days')
+    parser.add_argument('--images', type=int, default=100, help='distinct sample photos to write')
+    parser.add_argument('--skip-variants', action='store_true', help='do not pre-generate resized variants')
+    parser.add_argument('--chunk-size', type=int, default=20000, help='rows per insert and commit')
+    parser.add_argument('--workers', type=int, default=1, help='processes generating rows')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    seed_database()
\ No newline at end of file
+    options = parse_args()
+    if options.users:
+        generate_database(options)
+    else:
+        seed_database()
@@ -0,0 +1,101 @@
+"""In-memory follow graph with cached adjacency lists.
+
+Each user's following and follower lists are held as sorted array('i') of
+user ids: 4 bytes per edge, so a few million edges fit in tens of MB. A
+membership check is a binary search over one user's list, O(log degree).
+
+Lists are cached per process and validated against named version counters
+('following:<id>' and 'followers:<id>') owned by the caller; bumping a
+counter after a follow or unfollow commits makes every process reload that
+list on its next lookup. Entries also expire after `ttl` seconds as a
+backstop for counters that only live in one process.
+"""
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+
+KINDS = ('following', 'followers')
+
+
+def contains(ids, user_id):
+    """Binary search in a sorted array of ids"""
+    position = bisect_left(ids, user_id)
+    return position < len(ids) and ids[position] == user_id
+
+
+class FollowGraph:
+    def __init__(self, load, versions, max_lists=100000, ttl=300):
+        self.load = load  # (kind, user ids) -> {user_id: iterable of ids}
+        self.versions = versions  # list of counter names -> list of versions
+        self.max_lists = max_lists
+        self.ttl = ttl
+        self.lists = OrderedDict()  # (kind, user_id) -> (version, expires, array), least recently used first
+        self.lock = threading.Lock()
+
+    def adjacency(self, kind, user_ids):
+        """Returns {user_id: sorted array of ids} for many users, loading stale lists in one batch"""
+        user_ids = list(dict.fromkeys(user_ids))
+        versions = self.versions([f'{kind}:{user_id}' for user_id in user_ids])
+        now = time.monotonic()
+        found, missing = {}, []
+        with self.lock:
+            for user_id, version in zip(user_ids, versions):
+                entry = self.lists.get((kind, user_id))
+                if entry and entry[0] == version and entry[1] > now:
+                    self.lists.move_to_end((kind, user_id))
+                    found[user_id] = entry[2]
+                else:
+                    missing.append((user_id, version))
+
+        if missing:
+            loaded = self.load(kind, [user_id for user_id, _ in missing])
+            with self.lock:
+                for user_id, version in missing:
+                    ids = array('i', sorted(loaded.get(user_id, ())))
+                    self.lists[(kind, user_id)] = (version, now + self.ttl, ids)
+                    self.lists.move_to_end((kind, user_id))
+                    found[user_id] = ids
+                while len(self.lists) > self.max_lists:
+                    self.lists.popitem(last=False)
+        return found
+
+    def following(self, user_id):
+        return self.adjacency('following', [user_id])[user_id]
+
+    def followers(self, user_id):
+        return self.adjacency('followers', [user_id])[user_id]
+
+    def is_following(self, follower_id, followed_id):
+        return contains(self.following(follower_id), followed_id)
+
+    def following_among(self, viewer_id, user_ids):
+        """Returns the subset of user_ids the viewer follows, from one cached list"""
+        following = self.following(viewer_id)
+        return {user_id for user_id in user_ids if contains(following, user_id)}
+
+    def suggestions(self, user_ids, limit=10):
+        """Friends-of-friends for many users at once: {user_id: [(candidate, mutual count)]}
+
+        Candidates are followed by people the user follows, ranked by how many
+        of them do. Every second-hop list is loaded in one batch and shared
+        between the users asking.
+        """
+        first_hop = self.adjacency('following', user_ids)
+        second_hop = self.adjacency('following', {friend for ids in first_hop.values() for friend in ids})
+        results = {}
+        for user_id, friends in first_hop.items():
+            counts = Counter()
+            for friend in friends:
+                counts.update(second_hop.get(friend, ()))
+            counts.pop(user_id, None)
+            for friend in friends:
+                counts.pop(friend, None)
+            results[user_id] = heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.lists.clear()
@@ -0,0 +1,279 @@
+"""Per-request instrumentation: SQL, template and upload timings, metrics and profiles.
+
+RequestMetrics keeps a RequestStats in flask.g for every request. SQLAlchemy
+engine events add each query's count and time to it, templates are timed by
+swapping in TimedTemplate as the Jinja template class, and app.py wraps
+upload parsing and saving in timed('upload'). Timers nest: a template that
+renders another template (feed cards) is only counted once.
+
+When a request finishes its numbers go to process-wide Prometheus counters
+and histograms, labelled with the Flask endpoint, and optionally into a
+Server-Timing header that browser dev tools show next to the request.
+Queries slower than a threshold are also kept as samples, with the endpoint
+that ran them, in a bounded buffer.
+
+SamplingProfiler is a background thread that snapshots the stacks of the
+threads serving requests every few milliseconds. A request that ends up
+slower than its threshold gets its samples written as folded stacks, one
+`frame;frame;frame count` line each, which flamegraph.pl and speedscope read
+directly. Samples of fast requests are dropped.
+
+Everything here is per process; with several workers each serves its own
+/metrics and Prometheus adds them up.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+
+STATS = 'request_stats'
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SERVER_TIMING = [('sql', 'SQL'), ('template', 'Templates'), ('upload', 'Upload I/O')]
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.seconds = Counter()  # kind -> seconds
+        self.depth = Counter()  # kind -> timers of that kind currently running
+
+
+def current_stats():
+    return g.get(STATS) if has_request_context() else None
+
+
+@contextmanager
+def timed(kind):
+    """Adds the time spent in the block to the current request's `kind` total"""
+    stats = current_stats()
+    if stats is None:
+        yield
+        return
+    stats.depth[kind] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.depth[kind] -= 1
+        if not stats.depth[kind]:
+            stats.seconds[kind] += time.perf_counter() - started
+
+
+class TimedTemplate(Template):
+    """Jinja template class that times render() for the current request"""
+
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return super().render(*args, **kwargs)
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    return ','.join(f'{name}="{label_value(value)}"' for name, value in zip(names, values))
+
+
+class RequestMetrics:
+    def __init__(self, slow_query_seconds=0.1, slow_query_samples=200, profiler=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.slow_queries = deque(maxlen=slow_query_samples)
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        self.requests = Counter()  # (endpoint, method, status) -> count
+        self.durations = {}  # endpoint -> [count per bucket, count, sum]
+        self.totals = Counter()  # (metric, endpoint) -> value
+
+    # Collection
+    def instrument_engine(self, engine):
+        """Counts and times every query run on an engine"""
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_query(connection, cursor, statement, parameters, context, executemany):
+            connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def finish_query(connection, cursor, statement, parameters, context, executemany):
+            self.record_query(connection, statement)
+
+        @event.listens_for(engine, 'handle_error')
+        def failed_query(exception_context):
+            # A statement that raised never reaches after_cursor_execute; without this its
+            # start would stay on the pooled connection and be taken for a later query's
+            if exception_context.execution_context is not None and exception_context.connection is not None:
+                self.record_query(exception_context.connection, exception_context.statement)
+
+    def record_query(self, connection, statement):
+        started = connection.info.get('query_started')
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        stats = current_stats()
+        if stats is not None:
+            stats.query_count += 1
+            stats.seconds['sql'] += elapsed
+        if elapsed >= self.slow_query_seconds:
+            self.record_slow_query(statement, elapsed)
+
+    def record_slow_query(self, statement, elapsed):
+        endpoint = request.endpoint if has_request_context() else None
+        with self.lock:
+            self.totals['slow_queries', endpoint or ''] += 1
+            self.slow_queries.append({
+                'at': datetime.utcnow().isoformat(timespec='seconds'),
+                'endpoint': endpoint,
+                'path': request.path if has_request_context() else None,
+                'seconds': round(elapsed, 6),
+                'statement': statement,
+            })
+
+    def start_request(self):
+        setattr(g, STATS, RequestStats())
+        if self.profiler is not None:
+            self.profiler.begin()
+
+    def finish_request(self, response, server_timing=False):
+        """Records the request's numbers; adds a Server-Timing header if asked to"""
+        stats = g.pop(STATS, None)
+        if stats is None:
+            return response
+        duration = time.perf_counter() - stats.started
+        endpoint = request.endpoint or ''
+        with self.lock:
+            self.requests[endpoint, request.method, response.status_code] += 1
+            histogram = self.durations.setdefault(endpoint, [[0] * len(DURATION_BUCKETS), 0, 0.0])
+            for number, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    histogram[0][number] += 1
+            histogram[1] += 1
+            histogram[2] += duration
+            self.totals['sql_queries', endpoint] += stats.query_count
+            for kind, seconds in stats.seconds.items():
+                self.totals[f'{kind}_seconds', endpoint] += seconds
+
+        if self.profiler is not None:
+            profile = self.profiler.end(duration, endpoint)
+            if profile:
+                with self.lock:
+                    self.totals['profiles', endpoint] += 1
+
+        if server_timing:
+            timings = [f'{kind};dur={stats.seconds[kind] * 1000:.1f};desc="{description}"'
+                       for kind, description in SERVER_TIMING if kind in stats.seconds]
+            timings.append(f'queries;desc="{stats.query_count} SQL queries"')
+            timings.append(f'total;dur={duration * 1000:.1f}')
+            response.headers.add('Server-Timing', ', '.join(timings))
+        return response
+
+    def discard_request(self):
+        """Forgets a request that never reached finish_request"""
+        if g.pop(STATS, None) is not None and self.profiler is not None:
+            self.profiler.end(0, None)
+
+    # Export
+    def prometheus(self, prefix='hultagram'):
+        """Returns every metric in the Prometheus text exposition format"""
+        with self.lock:
+            requests = sorted(self.requests.items())
+            durations = sorted((endpoint, [list(buckets), count, total])
+                               for endpoint, (buckets, count, total) in self.durations.items())
+            totals = dict(self.totals)
+
+        lines = [f'# HELP {prefix}_requests_total Requests served, by endpoint, method and status',
+                 f'# TYPE {prefix}_requests_total counter']
+        for (endpoint, method, status), count in requests:
+            labels = format_labels(('endpoint', 'method', 'status'), (endpoint, method, status))
+            lines.append(f'{prefix}_requests_total{{{labels}}} {count}')
+
+        lines += [f'# HELP {prefix}_request_duration_seconds Time from the start of a request to its response',
+                  f'# TYPE {prefix}_request_duration_seconds histogram']
+        for endpoint, (buckets, count, total) in durations:
+            labels = format_labels(('endpoint',), (endpoint,))
+            for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels},le="{bound}"}} {bucket_count}')
+            lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{prefix}_request_duration_seconds_count{{{labels}}} {count}')
+            lines.append(f'{prefix}_request_duration_seconds_sum{{{labels}}} {total:.6f}')
+
+        for metric, description in [
+            ('sql_queries', 'SQL queries run by requests'),
+            ('sql_seconds', 'Time requests spent waiting on SQL queries'),
+            ('template_seconds', 'Time requests spent rendering templates'),
+            ('upload_seconds', 'Time requests spent reading and storing uploads'),
+            ('slow_queries', 'Queries slower than the slow query threshold'),
+            ('profiles', 'Slow requests whose stacks were written out'),
+        ]:
+            lines += [f'# HELP {prefix}_{metric}_total {description}', f'# TYPE {prefix}_{metric}_total counter']
+            for (name, endpoint), value in sorted(totals.items()):
+                if name == metric:
+                    value = f'{value:.6f}' if isinstance(value, float) else value
+                    lines.append(f'{prefix}_{metric}_total{{{format_labels(("endpoint",), (endpoint,))}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def slow_query_samples(self):
+        """The most recent slow queries, newest first"""
+        with self.lock:
+            return list(reversed(self.slow_queries))
+
+
+def fold(frame):
+    """A stack as one 'outermost;...;innermost' line of function (file:line) frames"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, directory, threshold_seconds, interval=0.005):
+        self.directory = directory
+        self.threshold_seconds = threshold_seconds
+        self.interval = interval
+        self.active = {}  # thread id -> Counter of folded stacks
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def begin(self):
+        """Starts sampling the calling thread"""
+        with self.lock:
+            self.active[threading.get_ident()] = Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+
+    def end(self, duration, label):
+        """Stops sampling the calling thread; writes its stacks if it was slow and returns the file path"""
+        with self.lock:
+            stacks = self.active.pop(threading.get_ident(), None)
+        if not stacks or duration < self.threshold_seconds:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S.%f}-{label or 'request'}-{duration * 1000:.0f}ms.folded"
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as output:
+            for stack, count in stacks.most_common():
+                output.write(f'{stack} {count}\n')
+        return path
+
+    def run(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None and thread_id != own_id:
+                        stacks[fold(frame)] += 1
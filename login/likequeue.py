@@ -0,0 +1,124 @@
+"""Write-behind queue for like toggles.
+
+In write-behind mode a like or unlike does not touch the main database on the
+request path. The request records the state the user wants ("liked" or "not
+liked") in a small local SQLite file and returns; a background thread later
+writes whole batches of those states to the main database in one transaction.
+
+The queue is keyed by (user_id, post_id), so a burst of toggles on the same
+post by the same user coalesces into one row holding the final state. Rows
+hold states rather than toggles, which makes applying a batch idempotent:
+if two processes drain the same rows, or a batch is retried after a failure,
+the result is the same. A row is only removed once its batch has committed,
+and only if no newer toggle replaced it in the meantime, so nothing is lost
+across crashes or restarts.
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LikeQueue:
+    def __init__(self, path, apply, interval=0.5, batch_size=500):
+        self.path = path
+        self.apply = apply  # list of (user_id, post_id, liked) -> None, raises to retry later
+        self.interval = interval
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.puts = 0
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending_like ('
+                'user_id INTEGER NOT NULL, post_id INTEGER NOT NULL, liked INTEGER NOT NULL, '
+                'version INTEGER NOT NULL DEFAULT 1, queued_at REAL NOT NULL, '
+                'PRIMARY KEY (user_id, post_id))'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_pending_like_queued ON pending_like (queued_at)')
+
+    def connect(self):
+        # One connection per thread; sqlite3 connections are not shareable across threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def put(self, user_id, post_id, liked):
+        """Records the like state a user wants for a post, replacing any queued state"""
+        self.connect().execute(
+            'INSERT INTO pending_like (user_id, post_id, liked, queued_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (user_id, post_id) DO UPDATE SET '
+            'liked = excluded.liked, version = version + 1, queued_at = excluded.queued_at',
+            (user_id, post_id, int(liked), time.time())
+        )
+        # Flush early instead of waiting for the timer when a full batch is waiting
+        self.puts += 1
+        if self.puts % self.batch_size == 0:
+            self.wake.set()
+
+    def pending(self, user_id, post_ids):
+        """Returns {post_id: liked} for a user's queued states on the given posts"""
+        post_ids = list(post_ids)
+        if not post_ids:
+            return {}
+        rows = self.connect().execute(
+            f"SELECT post_id, liked FROM pending_like WHERE user_id = ? "
+            f"AND post_id IN ({','.join('?' * len(post_ids))})",
+            [user_id] + post_ids
+        )
+        return {post_id: bool(liked) for post_id, liked in rows}
+
+    def flush(self):
+        """Applies queued states in batches until the queue is empty; returns rows applied"""
+        applied = 0
+        with self.flush_lock:
+            connection = self.connect()
+            while True:
+                rows = connection.execute(
+                    'SELECT user_id, post_id, liked, version FROM pending_like '
+                    'ORDER BY queued_at LIMIT ?', (self.batch_size,)
+                ).fetchall()
+                if not rows:
+                    return applied
+                self.apply([(user_id, post_id, bool(liked)) for user_id, post_id, liked, _ in rows])
+                connection.executemany(
+                    'DELETE FROM pending_like WHERE user_id = ? AND post_id = ? AND version = ?',
+                    [(user_id, post_id, version) for user_id, post_id, _, version in rows]
+                )
+                applied += len(rows)
+                if len(rows) < self.batch_size:
+                    return applied
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Rows stay queued and are retried on the next tick
+                logger.exception('Could not flush queued likes')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='like-queue', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread and drains what is left"""
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM pending_like').fetchone()[0]
@@ -0,0 +1,313 @@
+"""Live like counts and comments over server-sent events.
+
+A page opens one EventSource for the posts it shows and receives a `likes`
+event with the new count whenever one of them is liked or unliked, and a
+`comment` event with each new comment. Like events carry the count rather
+than a delta, so a missed or repeated one corrects itself on the next.
+
+LiveHub fans events out to the streams open in this process, indexed by post,
+so publishing touches only the streams showing that post. A stream that falls
+more than `max_queue` events behind is closed, and the browser reconnects.
+
+Events must also reach streams held by other processes:
+
+- LiveHub alone is enough when one process serves everything (the dev server).
+- SqliteBroker stands in for a message broker such as Redis pub/sub on a
+  single host. Publishers append events to a local SQLite file, and every
+  process polls it every `interval` seconds and hands new events to its own
+  hub. Old events are trimmed after `retention` seconds.
+
+Both have the same publish/subscribe/unsubscribe interface.
+
+A streamed WSGI response holds a thread for as long as the page stays open,
+so app.py serves none of its own /api/live streams unless LIVE_MAX_STREAMS is
+raised. On an asyncio event loop an
+idle stream costs a socket and a queue instead: asgi.py serves /api/live that
+way when the app runs under an ASGI server, and LiveServer does the same as
+its own process next to WSGI workers, fed through SqliteBroker, with the
+proxy sending /api/live to it.
+
+Streams can start with a snapshot, the posts' current like counts, since the
+page may have come from a cache or been open a while before connecting.
+"""
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+KEEPALIVE = ': keepalive\n\n'
+
+
+def format_event(kind, data):
+    return f"event: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def parse_post_ids(value, limit):
+    """Parses '1,2,3' into a set of post ids; raises ValueError if malformed or longer than limit"""
+    post_ids = {int(item) for item in value.split(',') if item}
+    if not post_ids:
+        raise ValueError('posts must be a comma-separated list of post ids')
+    if len(post_ids) > limit:
+        raise ValueError(f'At most {limit} posts per stream')
+    return post_ids
+
+
+class Subscription:
+    def __init__(self, post_ids, deliver):
+        self.post_ids = frozenset(post_ids)
+        self.deliver = deliver  # event text -> False to be dropped; called on the publishing thread
+
+
+class LiveHub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_post = {}  # post_id -> set of Subscriptions
+        self.count = 0
+
+    def subscribe(self, post_ids, deliver):
+        subscription = Subscription(post_ids, deliver)
+        with self.lock:
+            for post_id in subscription.post_ids:
+                self.by_post.setdefault(post_id, set()).add(subscription)
+            self.count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            removed = False
+            for post_id in subscription.post_ids:
+                subscribers = self.by_post.get(post_id)
+                if subscribers and subscription in subscribers:
+                    subscribers.discard(subscription)
+                    removed = True
+                    if not subscribers:
+                        del self.by_post[post_id]
+            if removed:
+                self.count -= 1
+
+    def publish(self, post_id, kind, data):
+        self.dispatch(post_id, format_event(kind, data))
+
+    def dispatch(self, post_id, text):
+        with self.lock:
+            subscribers = list(self.by_post.get(post_id, ()))
+        for subscription in subscribers:
+            if not subscription.deliver(text):
+                self.unsubscribe(subscription)
+
+    def __len__(self):
+        return self.count
+
+
+class SqliteBroker:
+    def __init__(self, path, hub, interval=0.25, retention=60):
+        self.path = path
+        self.hub = hub
+        self.interval = interval
+        self.retention = retention
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.position = 0
+        self.writes = 0
+        connection = self.connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        # AUTOINCREMENT so ids are never reused after a trim, which pollers would skip
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS live_event (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'post_id INTEGER NOT NULL, body TEXT NOT NULL, created_at REAL NOT NULL)'
+        )
+
+    def connect(self):
+        # One connection per thread; sqlite3 connections are not shareable across threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA synchronous=OFF')  # Events are ephemeral; a crash may lose the last few
+            self.local.connection = connection
+        return connection
+
+    def publish(self, post_id, kind, data):
+        now = time.time()
+        connection = self.connect()
+        connection.execute('INSERT INTO live_event (post_id, body, created_at) VALUES (?, ?, ?)',
+                           (post_id, format_event(kind, data), now))
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            connection.execute('DELETE FROM live_event WHERE created_at < ?', (now - self.retention,))
+
+    def subscribe(self, post_ids, deliver):
+        self.start()
+        return self.hub.subscribe(post_ids, deliver)
+
+    def unsubscribe(self, subscription):
+        self.hub.unsubscribe(subscription)
+
+    def __len__(self):
+        return len(self.hub)
+
+    def poll(self):
+        """Hands events published since the last poll to the hub; returns how many"""
+        rows = self.connect().execute(
+            'SELECT id, post_id, body FROM live_event WHERE id > ? ORDER BY id', (self.position,)
+        ).fetchall()
+        for event_id, post_id, body in rows:
+            self.hub.dispatch(post_id, body)
+            self.position = event_id
+        return len(rows)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Could not poll live events')
+
+    def start(self):
+        """Starts polling from the newest event, once; processes without streams never poll"""
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.position = self.connect().execute('SELECT COALESCE(MAX(id), 0) FROM live_event').fetchone()[0]
+                self.thread = threading.Thread(target=self.run, name='live-broker', daemon=True)
+                self.thread.start()
+
+
+def thread_stream(source, post_ids, keepalive=15, max_queue=100, snapshot=()):
+    """Yields a stream's events for a WSGI response, blocking its thread in between"""
+    events = queue.Queue()
+
+    def deliver(text):
+        if events.qsize() >= max_queue:
+            events.put(None)
+            return False
+        events.put(text)
+        return True
+
+    subscription = source.subscribe(post_ids, deliver)
+    try:
+        yield KEEPALIVE  # Sends the headers straight away
+        yield from snapshot
+        while True:
+            try:
+                text = events.get(timeout=keepalive)
+            except queue.Empty:
+                text = KEEPALIVE  # Also how a closed connection is noticed
+            if text is None:
+                return
+            yield text
+    finally:
+        source.unsubscribe(subscription)
+
+
+def subscribe_async(source, post_ids, max_queue=100):
+    """Subscribes a coroutine on the running loop; returns (subscription, queue of event texts)
+    
+    A None on the queue means the stream fell behind and should close.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def deliver(text):
+        # Runs on the publishing thread; the queue is only touched on the loop
+        if events.qsize() >= max_queue:
+            loop.call_soon_threadsafe(events.put_nowait, None)
+            return False
+        loop.call_soon_threadsafe(events.put_nowait, text)
+        return True
+
+    return source.subscribe(post_ids, deliver), events
+
+
+async def next_event(events, keepalive, disconnected=None):
+    """The next event text, KEEPALIVE after `keepalive` idle seconds, or None to close the stream"""
+    waiter = asyncio.ensure_future(events.get())
+    waiting = {waiter} if disconnected is None else {waiter, disconnected}
+    done, _ = await asyncio.wait(waiting, timeout=keepalive, return_when=asyncio.FIRST_COMPLETED)
+    if waiter not in done:
+        waiter.cancel()
+        return None if disconnected in done else KEEPALIVE
+    return waiter.result()
+
+
+class LiveServer:
+    """A minimal HTTP server that only serves event streams, all on one event loop"""
+
+    def __init__(self, source, path='/api/live', max_posts=100, max_streams=10000, keepalive=15,
+                 max_queue=100, allow_origin=None, snapshot=None):
+        self.source = source
+        self.snapshot = snapshot  # async post_ids -> event texts, or None
+        self.path = path
+        self.max_posts = max_posts
+        self.max_streams = max_streams
+        self.keepalive = keepalive
+        self.max_queue = max_queue
+        self.allow_origin = allow_origin
+
+    def headers(self, status, content_type, extra=()):
+        lines = [f'HTTP/1.1 {status}', f'Content-Type: {content_type}', 'Cache-Control: no-cache',
+                 'Connection: close', *extra]
+        if self.allow_origin:
+            lines.append(f'Access-Control-Allow-Origin: {self.allow_origin}')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+    async def refuse(self, writer, status, message, extra=()):
+        writer.write(self.headers(status, 'application/json', extra) + json.dumps({'error': message}).encode())
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+            url = urlsplit(target)
+            if method != 'GET' or url.path != self.path:
+                await self.refuse(writer, '404 Not Found', 'Not found')
+                return
+            try:
+                post_ids = parse_post_ids(parse_qs(url.query).get('posts', [''])[0], self.max_posts)
+            except ValueError as error:
+                await self.refuse(writer, '400 Bad Request', str(error))
+                return
+            if len(self.source) >= self.max_streams:
+                await self.refuse(writer, '503 Service Unavailable', 'Too many live streams',
+                                  [f'Retry-After: {self.keepalive}'])
+                return
+            await self.stream(writer, post_ids)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ValueError, ConnectionError):
+            pass  # Malformed requests and dropped connections just close
+        finally:
+            writer.close()
+
+    async def stream(self, writer, post_ids):
+        subscription, events = subscribe_async(self.source, post_ids, self.max_queue)
+        try:
+            writer.write(self.headers('200 OK', 'text/event-stream', ['X-Accel-Buffering: no']))
+            writer.write(KEEPALIVE.encode())
+            if self.snapshot is not None:
+                writer.write(''.join(await self.snapshot(post_ids)).encode())
+            await writer.drain()
+            while True:
+                text = await next_event(events, self.keepalive)
+                if text is None:
+                    return
+                writer.write(text.encode())
+                await writer.drain()
+        finally:
+            self.source.unsubscribe(subscription)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host='127.0.0.1', port=8081):
+        asyncio.run(self.serve(host, port))
@@ -0,0 +1,229 @@
+"""Load test for the main pages and write paths.
+
+Simulated users browse the home feed, explore and profiles, like posts and
+create posts with real JPEG uploads, in a fixed mix, and the run prints
+throughput and p50/p99 latency per endpoint:
+
+    python db_seed_script.py --users 100000
+    python loadtest.py --threads 16 --seconds 30
+
+By default requests go through the Flask test client in this process,
+against a copy of --database, so every run starts from the same data and the
+same --seed replays the same requests. With --url they go over HTTP to a
+running server instead (which writes to its own database); clients log in
+as seeded users with --password. Start that server with RATE_LIMIT_BACKEND=
+(empty), since every client shares one IP and most writes would get 429s.
+Uploads from create_post land in the upload folder; `flask sweep-uploads`
+removes them once the copy is gone.
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from PIL import Image
+
+from bench_db import percentile
+
+DEFAULT_MIX = {'index': 40, 'explore': 20, 'profile': 20, 'like': 15, 'create': 5}
+SAMPLE_ROWS = 10000  # users and posts the clients pick from
+
+
+def parse_mix(value):
+    """Parses 'index=40,like=20,...' into {endpoint: weight}"""
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown endpoint {name!r}, expected one of {", ".join(DEFAULT_MIX)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def sample_ids(database, seed):
+    """Returns (user ids and usernames, post ids) sampled from a database"""
+    connection = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        users = connection.execute('SELECT id, username FROM user ORDER BY id').fetchall()
+        post_ids = [post_id for (post_id,) in connection.execute('SELECT id FROM post ORDER BY id')]
+    finally:
+        connection.close()
+    if not users or not post_ids:
+        raise SystemExit('Seed the database first: python db_seed_script.py --users 10000')
+    rng = random.Random(seed)
+    return rng.sample(users, min(SAMPLE_ROWS, len(users))), rng.sample(post_ids, min(SAMPLE_ROWS, len(post_ids)))
+
+
+def sample_upload(rng):
+    """A small JPEG, different for every request so each create stores a new blob"""
+    image = Image.new('RGB', (480, 480), tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=80)
+    return buffer.getvalue()
+
+
+class TestClient:
+    """Drives the app in this process; logging in just sets the session"""
+
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = user_id
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data=None, image=None):
+        data = dict(data or {})
+        if image is not None:
+            data['image'] = (io.BytesIO(image), 'photo.jpg')
+        return self.client.post(path, data=data, content_type='multipart/form-data').status_code
+
+
+class HttpClient:
+    """Drives a running server over HTTP with its own cookie jar; redirects are not followed"""
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args):
+            return None
+
+    def __init__(self, base_url, username, password):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirect)
+        if self.post('/login', {'username': username, 'password': password}) != 302:
+            raise SystemExit(f'Could not log in as {username}')
+
+    def request(self, path, body=None, content_type=None):
+        request = urllib.request.Request(self.base_url + path, data=body)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    def get(self, path):
+        return self.request(path)
+
+    def post(self, path, data=None, image=None):
+        boundary = uuid.uuid4().hex
+        parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+                 for name, value in (data or {}).items()]
+        if image is not None:
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="photo.jpg"\r\n'
+                         f'Content-Type: image/jpeg\r\n\r\n'.encode() + image + b'\r\n')
+        body = b''.join(parts) + f'--{boundary}--\r\n'.encode()
+        return self.request(path, body, f'multipart/form-data; boundary={boundary}')
+
+
+def run(args, make_client, users, post_ids):
+    """Runs the clients and returns {endpoint: {'latencies': [...], 'errors': n}}"""
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    results = {name: {'latencies': [], 'errors': 0} for name in names}
+    lock = threading.Lock()
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.seconds
+
+    def client_loop(number):
+        # Clients sharing a user like disjoint posts, so two requests never race on one like
+        rng = random.Random(f'{args.seed}:{number}')
+        user_id, username = users[number % len(users)]
+        sharing = -(-args.threads // len(users))
+        own_posts = post_ids[number // len(users) % sharing::sharing] or post_ids
+        client = make_client(user_id, username)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            if name == 'index':
+                request, expected = (lambda: client.get('/')), 200
+            elif name == 'explore':
+                request, expected = (lambda: client.get('/explore')), 200
+            elif name == 'profile':
+                path = '/profile/' + urllib.parse.quote(rng.choice(users)[1])
+                request, expected = (lambda: client.get(path)), 200
+            elif name == 'like':
+                path = f'/like/{rng.choice(own_posts)}'
+                request, expected = (lambda: client.post(path)), 302
+            else:
+                image = sample_upload(rng)
+                request, expected = (lambda: client.post('/create', {'caption': 'Load test #loadtest'}, image)), 302
+            request_started = time.perf_counter()
+            status = request()
+            elapsed = time.perf_counter() - request_started
+            if request_started >= measure_from:
+                with lock:
+                    results[name]['latencies'].append(elapsed)
+                    if status != expected:
+                        results[name]['errors'] += 1
+
+    threads = [threading.Thread(target=client_loop, args=(number,)) for number in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def report(results, seconds):
+    total = sum(len(result['latencies']) for result in results.values())
+    print(f"{'endpoint':<10} {'requests':>9} {'req/s':>8} {'p50':>9} {'p99':>9} {'errors':>7}")
+    for name, result in results.items():
+        latencies = result['latencies']
+        print(f"{name:<10} {len(latencies):>9} {len(latencies) / seconds:>8.1f} "
+              f"{percentile(latencies, 0.5) * 1000:>7.1f}ms {percentile(latencies, 0.99) * 1000:>7.1f}ms "
+              f"{result['errors']:>7}")
+    print(f"{'total':<10} {total:>9} {total / seconds:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=30, help='measured duration')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of requests before measuring')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='endpoint weights, e.g. index=40,explore=20,profile=20,like=15,create=5')
+    parser.add_argument('--database', default=os.path.join('instance', 'photogram.db'))
+    parser.add_argument('--url', help='load a running server, e.g. http://127.0.0.1:5000, instead of this process')
+    parser.add_argument('--password', default='password123', help='password of the seeded users (with --url)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the raw latencies to this file')
+    args = parser.parse_args()
+
+    users, post_ids = sample_ids(args.database, args.seed)
+    if args.url:
+        results = run(args, lambda user_id, username: HttpClient(args.url, username, args.password), users, post_ids)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'photogram.db')
+            shutil.copy(args.database, database)
+            os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+            os.environ.setdefault('LIKE_QUEUE_PATH', os.path.join(directory, 'like_queue.db'))
+            os.environ.setdefault('RATE_LIMIT_BACKEND', '')  # Every client shares one IP
+            from app import app  # Reads DATABASE_URL when imported
+            app.logger.disabled = True  # Failed requests log full tracebacks
+            results = run(args, lambda user_id, username: TestClient(app, user_id), users, post_ids)
+
+    report(results, args.seconds)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'args': {key: value for key, value in vars(args).items() if key != 'json'},
+                       'results': results}, output)
+
+
+if __name__ == '__main__':
+    main()
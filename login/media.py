@@ -0,0 +1,300 @@
+"""Image processing for uploaded photos.
+
+Every upload is re-encoded off the request thread into a set of resized WebP
+variants named `<name>_<variant>.webp` next to the original. Re-encoding
+drops EXIF/GPS metadata; orientation is applied to the pixels first so nothing
+is lost by stripping it. Templates ask for a variant with the `file_url`
+filter and fall back to the original until the variant exists.
+
+Originals are public too, so strip_metadata() cleans them as they are stored.
+It copies the file's structure without decoding any pixels: EXIF, XMP and
+IPTC segments and text chunks are left out, and so are comments and any
+chunk it does not know to be harmless. A JPEG keeps just its orientation tag.
+"""
+import logging
+import os
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from PIL import Image, ImageOps
+
+# name -> (width in pixels, crop to a square)
+VARIANTS = {
+    'thumb': (320, True),
+    'feed': (1080, False),
+    'full': (2048, False),
+}
+VARIANT_FORMAT = 'WEBP'
+VARIANT_EXT = '.webp'
+VARIANT_QUALITY = 80
+
+logger = logging.getLogger(__name__)
+
+
+# Leading bytes of each accepted image format -> stored file extension
+SIGNATURES = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+
+
+def sniff_image_type(head):
+    """Returns the extension for an image's first bytes, or None if it is not one we accept"""
+    for signature, ext in SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def strip_metadata(source, destination):
+    """Copies an image from one file object to another without its metadata; raises ValueError if malformed"""
+    head = source.read(8)
+    source.seek(0)
+    ext = sniff_image_type(head)
+    if ext == '.jpg':
+        _strip_jpeg(source, destination)
+    elif ext == '.png':
+        _strip_png(source, destination)
+    elif ext == '.gif':
+        _strip_gif(source, destination)
+    else:
+        raise ValueError('not a supported image')
+
+
+def _read(source, size):
+    data = source.read(size)
+    if len(data) != size:
+        raise ValueError('truncated image')
+    return data
+
+
+# Application segments a JPEG needs to decode correctly: JFIF, ICC colour profiles and Adobe colour transforms
+JPEG_KEEP = {0xE0: (b'JFIF\0', b'JFXX\0'), 0xE2: (b'ICC_PROFILE\0',), 0xEE: (b'Adobe',)}
+ORIENTATION = 0x0112
+
+
+def _strip_jpeg(source, destination):
+    if _read(source, 2) != b'\xff\xd8':
+        raise ValueError('not a JPEG')
+    destination.write(b'\xff\xd8')
+    while True:
+        if _read(source, 1) != b'\xff':
+            raise ValueError('bad JPEG marker')
+        marker = source.read(1)
+        while marker == b'\xff':  # Fill bytes
+            marker = source.read(1)
+        if not marker:
+            raise ValueError('truncated image')
+        marker = marker[0]
+        if marker == 0xD9 or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            destination.write(bytes((0xFF, marker)))  # No payload
+            if marker == 0xD9:
+                return
+            continue
+        length = struct.unpack('>H', _read(source, 2))[0]
+        payload = _read(source, length - 2)
+        if marker == 0xE1 and payload.startswith(b'Exif\0\0'):
+            # Keep only the orientation, which browsers apply when showing the original
+            exif = Image.Exif()
+            try:
+                exif.load(payload)
+                orientation = exif.get(ORIENTATION)
+            except Exception:
+                orientation = None  # Unreadable EXIF is dropped whole
+            if orientation and orientation != 1:
+                minimal = Image.Exif()
+                minimal[ORIENTATION] = orientation
+                payload = minimal.tobytes()
+                destination.write(b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload)
+        elif marker == 0xFE or (0xE0 <= marker <= 0xEF and not payload.startswith(JPEG_KEEP.get(marker, ()))):
+            pass  # Comments and other application segments: EXIF, XMP, IPTC, maker notes
+        else:
+            destination.write(bytes((0xFF, marker)) + struct.pack('>H', length) + payload)
+        if marker == 0xDA:
+            shutil.copyfileobj(source, destination)  # Entropy-coded data through to the end
+            return
+
+
+# Chunks that affect how a PNG (or APNG) looks; text, time and EXIF chunks are dropped
+PNG_KEEP = {b'IHDR', b'PLTE', b'IDAT', b'IEND', b'tRNS', b'gAMA', b'cHRM', b'sRGB', b'iCCP', b'sBIT',
+            b'bKGD', b'pHYs', b'acTL', b'fcTL', b'fdAT'}
+
+
+def _strip_png(source, destination):
+    destination.write(_read(source, 8))
+    while True:
+        header = _read(source, 8)
+        length, kind = struct.unpack('>I', header[:4])[0], header[4:]
+        body = _read(source, length + 4)  # Data and CRC
+        if kind in PNG_KEEP:
+            destination.write(header + body)
+        if kind == b'IEND':
+            return
+
+
+# Application extensions a GIF needs: animation loop counts
+GIF_KEEP_APPLICATIONS = (b'NETSCAPE2.0', b'ANIMEXTS1.0')
+
+
+def _copy_sub_blocks(source, destination=None):
+    while True:
+        size = _read(source, 1)
+        block = _read(source, size[0])
+        if destination is not None:
+            destination.write(size + block)
+        if size == b'\0':
+            return
+
+
+def _strip_gif(source, destination):
+    header = _read(source, 13)  # Signature and logical screen descriptor
+    destination.write(header)
+    if header[10] & 0x80:
+        destination.write(_read(source, 3 << ((header[10] & 0x07) + 1)))  # Global colour table
+    while True:
+        introducer = _read(source, 1)
+        if introducer == b'\x3b':  # Trailer
+            destination.write(introducer)
+            return
+        if introducer == b'\x2c':  # Image
+            descriptor = _read(source, 9)
+            destination.write(introducer + descriptor)
+            if descriptor[8] & 0x80:
+                destination.write(_read(source, 3 << ((descriptor[8] & 0x07) + 1)))  # Local colour table
+            destination.write(_read(source, 1))  # LZW minimum code size
+            _copy_sub_blocks(source, destination)
+        elif introducer == b'\x21':
+            label = _read(source, 1)
+            if label == b'\xff':
+                size = _read(source, 1)
+                identifier = _read(source, size[0])
+                keep = identifier in GIF_KEEP_APPLICATIONS
+                if keep:
+                    destination.write(introducer + label + size + identifier)
+                _copy_sub_blocks(source, destination if keep else None)
+            elif label == b'\xfe':  # Comment
+                _copy_sub_blocks(source)
+            else:  # Graphic control and plain text
+                destination.write(introducer + label)
+                _copy_sub_blocks(source, destination)
+        else:
+            raise ValueError('bad GIF block')
+
+
+def variant_name(filename, variant):
+    stem = os.path.splitext(filename)[0]
+    return f"{stem}_{variant}{VARIANT_EXT}"
+
+
+def is_variant(filename):
+    return any(filename.endswith(f"_{variant}{VARIANT_EXT}") for variant in VARIANTS)
+
+
+class ImagePipeline:
+    def __init__(self, upload_folder, max_workers=2):
+        self.upload_folder = upload_folder
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='images')
+        self.ready = set()  # originals whose variants are all on disk
+        self.kept = set()  # originals served as uploaded, without variants (animated GIFs)
+        self.pending = {}  # original -> Future, so each upload is processed once at a time
+        self.lock = Lock()
+
+    def path(self, filename):
+        return os.path.join(self.upload_folder, filename)
+
+    def submit(self, filename):
+        """Queues an upload for processing and returns the Future"""
+        with self.lock:
+            if filename in self.pending:
+                return self.pending[filename]
+            future = self.executor.submit(self.process, filename)
+            self.pending[filename] = future
+        future.add_done_callback(lambda done: self._finished(filename, done))
+        return future
+
+    def _finished(self, filename, future):
+        with self.lock:
+            self.pending.pop(filename, None)
+        if not future.cancelled() and future.exception():
+            logger.warning('Could not process %s: %s', filename, future.exception())
+
+    def process(self, filename):
+        """Writes every variant of an upload; returns the variant names written"""
+        with Image.open(self.path(filename)) as original:
+            if getattr(original, 'is_animated', False):
+                self.kept.add(filename)
+                return []  # Keep animated GIFs as uploaded
+            # Palette and greyscale images may mark a transparent colour rather than carry alpha
+            alpha = 'A' in original.getbands() or 'transparency' in original.info
+            image = ImageOps.exif_transpose(original)
+            image = image.convert('RGBA' if alpha else 'RGB')
+
+        written = []
+        for variant, (width, square) in VARIANTS.items():
+            if square:
+                resized = ImageOps.fit(image, (width, width), Image.LANCZOS)
+            else:
+                resized = image.copy()
+                resized.thumbnail((width, width * 4), Image.LANCZOS)
+
+            # Write to a temporary name and rename so readers never see a partial file
+            name = variant_name(filename, variant)
+            temp_path = self.path(name) + '.tmp'
+            resized.save(temp_path, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+            os.replace(temp_path, self.path(name))
+            written.append(name)
+
+        self.ready.add(filename)
+        return written
+
+    def available(self, filename):
+        """Returns {variant: name} for the variants of an upload that exist on disk"""
+        if filename in self.ready:
+            return {variant: variant_name(filename, variant) for variant in VARIANTS}
+        if filename in self.kept:
+            return {}
+        found = {
+            variant: variant_name(filename, variant)
+            for variant in VARIANTS
+            if os.path.exists(self.path(variant_name(filename, variant)))
+        }
+        if len(found) == len(VARIANTS):
+            self.ready.add(filename)
+        elif not found and os.path.splitext(filename)[1].lower() == '.gif' and self.is_animated(filename):
+            self.kept.add(filename)  # Found once per process, then answered from memory
+        return found
+
+    def is_animated(self, filename):
+        try:
+            with Image.open(self.path(filename)) as image:
+                return getattr(image, 'is_animated', False)
+        except (OSError, Image.DecompressionBombError):
+            return False
+
+    def done(self, filename):
+        """Whether an upload needs no more processing: its variants exist, or it is kept as uploaded"""
+        return len(self.available(filename)) == len(VARIANTS) or filename in self.kept
+
+    def originals(self):
+        """Yields every uploaded original (relative to the upload folder)"""
+        for root, _, files in os.walk(self.upload_folder):
+            for name in sorted(files):
+                if name.startswith('.') or name.endswith('.tmp') or is_variant(name):
+                    continue
+                yield os.path.relpath(os.path.join(root, name), self.upload_folder).replace(os.sep, '/')
+
+    def backfill(self):
+        """Processes every original that is missing variants; returns (done, failed)"""
+        pending = [name for name in self.originals() if not self.done(name)]
+        done, failed = 0, []
+        for name, future in [(name, self.submit(name)) for name in pending]:
+            try:
+                future.result()
+                done += 1
+            except (OSError, Image.DecompressionBombError) as error:
+                failed.append((name, error))
+        return done, failed
@@ -0,0 +1,217 @@
+"""Versioned, in-place schema upgrades for existing databases.
+
+db.create_all() only creates missing tables; it never adds columns or indexes
+to tables that already exist. Each migration below brings an existing database
+one step closer to the current models, and the schema_version table records
+how far a database has got. A brand new database is created from the models
+and stamped with the latest version instead.
+
+Migrations use plain SQL rather than the models so that they keep describing
+the schema as it was at the time, whatever the models look like later.
+
+Several processes may start against one database at once, as ASGI workers
+do. Each step takes the database's write lock and re-reads the version
+before applying anything, so between them they apply every migration once.
+"""
+from datetime import datetime
+import math
+
+from sqlalchemy import inspect, text
+
+from search import extract_hashtags
+
+MIGRATIONS = []  # (version, description, function taking a connection)
+
+
+def migration(version, description):
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return function
+    return register
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(connection):
+    connection.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    version = connection.execute(text('SELECT MAX(version) FROM schema_version')).scalar()
+    return version or 0
+
+
+def set_version(connection, version):
+    connection.execute(text('DELETE FROM schema_version'))
+    connection.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+
+
+def lock(connection):
+    """Takes a lock that other processes migrating the database wait on, held until the transaction ends"""
+    if connection.dialect.name == 'sqlite':
+        # pysqlite defers BEGIN to the first write; take the write lock before reading instead
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+    elif connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(7461)'))
+
+
+def stamp(connection):
+    """Marks a database created from the current models as fully migrated"""
+    current_version(connection)
+    set_version(connection, latest_version())
+
+
+def upgrade(engine, log=print):
+    """Applies every pending migration, each in its own transaction"""
+    with engine.begin() as connection:
+        version = current_version(connection)
+    for target, description, function in MIGRATIONS:
+        if target <= version:
+            continue
+        with engine.begin() as connection:
+            lock(connection)
+            version = current_version(connection)  # Another process may have got here first
+            if target <= version:
+                continue
+            log(f'Migrating database to version {target}: {description}')
+            function(connection)
+            set_version(connection, target)
+        version = target
+    return version
+
+
+def add_column(connection, table, column, definition):
+    """ALTER TABLE ADD COLUMN, skipped if the column already exists"""
+    existing = {info['name'] for info in inspect(connection).get_columns(table)}
+    if column not in existing:
+        connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}'))
+
+
+def reconcile_counters(connection):
+    connection.execute(text(
+        'UPDATE post SET '
+        'like_count = (SELECT COUNT(*) FROM "like" WHERE "like".post_id = post.id), '
+        'comment_count = (SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)'
+    ))
+    connection.execute(text(
+        'UPDATE "user" SET '
+        'follower_count = (SELECT COUNT(*) FROM follow WHERE follow.followed_id = "user".id), '
+        'following_count = (SELECT COUNT(*) FROM follow WHERE follow.follower_id = "user".id), '
+        'post_count = (SELECT COUNT(*) FROM post WHERE post.user_id = "user".id)'
+    ))
+
+
+@migration(1, 'denormalized like/comment/follow/post counters')
+def add_counters(connection):
+    for table, column in [('post', 'like_count'), ('post', 'comment_count'),
+                          ('user', 'follower_count'), ('user', 'following_count'),
+                          ('user', 'post_count')]:
+        add_column(connection, table, column, 'INTEGER NOT NULL DEFAULT 0')
+    reconcile_counters(connection)
+
+
+@migration(2, 'indexes for feed, profile, comment, like and follow lookups')
+def add_lookup_indexes(connection):
+    # Duplicate follows were possible before the unique index; keep the oldest row of each pair
+    connection.execute(text(
+        'DELETE FROM follow WHERE id NOT IN '
+        '(SELECT MIN(id) FROM follow GROUP BY follower_id, followed_id)'
+    ))
+    for statement in [
+        'CREATE INDEX IF NOT EXISTS ix_post_created_at_id ON post (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_post_user_created ON post (user_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_comment_post_created ON comment (post_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_like_post_user ON "like" (post_id, user_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_follow_follower_followed ON follow (follower_id, followed_id)',
+        'CREATE INDEX IF NOT EXISTS ix_follow_followed_follower ON follow (followed_id, follower_id)',
+    ]:
+        connection.execute(text(statement))
+    reconcile_counters(connection)
+
+
+@migration(3, 'trending score column and index')
+def add_trend_score(connection):
+    add_column(connection, 'post', 'trend_score', 'FLOAT NOT NULL DEFAULT 0')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_post_trend_score ON post (trend_score, id)'))
+    # Approximate each post's events as happening when it was posted, with the
+    # weights and six-hour half-life of the time; recompute-trending refines it
+    epoch, tau = datetime(2024, 1, 1), 6 * 3600 / math.log(2)
+    rows = connection.execute(text('SELECT id, created_at, like_count, comment_count FROM post')).fetchall()
+    scores = []
+    for post_id, created_at, like_count, comment_count in rows:
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at)
+        age = ((created_at or epoch) - epoch).total_seconds()
+        scores.append({'id': post_id, 'score': math.log(1 + like_count + 2 * comment_count) + age / tau})
+    if scores:
+        connection.execute(text('UPDATE post SET trend_score = :score WHERE id = :id'), scores)
+
+
+@migration(4, 'hashtags extracted from captions')
+def add_hashtags(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS hashtag (id INTEGER NOT NULL PRIMARY KEY, '
+        'name VARCHAR(100) NOT NULL UNIQUE, post_count INTEGER NOT NULL DEFAULT 0)'
+    ))
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS post_hashtag (hashtag_id INTEGER NOT NULL REFERENCES hashtag (id), '
+        'post_id INTEGER NOT NULL REFERENCES post (id), PRIMARY KEY (hashtag_id, post_id))'
+    ))
+    tags = {}
+    for post_id, caption in connection.execute(text('SELECT id, caption FROM post')):
+        for name in extract_hashtags(caption):
+            tags.setdefault(name, []).append(post_id)
+    # The tables are new (or were just created empty from the models), so nothing conflicts
+    for name, post_ids in tags.items():
+        connection.execute(text('INSERT INTO hashtag (name, post_count) VALUES (:name, :count)'),
+                           {'name': name, 'count': len(post_ids)})
+        tag_id = connection.execute(text('SELECT id FROM hashtag WHERE name = :name'), {'name': name}).scalar()
+        connection.execute(text('INSERT INTO post_hashtag (hashtag_id, post_id) VALUES (:tag, :post)'),
+                           [{'tag': tag_id, 'post': post_id} for post_id in post_ids])
+
+
+@migration(5, 'activity log and notification inboxes')
+def add_notifications(connection):
+    add_column(connection, 'user', 'unread_notifications', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(connection, 'user', 'notifications_read_at', 'DATETIME')
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS activity_event (id INTEGER NOT NULL PRIMARY KEY, '
+        'recipient_id INTEGER NOT NULL REFERENCES "user" (id), actor_id INTEGER NOT NULL REFERENCES "user" (id), '
+        'kind VARCHAR(10) NOT NULL, post_id INTEGER REFERENCES post (id), created_at DATETIME NOT NULL)'
+    ))
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS activity_cursor (name VARCHAR(50) NOT NULL PRIMARY KEY, '
+        'event_id INTEGER NOT NULL DEFAULT 0)'
+    ))
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS notification (id INTEGER NOT NULL PRIMARY KEY, '
+        'user_id INTEGER NOT NULL REFERENCES "user" (id), kind VARCHAR(10) NOT NULL, '
+        'post_id INTEGER REFERENCES post (id), actor_id INTEGER NOT NULL REFERENCES "user" (id), '
+        'actor_count INTEGER NOT NULL DEFAULT 1, created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_activity_event_created ON activity_event (created_at)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_notification_user_updated ON notification (user_id, updated_at, id)'
+    ))
+
+
+@migration(6, 'flag authors whose posts skipped fan-out')
+def add_fanout_skipped(connection):
+    add_column(connection, 'user', 'fanout_skipped', 'BOOLEAN NOT NULL DEFAULT 0')
+    # Authors above the default FANOUT_FOLLOWER_LIMIT of the time may have skipped posts in hybrid mode
+    connection.execute(text('UPDATE "user" SET fanout_skipped = 1 WHERE follower_count >= 10000'))
+
+
+@migration(7, 'claim activity events with a flag instead of a log position')
+def add_activity_folded(connection):
+    add_column(connection, 'activity_event', 'folded', 'BOOLEAN NOT NULL DEFAULT 0')
+    connection.execute(text(
+        'UPDATE activity_event SET folded = 1 WHERE id <= '
+        "COALESCE((SELECT event_id FROM activity_cursor WHERE name = 'notifications'), 0)"
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_activity_event_folded ON activity_event (folded, id)'
+    ))
+    connection.execute(text('DROP TABLE IF EXISTS activity_cursor'))
@@ -0,0 +1,110 @@
+"""Activity notifications, aggregated in batches at write time.
+
+Likes, comments and follows append a row to an activity log in the same
+transaction as the action itself, and do nothing else on the request path.
+An aggregator thread folds new log entries into each recipient's inbox a
+batch at a time, so a burst of fifty likes on one post costs one inbox write
+instead of fifty:
+
+- Events in a batch are grouped by (recipient, kind, post); collapse() turns
+  each group into its distinct actors, most recent last.
+- A group merges into the recipient's open notification for the same key,
+  one that is still unread, or else becomes a new one. Once read, a
+  notification never changes; later likes start a fresh "bob liked your
+  post" instead of resurfacing an old one.
+- A notification stores its latest actor and a count of actors, which is all
+  "alice and 41 others liked your post" needs. Counts are of distinct actors
+  within each batch, so someone who likes, unlikes and likes again across
+  batches is counted twice.
+
+Each batch claims its events by flagging them folded in the batch's own
+transaction, with an UPDATE that only matches events not yet flagged. Several
+processes can run aggregators against one database and each event is folded
+in exactly once, even on databases where events may commit out of id order,
+since no position in the log is ever skipped past. Unlikes and unfollows are
+not retracted from inboxes.
+"""
+import logging
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+VERBS = {'like': 'liked your post', 'comment': 'commented on your post', 'follow': 'started following you'}
+
+Group = namedtuple('Group', 'actor_ids first_at')
+
+
+def collapse(events):
+    """Groups (recipient_id, actor_id, kind, post_id, created_at) events, oldest first,
+    into {(recipient_id, kind, post_id): Group}"""
+    groups = {}
+    for recipient_id, actor_id, kind, post_id, created_at in events:
+        key = (recipient_id, kind, post_id)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = Group([actor_id], created_at)
+            continue
+        # Keep each actor once, in order of their latest event
+        if actor_id in group.actor_ids:
+            group.actor_ids.remove(actor_id)
+        group.actor_ids.append(actor_id)
+    return groups
+
+
+def merged_count(actor_count, latest_actor_id, actor_ids):
+    """An open notification's actor count after a group's actors are folded into it"""
+    return actor_count + sum(1 for actor_id in actor_ids if actor_id != latest_actor_id)
+
+
+def describe(kind, actor_name, actor_count):
+    """'alice liked your post', or 'alice and 41 others liked your post'"""
+    others = actor_count - 1
+    if others <= 0:
+        return f'{actor_name} {VERBS[kind]}'
+    return f"{actor_name} and {others} other{'' if others == 1 else 's'} {VERBS[kind]}"
+
+
+class ActivityAggregator:
+    def __init__(self, aggregate, interval=2.0, batch_size=1000):
+        self.aggregate = aggregate  # batch_size -> events folded in, raises to retry later
+        self.interval = interval
+        self.batch_size = batch_size
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def drain(self):
+        """Folds batches in until the log is caught up; returns events folded in"""
+        folded = 0
+        while True:
+            count = self.aggregate(self.batch_size)
+            folded += count
+            if count < self.batch_size:
+                return folded
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.drain()
+            except Exception:
+                # Events are only flagged when a batch commits, so it is retried next tick
+                logger.exception('Could not aggregate activity')
+
+    def start(self):
+        """Starts the background thread, once"""
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='notifications', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,51 @@
+"""Password hashing off the request threads, with tunable cost.
+
+Hashing is slow on purpose, and a burst of logins hashing on every request
+thread at once can leave nothing to serve feeds with. PasswordHasher runs
+hashes on a small thread pool instead. The pool bounds how many run at once,
+and `max_pending` bounds how many may wait: past that, callers get HasherBusy
+straight away rather than queueing behind the burst.
+
+Hashes use werkzeug's format, `method$salt$hash`, where the method carries the
+cost (e.g. `pbkdf2:sha256:260000`). verify() reports when a stored hash was
+made with other settings, so the caller can store a fresh hash while it still
+has the plain password. Raising the cost therefore upgrades accounts as their
+owners log in.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Too many hashes are already waiting"""
+
+
+class PasswordHasher:
+    def __init__(self, method='pbkdf2:sha256:260000', salt_length=16, workers=2, max_pending=32):
+        self.method = method
+        self.salt_length = salt_length
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self.executor.submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        """Returns (whether the password matches, whether the hash should be redone with current settings)"""
+        matches = self.run(check_password_hash, password_hash, password)
+        return matches, matches and not self.is_current(password_hash)
+
+    def is_current(self, password_hash):
+        method, _, rest = password_hash.partition('$')
+        salt = rest.partition('$')[0]
+        return method == self.method and len(salt) == self.salt_length
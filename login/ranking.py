@@ -0,0 +1,100 @@
+"""Time-decayed trending scores for posts.
+
+A post's trending value is the sum of its events (being posted, likes,
+comments), each weighted and decayed exponentially with its age:
+
+    value(now) = sum(weight * 2 ** -((now - event time) / half_life))
+
+Every post decays by the same factor as time passes, so the ranking only
+depends on value(now) * 2 ** ((now - epoch) / half_life), which no longer
+changes with `now`. Its logarithm is what gets stored:
+
+    score = log(sum(weight * e ** ((event time - epoch) / tau)))   tau = half_life / ln 2
+
+A new event adds its own point, log(weight) + (event time - epoch) / tau, by
+log-add-exp, which keeps the numbers small for any number of events and any
+date. The result is a plain column that can be indexed, updated atomically
+in SQL and sorted on without scanning the table.
+"""
+import math
+from bisect import bisect_left, insort
+from datetime import datetime
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:  # Batch recomputes fall back to pure Python
+    np = None
+
+EPOCH = datetime(2024, 1, 1)
+
+
+def trend_point(at, weight, half_life):
+    """The log-space contribution of one event of `weight` at time `at` (half_life in seconds)"""
+    return math.log(weight) + (at - EPOCH).total_seconds() * math.log(2) / half_life
+
+
+def group_logsumexp(groups, points):
+    """Returns {group: log(sum(exp(point)))} for parallel sequences of group keys and points"""
+    if not points:
+        return {}
+    if np is not None:
+        keys, index = np.unique(np.asarray(groups), return_inverse=True)
+        points = np.asarray(points, dtype=float)
+        # Shift by each group's maximum so exp() never overflows or underflows to zero
+        peaks = np.full(len(keys), -np.inf)
+        np.maximum.at(peaks, index, points)
+        totals = np.bincount(index, weights=np.exp(points - peaks[index]), minlength=len(keys))
+        return dict(zip(keys.tolist(), (peaks + np.log(totals)).tolist()))
+
+    peaks = {}
+    for group, point in zip(groups, points):
+        peaks[group] = max(point, peaks.get(group, point))
+    totals = {}
+    for group, point in zip(groups, points):
+        totals[group] = totals.get(group, 0.0) + math.exp(point - peaks[group])
+    return {group: peaks[group] + math.log(total) for group, total in totals.items()}
+
+
+class TopK:
+    """The k highest (score, id) pairs, kept sorted in a bounded list
+
+    Writes offer new scores as they happen; anything that falls out of the
+    top k is forgotten, and reload() replaces the whole list from the
+    database index to pick up changes made by other processes.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.entries = []  # ascending (-score, id), i.e. best first
+        self.scores = {}  # id -> score for ids in entries
+        self.loaded_at = None
+        self.lock = Lock()
+
+    def offer(self, item_id, score):
+        with self.lock:
+            if item_id in self.scores:
+                self.entries.pop(bisect_left(self.entries, (-self.scores.pop(item_id), item_id)))
+            elif len(self.entries) >= self.k and -score >= self.entries[-1][0]:
+                return  # Not good enough to enter a full list
+            insort(self.entries, (-score, item_id))
+            self.scores[item_id] = score
+            if len(self.entries) > self.k:
+                _, dropped = self.entries.pop()
+                del self.scores[dropped]
+
+    def reload(self, pairs, now):
+        """Replaces the contents with (id, score) pairs, e.g. the top k rows of the index"""
+        entries = sorted((-score, item_id) for item_id, score in pairs)[:self.k]
+        with self.lock:
+            self.entries = entries
+            self.scores = {item_id: -negated for negated, item_id in entries}
+            self.loaded_at = now
+
+    def page(self, offset=0, limit=10):
+        """Returns ids ranked offset..offset+limit, best first"""
+        with self.lock:
+            return [item_id for _, item_id in self.entries[offset:offset + limit]]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,100 @@
+"""Token-bucket rate limiting.
+
+A bucket holds up to `burst` tokens and refills at `rate` tokens per second;
+each request takes one token, and a request that finds the bucket empty is
+refused along with the number of seconds until a token is back. A bucket is
+just (tokens, last update), refilled lazily when it is next used, so idle
+buckets cost nothing but their entry.
+
+Two stores share one interface:
+
+- MemoryBuckets keeps buckets in this process, evicting the least recently
+  used beyond `max_entries`. An evicted bucket comes back full, so the limit
+  should be large enough to hold every client that is busy at once.
+- SqliteBuckets keeps them in a local SQLite file, so all worker processes on
+  one host share each client's budget. Buckets idle long enough to have
+  refilled are deleted in passing.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def take(tokens, rate):
+    """Returns (tokens left, seconds to wait) for a request against a refilled bucket"""
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from a bucket; returns 0 if allowed, else the seconds until it would be"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens, wait = take(refill(tokens, updated, now, rate, burst), rate)
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class SqliteBuckets:
+    def __init__(self, path, max_idle=3600):
+        self.path = path
+        self.max_idle = max_idle  # seconds after which any bucket has refilled and can be dropped
+        self.local = threading.local()
+        self.writes = 0
+        connection = self.connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL) WITHOUT ROWID'
+        )
+
+    def connect(self):
+        # One connection per thread; sqlite3 connections are not shareable across threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA synchronous=OFF')  # Losing the last few buckets in a crash is harmless
+            self.local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens, wait = take(refill(tokens, updated, now, rate, burst), rate)
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, tokens, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        # Trimming on every request would double its cost, so trim every 1000 requests
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            connection.execute('DELETE FROM bucket WHERE updated < ?', (now - self.max_idle,))
+        return wait
+
+    def clear(self):
+        self.connect().execute('DELETE FROM bucket')
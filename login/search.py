@@ -0,0 +1,213 @@
+"""Full-text search over captions, comments and users.
+
+Both indexes share one interface so app.py can switch between them with the
+SEARCH_BACKEND setting:
+
+- FtsSearchIndex uses SQLite FTS5. Captions and comments are indexed as
+  external-content tables, so the index holds only tokens and reads text
+  from the post and comment tables; it adds little to the database size.
+  Usernames and bios get a small table of their own with a prefix index,
+  which makes username autocomplete a lookup rather than a scan.
+- LikeSearchIndex needs no extra tables and matches with LIKE. It works on
+  any SQLite build and on other databases but scans, so it only suits
+  small databases.
+
+Ranking looks at the newest `max_candidates` matches of a query and orders
+those by relevance (BM25 for FTS5). Taking the newest matches first is one
+walk down the index, so a common word costs the same whether it occurs in a
+thousand captions or in millions, and the results favour recent posts.
+
+The app writes to the index in the same transaction as the rows it covers
+(see index_post, index_comment and index_user in app.py).
+"""
+import re
+
+from sqlalchemy import text
+
+HASHTAG = re.compile(r'(?<![\w#])#(\w{1,100})')
+TERM = re.compile(r'\w+')
+MAX_TERMS = 8
+COMMENT_WEIGHT = 0.5  # a match in a comment counts half as much as one in the caption
+
+FTS_TABLES = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+    "caption, content='post', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS comment_fts USING fts5("
+    "content, post_id UNINDEXED, content='comment', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    # '_' is part of a username, and the prefix index answers autocomplete for up to 3 characters
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5("
+    "username, bio, tokenize=\"unicode61 remove_diacritics 2 tokenchars '_'\", prefix='1 2 3')",
+]
+
+
+def extract_hashtags(caption):
+    """Returns the distinct lowercase hashtags in a caption, in order of appearance"""
+    return list(dict.fromkeys(tag.lower() for tag in HASHTAG.findall(caption or '')))
+
+
+def query_terms(query):
+    """Splits a search box query into at most MAX_TERMS lowercase words"""
+    return [term.lower() for term in TERM.findall(query or '')][:MAX_TERMS]
+
+
+def has_fts5(connection):
+    options = {row[0] for row in connection.execute(text('PRAGMA compile_options'))}
+    return 'ENABLE_FTS5' in options
+
+
+def rank_posts(caption_scores, comment_scores):
+    """Combines {post_id: score} from captions and comments into post ids, best first"""
+    scores = dict(caption_scores)
+    for post_id, score in comment_scores.items():
+        scores[post_id] = scores.get(post_id, 0.0) + COMMENT_WEIGHT * score
+    return sorted(scores, key=lambda post_id: (-scores[post_id], -post_id))
+
+
+class FtsSearchIndex:
+    def __init__(self, session, max_candidates=1000):
+        self.session = session
+        self.max_candidates = max_candidates
+
+    def create(self):
+        """Creates the index tables if needed; returns True if they are new and need a rebuild"""
+        existed = self.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'post_fts'")).first()
+        for statement in FTS_TABLES:
+            self.session.execute(text(statement))
+        return existed is None
+
+    def rebuild(self):
+        """Re-indexes every post, comment and user from their tables"""
+        self.create()
+        self.session.execute(text("INSERT INTO post_fts (post_fts) VALUES ('rebuild')"))
+        self.session.execute(text("INSERT INTO comment_fts (comment_fts) VALUES ('rebuild')"))
+        self.session.execute(text('DELETE FROM user_fts'))
+        self.session.execute(text('INSERT INTO user_fts (rowid, username, bio) SELECT id, username, bio FROM "user"'))
+
+    def index_post(self, post_id, caption):
+        self.session.execute(text('INSERT INTO post_fts (rowid, caption) VALUES (:id, :caption)'),
+                             {'id': post_id, 'caption': caption})
+
+    def index_comment(self, comment_id, post_id, content):
+        self.session.execute(text('INSERT INTO comment_fts (rowid, content, post_id) VALUES (:id, :content, :post_id)'),
+                             {'id': comment_id, 'content': content, 'post_id': post_id})
+
+    def index_user(self, user_id, username, bio):
+        self.session.execute(text('DELETE FROM user_fts WHERE rowid = :id'), {'id': user_id})
+        self.session.execute(text('INSERT INTO user_fts (rowid, username, bio) VALUES (:id, :username, :bio)'),
+                             {'id': user_id, 'username': username, 'bio': bio or ''})
+
+    def match(self, terms, prefix=False):
+        """An FTS5 query requiring every term; quoting keeps user input out of the query syntax"""
+        phrases = [f'"{term}"' for term in terms]
+        if prefix:
+            phrases[-1] += '*'
+        return ' '.join(phrases)
+
+    def posts(self, query, offset=0, limit=10):
+        """Returns ids of posts whose caption or comments match, best first"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        params = {'match': self.match(terms), 'candidates': self.max_candidates}
+        # bm25() is lower for better matches
+        captions = {post_id: -rank for post_id, rank in self.session.execute(text(
+            'SELECT rowid, bm25(post_fts) FROM post_fts WHERE post_fts MATCH :match '
+            'ORDER BY rowid DESC LIMIT :candidates'), params)}
+        comments = {}
+        for post_id, rank in self.session.execute(text(
+                'SELECT post_id, bm25(comment_fts) FROM comment_fts WHERE comment_fts MATCH :match '
+                'ORDER BY rowid DESC LIMIT :candidates'), params):
+            comments[post_id] = max(-rank, comments.get(post_id, 0.0))
+        return rank_posts(captions, comments)[offset:offset + limit]
+
+    def users(self, query, offset=0, limit=10):
+        """Returns ids of users whose username or bio match, best first; the last word may be a prefix"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        rows = self.session.execute(text(
+            'SELECT id FROM (SELECT rowid AS id, bm25(user_fts, 10.0, 1.0) AS rank FROM user_fts '
+            'WHERE user_fts MATCH :match LIMIT :candidates) ORDER BY rank, id LIMIT :limit OFFSET :offset'
+        ), {'match': self.match(terms, prefix=True), 'candidates': self.max_candidates,
+            'limit': limit, 'offset': offset})
+        return [user_id for (user_id,) in rows]
+
+    def complete_username(self, prefix, limit=8):
+        """Returns ids of users whose username starts with prefix, most followed first"""
+        terms = query_terms(prefix)
+        if not terms:
+            return []
+        rows = self.session.execute(text(
+            'SELECT "user".id FROM (SELECT rowid AS id FROM user_fts WHERE user_fts MATCH :match '
+            'LIMIT :candidates) AS matches JOIN "user" ON "user".id = matches.id '
+            'ORDER BY "user".follower_count DESC, "user".username LIMIT :limit'
+        ), {'match': 'username : ' + self.match(terms[:1], prefix=True),
+            'candidates': self.max_candidates, 'limit': limit})
+        return [user_id for (user_id,) in rows]
+
+
+class LikeSearchIndex:
+    def __init__(self, session, max_candidates=1000):
+        self.session = session
+        self.max_candidates = max_candidates
+
+    def create(self):
+        return False
+
+    def rebuild(self):
+        pass
+
+    def index_post(self, post_id, caption):
+        pass
+
+    def index_comment(self, comment_id, post_id, content):
+        pass
+
+    def index_user(self, user_id, username, bio):
+        pass
+
+    def like(self, columns, terms, prefix=False):
+        """A WHERE clause requiring every term in one of the columns, and its parameters"""
+        clauses, params = [], {}
+        for number, term in enumerate(terms):
+            params[f'term{number}'] = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            clauses.append('(' + ' OR '.join(f"{column} LIKE :term{number} ESCAPE '\\'" for column in columns) + ')')
+        return ' AND '.join(clauses), params
+
+    def posts(self, query, offset=0, limit=10):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        where, params = self.like(['caption'], terms)
+        params['candidates'] = self.max_candidates
+        captions = {post_id: 1.0 for (post_id,) in self.session.execute(text(
+            f'SELECT id FROM post WHERE {where} ORDER BY id DESC LIMIT :candidates'), params)}
+        where, params = self.like(['content'], terms)
+        params['candidates'] = self.max_candidates
+        comments = {post_id: 1.0 for (post_id,) in self.session.execute(text(
+            f'SELECT post_id FROM comment WHERE {where} ORDER BY id DESC LIMIT :candidates'), params)}
+        return rank_posts(captions, comments)[offset:offset + limit]
+
+    def users(self, query, offset=0, limit=10):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        where, params = self.like(['username', 'bio'], terms)
+        params.update(limit=limit, offset=offset)
+        rows = self.session.execute(text(
+            f'SELECT id FROM "user" WHERE {where} ORDER BY follower_count DESC, id LIMIT :limit OFFSET :offset'
+        ), params)
+        return [user_id for (user_id,) in rows]
+
+    def complete_username(self, prefix, limit=8):
+        terms = query_terms(prefix)
+        if not terms:
+            return []
+        where, params = self.like(['username'], terms[:1])
+        params['term0'] = params['term0'][1:]  # Anchored at the start of the name
+        params['limit'] = limit
+        rows = self.session.execute(text(
+            f'SELECT id FROM "user" WHERE {where} ORDER BY follower_count DESC, username LIMIT :limit'
+        ), params)
+        return [user_id for (user_id,) in rows]
@@ -0,0 +1,65 @@
+"""Production entry point.
+
+    python serve.py --mode asgi --workers 4 --threads 32 --port 8000
+    python serve.py --mode threaded --port 8000
+
+'asgi' serves asgi.py under uvicorn (pip install -r requirements-asgi.txt)
+with --workers processes, each running Flask views on --threads threads
+while its event loop handles connections, request bodies and live streams.
+'threaded' is what `python app.py` runs, minus the debugger and reloader:
+one process with a thread per connection. bench_serving.py compares the two.
+
+Worker processes share nothing in memory. With more than one, LIVE_BROKER and
+GRAPH_VERSIONS default to 'sqlite' here so live updates reach streams held by
+any worker and follows made in one worker show in the others at once; set
+CACHE_BACKEND and RATE_LIMIT_BACKEND to 'sqlite' as well to share the page
+cache and rate limits between them.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['asgi', 'threaded'], default='asgi')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='worker processes (asgi)')
+    parser.add_argument('--threads', type=int, default=32, help='threads running Flask views per worker (asgi)')
+    parser.add_argument('--backlog', type=int, default=2048, help='pending connections the socket accepts')
+    parser.add_argument('--access-log', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    # Read by app.py when each worker imports it
+    os.environ['ASGI_THREADS'] = str(args.threads)
+    if args.workers > 1:
+        os.environ.setdefault('LIVE_BROKER', 'sqlite')
+        os.environ.setdefault('GRAPH_VERSIONS', 'sqlite')
+
+    if args.mode == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            raise SystemExit('ASGI mode needs an ASGI server: pip install -r requirements-asgi.txt')
+        # Every worker initialises the database when it imports the app; migrating
+        # here first leaves them nothing to do but check the version
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db-upgrade'], cwd=HERE, check=True)
+        uvicorn.run('asgi:application', app_dir=HERE, host=args.host, port=args.port, workers=args.workers,
+                    backlog=args.backlog, access_log=args.access_log, lifespan='on')
+    else:
+        if args.workers != 1:
+            parser.error('threaded mode runs a single process; use --mode asgi for more workers')
+        from werkzeug.serving import run_simple
+        from app import app
+        if not args.access_log:
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        run_simple(args.host, args.port, app, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
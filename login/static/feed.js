@@ -0,0 +1,55 @@
+// Infinite scroll: when the sentinel at the bottom of the feed comes into view,
+// fetch the next page fragment and swap it in place of the sentinel.
+(function () {
+    const feed = document.getElementById('feed');
+    if (!feed || !('IntersectionObserver' in window)) {
+        return;  // Fall back to the "Older posts" link
+    }
+
+    let loading = false;
+
+    const observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+            if (entry.isIntersecting) {
+                loadNext(entry.target);
+            }
+        });
+    }, { rootMargin: '600px' });
+
+    function loadNext(sentinel) {
+        if (loading) {
+            return;
+        }
+        loading = true;
+        observer.unobserve(sentinel);
+
+        fetch(sentinel.dataset.next, { credentials: 'same-origin' })
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error('Failed to load feed page');
+                }
+                return response.text();
+            })
+            .then(function (html) {
+                sentinel.insertAdjacentHTML('afterend', html);
+                sentinel.remove();
+                document.dispatchEvent(new CustomEvent('feed:page'));  // New posts to follow live
+                watch();
+            })
+            .catch(function () {
+                observer.observe(sentinel);  // Try again on the next scroll
+            })
+            .finally(function () {
+                loading = false;
+            });
+    }
+
+    function watch() {
+        const sentinel = feed.querySelector('.feed-sentinel');
+        if (sentinel) {
+            observer.observe(sentinel);
+        }
+    }
+
+    watch();
+})();
@@ -0,0 +1,247 @@
+// Progressive enhancement for likes and comments: forms marked with data-api
+// post to the JSON API and update the page in place instead of reloading it,
+// older comments load in place, search boxes suggest usernames, and like counts
+// and new comments on the posts in view arrive live. Without JavaScript, or if
+// the server cannot be reached, forms submit and links navigate as usual. A
+// visitor who is not logged in (401) is sent through the form too, which leads
+// to the login page; other errors, such as 429, show the server's message by
+// the form rather than posting it again.
+(function () {
+    function submitNormally(form) {
+        HTMLFormElement.prototype.submit.call(form);  // Skips this listener
+    }
+
+    // Like a flashed message, but next to the form that failed
+    function showError(form, message) {
+        let alert = form.nextElementSibling;
+        if (!alert || !alert.classList.contains('api-error')) {
+            alert = document.createElement('div');
+            alert.className = 'alert alert-warning api-error py-1 px-2 mb-2 small';
+            form.after(alert);
+        }
+        alert.textContent = message;
+    }
+
+    function failed(form, response) {
+        if (response.status === 401) {
+            submitNormally(form);
+            return;
+        }
+        return response.json().then(function (result) {
+            return result.error;
+        }, function () {
+            return null;
+        }).then(function (error) {
+            showError(form, error || 'Something went wrong. Please try again');
+        });
+    }
+
+    function likeText(count) {
+        return count + ' like' + (count === 1 ? '' : 's');
+    }
+
+    // liked is left alone when undefined (live updates do not know the viewer's state)
+    function showLikes(postId, likeCount, liked) {
+        document.querySelectorAll('[data-like-post="' + postId + '"]').forEach(function (element) {
+            const icon = element.querySelector('.bi');
+            if (icon && liked !== undefined) {
+                icon.classList.toggle('bi-heart-fill', liked);
+                icon.classList.toggle('bi-heart', !liked);
+            }
+            const count = element.querySelector('.like-count');
+            if (count) {
+                count.textContent = likeText(likeCount);
+            }
+        });
+    }
+
+    function toggleLike(form) {
+        fetch(form.dataset.api, { method: 'POST', credentials: 'same-origin' })
+            .then(function (response) {
+                if (!response.ok) {
+                    return failed(form, response);
+                }
+                return response.json().then(function (state) {
+                    showLikes(state.id, state.like_count, state.liked);
+                });
+            }, function () {
+                submitNormally(form);
+            });
+    }
+
+    function renderComment(list, comment) {
+        // The live stream and the comment form both deliver the viewer's own comments
+        if (list.querySelector('[data-comment-id="' + comment.id + '"]')) {
+            return;
+        }
+        const item = document.createElement('div');
+        item.dataset.commentId = comment.id;
+        const author = document.createElement('strong');
+        author.textContent = comment.author.username;
+        if (list.dataset.layout === 'detail') {
+            const content = document.createElement('p');
+            const time = document.createElement('small');
+            item.className = 'comment mb-2';
+            content.className = 'mb-0';
+            content.textContent = comment.content;
+            time.className = 'text-muted';
+            time.textContent = comment.time_since;
+            item.append(author, content, time);
+        } else {
+            item.className = 'px-3 py-1';
+            item.append(author, ' ' + comment.content);
+        }
+        const empty = list.querySelector('.no-comments');
+        if (empty) {
+            empty.remove();
+        }
+        list.appendChild(item);
+    }
+
+    function addComment(form) {
+        const input = form.querySelector('[name="content"]');
+        if (!input.value.trim()) {
+            return;
+        }
+        fetch(form.dataset.api, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ content: input.value })
+        })
+            .then(function (response) {
+                // The text stays in the box, so it can be sent again after an error
+                if (!response.ok) {
+                    return failed(form, response);
+                }
+                return response.json().then(function (result) {
+                    const list = document.querySelector(form.dataset.comments);
+                    if (list) {
+                        renderComment(list, result.comment);
+                    }
+                    input.value = '';
+                });
+            }, function () {
+                submitNormally(form);
+            });
+    }
+
+    // "Load older comments": swap the link for the older page, which brings its own link
+    document.addEventListener('click', function (event) {
+        const link = event.target.closest && event.target.closest('.comments-older');
+        if (!link || !window.fetch) {
+            return;
+        }
+        event.preventDefault();
+        fetch(link.dataset.next, { credentials: 'same-origin' })
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error('Failed to load comments');
+                }
+                return response.text();
+            })
+            .then(function (html) {
+                link.insertAdjacentHTML('afterend', html);
+                link.remove();
+            })
+            .catch(function () {
+                window.location = link.href;
+            });
+    });
+
+    // Username autocomplete for search boxes: suggestions fill the input's datalist,
+    // and picking one goes straight to that profile
+    let autocompleteTimer = null;
+    document.addEventListener('input', function (event) {
+        const input = event.target;
+        if (!input.dataset || !input.dataset.autocomplete || !window.fetch) {
+            return;
+        }
+        const list = document.getElementById(input.getAttribute('list'));
+        const option = list && Array.prototype.find.call(list.options, function (item) {
+            return item.value === input.value;
+        });
+        // Picking from the datalist is not typing: browsers send no inputType or a replacement
+        const picked = !event.inputType || event.inputType === 'insertReplacementText';
+        if (option && picked) {
+            window.location = option.dataset.url;
+            return;
+        }
+        clearTimeout(autocompleteTimer);
+        const query = input.value.trim();
+        if (!list || !query || query.charAt(0) === '#') {
+            return;
+        }
+        autocompleteTimer = setTimeout(function () {
+            fetch(input.dataset.autocomplete + '?q=' + encodeURIComponent(query), { credentials: 'same-origin' })
+                .then(function (response) {
+                    return response.ok ? response.json() : { users: [] };
+                })
+                .then(function (result) {
+                    list.replaceChildren.apply(list, result.users.map(function (user) {
+                        const item = document.createElement('option');
+                        item.value = user.username;
+                        item.dataset.url = user.profile_url;
+                        return item;
+                    }));
+                })
+                .catch(function () {});
+        }, 150);
+    });
+
+    // Live updates: one EventSource for the posts on the page, reopened when
+    // infinite scroll adds more. The browser reconnects it if it drops
+    const liveUrl = document.body.dataset.liveUrl;
+    const liveLimit = Number(document.body.dataset.liveLimit);  // LIVE_MAX_POSTS; the most recently added posts win
+    let liveSource = null;
+    let livePosts = '';
+
+    function watchLive() {
+        if (!liveUrl || !window.EventSource) {
+            return;
+        }
+        const ids = [];
+        document.querySelectorAll('[data-like-post]').forEach(function (element) {
+            if (ids.indexOf(element.dataset.likePost) === -1) {
+                ids.push(element.dataset.likePost);
+            }
+        });
+        const posts = ids.slice(-liveLimit).join(',');
+        if (!posts || posts === livePosts) {
+            return;
+        }
+        livePosts = posts;
+        if (liveSource) {
+            liveSource.close();
+        }
+        liveSource = new EventSource(liveUrl + '?posts=' + posts);
+        liveSource.addEventListener('likes', function (event) {
+            const data = JSON.parse(event.data);
+            showLikes(data.post_id, data.like_count);
+        });
+        liveSource.addEventListener('comment', function (event) {
+            const data = JSON.parse(event.data);
+            const list = document.getElementById('post-' + data.post_id + '-comments');
+            if (list) {
+                renderComment(list, data.comment);
+            }
+        });
+    }
+
+    document.addEventListener('feed:page', watchLive);
+    watchLive();
+
+    // Delegated, so it also covers feed pages added by infinite scroll
+    document.addEventListener('submit', function (event) {
+        const form = event.target;
+        if (!form.dataset || !form.dataset.api || !window.fetch) {
+            return;
+        }
+        event.preventDefault();
+        if (form.classList.contains('like-form')) {
+            toggleLike(form);
+        } else if (form.classList.contains('comment-form')) {
+            addComment(form);
+        }
+    });
+})();
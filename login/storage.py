@@ -0,0 +1,134 @@
+"""Content-addressed storage for uploaded files.
+
+A blob is named after the SHA-256 of the uploaded bytes, e.g.
+`3f/3fa1...c9.jpg`, so uploading the same photo twice stores it once and
+every name is write-once. An optional `rewrite` step (app.py strips image
+metadata with it) transforms each new upload before it is stored under that
+name.
+Nothing tracks references here: the database columns that hold blob names
+are the reference counts, and the owner of the store sweeps blobs that no row
+points at any more.
+
+Uploads arrive through an UploadSink, which the request parser writes each
+chunk of the file into. It spools straight to a temp file inside the store
+(so the final rename is atomic), hashes as it goes, and hands the first few KB
+to a callback that can reject the upload before the rest is read.
+"""
+import hashlib
+import os
+import tempfile
+import time
+
+CHUNK_SIZE = 64 * 1024
+SNIFF_BYTES = 4096
+
+
+class BlobStore:
+    def __init__(self, root, rewrite=None):
+        self.root = root
+        self.rewrite = rewrite  # (source file, destination file), or raises to reject the upload
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def name_for(self, digest, ext):
+        return f"{digest[:2]}/{digest}{ext.lower()}"
+
+    def put(self, stream, ext):
+        """Streams a file into the store and returns its blob name"""
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    temp.write(chunk)
+            return self.commit(temp_path, digest.hexdigest(), ext)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def commit(self, temp_path, digest, ext):
+        """Moves a fully written temp file to its blob name, or drops it if already stored"""
+        name = self.name_for(digest, ext)
+        path = self.path(name)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)  # Refresh the sweep grace period for the new reference
+            return name
+        if self.rewrite is not None:
+            self.rewrite_file(temp_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return name
+
+    def rewrite_file(self, path):
+        """Applies `rewrite` to a file in place, through a temp file so the original survives an error"""
+        fd, rewritten_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with open(path, 'rb') as source, os.fdopen(fd, 'wb') as destination:
+                self.rewrite(source, destination)
+            os.replace(rewritten_path, path)
+        finally:
+            if os.path.exists(rewritten_path):
+                os.remove(rewritten_path)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def age(self, name):
+        return time.time() - os.path.getmtime(self.path(name))
+
+
+class UploadSink:
+    def __init__(self, store, inspect, sniff_bytes=SNIFF_BYTES):
+        fd, self.temp_path = tempfile.mkstemp(dir=store.root, suffix='.tmp')
+        self.file = os.fdopen(fd, 'w+b')
+        self.store = store
+        self.inspect = inspect  # head bytes -> file extension, or raises to reject
+        self.sniff_bytes = sniff_bytes
+        self.head = b''
+        self.ext = None
+        self.digest = hashlib.sha256()
+        self.committed = None  # blob name once saved
+
+    def write(self, data):
+        if self.ext is None:
+            self.head += data[:self.sniff_bytes - len(self.head)]
+            if len(self.head) >= self.sniff_bytes:
+                self._inspect()
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def _inspect(self):
+        try:
+            self.ext = self.inspect(self.head)
+        except Exception:
+            self.close()  # Rejected: nothing else will clean up the temp file
+            raise
+
+    def save(self):
+        """Moves the upload into the store and returns its blob name"""
+        if self.committed:
+            return self.committed  # A retried request saves the same upload again
+        if self.ext is None:
+            self._inspect()  # Uploads shorter than sniff_bytes
+        self.file.close()
+        self.committed = self.store.commit(self.temp_path, self.digest.hexdigest(), self.ext)
+        return self.committed
+
+    def close(self):
+        self.file.close()
+        if not self.committed and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __getattr__(self, name):
+        # seek/read/tell etc. for the request parser and FileStorage
+        return getattr(self.file, name)
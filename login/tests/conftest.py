@@ -0,0 +1,83 @@
+"""Runs the app against a throwaway database seeded with a small network.
+
+app.py reads its configuration from the environment when it is imported, so
+the environment is set here, before any test imports it. Caching, rate
+limiting, live updates and the background notification aggregator are off so
+every request does the same work each time.
+"""
+import atexit
+import os
+import random
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORY = tempfile.mkdtemp(prefix='photogram-tests-')
+atexit.register(shutil.rmtree, DIRECTORY, ignore_errors=True)
+
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(DIRECTORY, 'photogram.db')}",
+    'LIKE_QUEUE_PATH': os.path.join(DIRECTORY, 'like_queue.db'),
+    'CACHE_BACKEND': '',
+    'RATE_LIMIT_BACKEND': '',
+    'LIVE_BROKER': '',
+    'NOTIFICATION_AGGREGATOR': '0',
+})
+sys.path.insert(0, HERE)
+os.chdir(HERE)  # UPLOAD_FOLDER is relative to the app's directory
+
+USERS = 30
+POSTS_PER_USER = 4
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    return app
+
+
+@pytest.fixture(scope='session')
+def seeded(app):
+    """Seeds users who post, comment and like; user 1 follows everyone and posts nothing. Returns user 1's id"""
+    from app import db, User, Post, Comment, Like, Follow, reconcile_counters, rebuild_search
+    
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    with app.app_context():
+        db.session.add_all([
+            User(username=f'user{number}', email=f'user{number}@example.com', password_hash='!')
+            for number in range(1, USERS + 1)
+        ])
+        db.session.flush()
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+        posts = [
+            Post(image_filename=f'{author_id:04d}{number}.jpg', caption=f'Post {number} #tests',
+                 created_at=now - timedelta(minutes=rng.randrange(60 * 24 * 7)), user_id=author_id)
+            for author_id in user_ids[1:] for number in range(POSTS_PER_USER)
+        ]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            for author_id in rng.sample(user_ids, 3):
+                db.session.add(Comment(content='Nice', post_id=post.id, user_id=author_id,
+                                       created_at=post.created_at + timedelta(minutes=1)))
+            for author_id in rng.sample(user_ids, 5):
+                db.session.add(Like(post_id=post.id, user_id=author_id))
+        db.session.add_all([Follow(follower_id=user_ids[0], followed_id=user_id) for user_id in user_ids[1:]])
+        db.session.commit()
+        reconcile_counters()
+        rebuild_search()
+        return user_ids[0]
+
+
+@pytest.fixture
+def client(app, seeded):
+    """A test client logged in as the seeded user who follows everyone"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = seeded
+    return client
@@ -0,0 +1,13 @@
+import pytest
+
+
+@pytest.mark.parametrize('body', [[1, 2], 'text', {'content': 5}, {'content': ['a']}, {'content': None}])
+def test_add_comment_rejects_malformed_json(client, body):
+    response = client.post('/api/posts/1/comments', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_add_comment_rejects_blank_content(client):
+    response = client.post('/api/posts/1/comments', json={})
+    assert response.status_code == 400
@@ -0,0 +1,32 @@
+import io
+
+from PIL import Image
+from werkzeug.test import EnvironBuilder
+
+
+def multipart(data):
+    environ = EnvironBuilder(method='POST', data={'caption': 'x', 'image': (io.BytesIO(data), 'a.jpg')}).get_environ()
+    return {'headers': [(b'content-type', environ['CONTENT_TYPE'].encode())]}, environ['wsgi.input'].read()
+
+
+def feed(data, chunk_size=1000):
+    """Returns how many chunks the check accepted before rejecting the body, or None if it accepted all"""
+    from asgi import UploadCheck, inspect_upload
+    
+    scope, body = multipart(data)
+    check = UploadCheck.for_request(scope, inspect_upload)
+    for number, start in enumerate(range(0, len(body), chunk_size)):
+        if not check.accepts(body[start:start + chunk_size], start + chunk_size < len(body)):
+            return number
+    return None
+
+
+def test_upload_check_rejects_a_file_from_its_first_bytes(app):
+    assert feed(b'not an image' * 100000) <= 5
+
+
+def test_upload_check_accepts_images_and_short_files_are_judged_whole(app):
+    image = io.BytesIO()
+    Image.new('RGB', (200, 200)).save(image, 'PNG')
+    assert feed(image.getvalue()) is None
+    assert feed(b'abc', chunk_size=10000) == 0
@@ -0,0 +1,19 @@
+from caching import SqliteCache
+
+
+def test_sqlite_cache_hits_refresh_recency_at_most_once_per_interval(tmp_path, monkeypatch):
+    cache = SqliteCache(str(tmp_path / 'cache.db'), touch_interval=60)
+    clock = [1000.0]
+    monkeypatch.setattr('caching.time.time', lambda: clock[0])
+    cache.set('page', 'html')
+    
+    writes = []
+    cache.connect().set_trace_callback(lambda statement: statement.startswith('UPDATE') and writes.append(statement))
+    for _ in range(5):
+        clock[0] += 1
+        assert cache.get('page') == 'html'
+    assert writes == []
+    
+    clock[0] += 60
+    assert cache.get('page') == 'html'
+    assert len(writes) == 1
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+
+
+def other_process(sql_prefix, statements):
+    """Runs statements on a separate connection just before this process first runs sql_prefix"""
+    from app import db
+    
+    path = db.engine.url.database
+    done = []
+    
+    def race(conn, cursor, statement, parameters, context, executemany):
+        if not done and statement.startswith(sql_prefix):
+            done.append(True)
+            with sqlite3.connect(path) as connection:
+                for sql, args in statements:
+                    connection.execute(sql, args)
+    
+    return race
+
+
+@pytest.mark.parametrize('liked', [True, False])
+def test_like_batch_counts_only_rows_it_changed(app, seeded, liked):
+    from app import db, Like, Post, apply_like_batch
+    
+    with app.app_context():
+        liked_posts = {post_id for (post_id,) in db.session.query(Like.post_id).filter_by(user_id=seeded)}
+        post_id = next(post_id for (post_id,) in db.session.query(Post.id).order_by(Post.id)
+                       if (post_id in liked_posts) != liked)
+        before = db.session.get(Post, post_id).like_count
+        # Another process flushing the same queued state wins the race between our read and our write
+        if liked:
+            prefix = 'INSERT INTO "like"'
+            statements = [('INSERT INTO "like" (user_id, post_id) VALUES (?, ?)', (seeded, post_id)),
+                          ('UPDATE post SET like_count = like_count + 1 WHERE id = ?', (post_id,))]
+        else:
+            prefix = 'DELETE FROM "like"'
+            statements = [('DELETE FROM "like" WHERE user_id = ? AND post_id = ?', (seeded, post_id)),
+                          ('UPDATE post SET like_count = like_count - 1 WHERE id = ?', (post_id,))]
+        race = other_process(prefix, statements)
+        event.listen(db.engine, 'before_cursor_execute', race)
+        try:
+            apply_like_batch([(seeded, post_id, liked)])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', race)
+        
+        db.session.expire_all()
+        assert db.session.get(Post, post_id).like_count == before + (1 if liked else -1)
+        assert (db.session.query(Like).filter_by(user_id=seeded, post_id=post_id).count() == 1) == liked
@@ -0,0 +1,25 @@
+import pytest
+
+import app as app_module
+from live import LiveHub
+
+
+@pytest.fixture
+def live(app, monkeypatch):
+    monkeypatch.setattr(app_module, 'live_updates', LiveHub())
+    for name in ('LIVE_URL', 'LIVE_ON_LOOP', 'LIVE_MAX_STREAMS'):
+        monkeypatch.setitem(app.config, name, app.config[name])
+    return app.test_client()
+
+
+def test_plain_wsgi_does_not_hold_threads_for_live_streams(app, seeded, live):
+    assert b'data-live-url' not in live.get('/explore').data
+    assert live.get('/api/live?posts=1').status_code == 404
+
+
+@pytest.mark.parametrize('setting, url', [('LIVE_ON_LOOP', '/api/live'), ('LIVE_URL', 'https://live.example.com/')])
+def test_pages_open_streams_held_on_an_event_loop(app, seeded, live, setting, url):
+    app.config[setting] = url if setting == 'LIVE_URL' else True
+    page = live.get('/explore').data
+    assert f'data-live-url="{url}"'.encode() in page
+    assert f'data-live-limit="{app.config["LIVE_MAX_POSTS"]}"'.encode() in page
@@ -0,0 +1,54 @@
+import pytest
+
+
+@pytest.fixture
+def accel(app, tmp_path, monkeypatch):
+    """Serves uploads from tmp_path through the nginx X-Accel-Redirect branch"""
+    monkeypatch.setitem(app.config, 'MEDIA_ACCEL', 'nginx')
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    (tmp_path / 'ab').mkdir()
+    (tmp_path / 'ab' / 'abcdef.jpg').write_bytes(b'jpeg')
+    return app.test_client()
+
+
+def test_accel_redirect_for_existing_upload(accel):
+    response = accel.get('/media/ab/abcdef.jpg')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/protected-uploads/ab/abcdef.jpg'
+
+
+@pytest.mark.parametrize('path', ['/media/ab/missing.jpg', '/media/..%2f..%2fapp.py', '/media/ab/..%2f..%2fapp.py'])
+def test_accel_redirect_refuses_missing_and_outside_paths(accel, path):
+    response = accel.get(path)
+    assert response.status_code == 404
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_animated_gifs_are_kept_as_uploaded_and_not_revisited(tmp_path):
+    from PIL import Image
+    from media import ImagePipeline
+    
+    frames = [Image.new('P', (20, 20), colour) for colour in range(3)]
+    frames[0].save(tmp_path / 'anim.gif', save_all=True, append_images=frames[1:])
+    pipeline = ImagePipeline(str(tmp_path))
+    assert pipeline.process('anim.gif') == []
+    assert pipeline.done('anim.gif')
+    
+    # A new process finds out from the file once, then answers from memory
+    restarted = ImagePipeline(str(tmp_path))
+    assert restarted.available('anim.gif') == {}
+    assert 'anim.gif' in restarted.kept
+    assert restarted.backfill() == (0, [])
+
+
+def test_variants_keep_palette_transparency(tmp_path):
+    from PIL import Image
+    from media import ImagePipeline
+    
+    image = Image.new('P', (64, 64), 0)
+    image.putpalette([255, 0, 0] * 256)
+    image.save(tmp_path / 'clear.png', transparency=0)
+    ImagePipeline(str(tmp_path)).process('clear.png')
+    with Image.open(tmp_path / 'clear_feed.webp') as variant:
+        assert variant.mode == 'RGBA'
+        assert variant.getpixel((0, 0))[3] == 0
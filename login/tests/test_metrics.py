@@ -0,0 +1,23 @@
+def test_metrics_need_a_token_even_from_localhost(app, monkeypatch):
+    client = app.test_client()
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', None)
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 403
+    
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
+def test_failed_queries_do_not_leave_their_start_on_the_connection(app):
+    import pytest
+    from sqlalchemy.exc import OperationalError
+    from app import db
+    
+    with app.app_context():
+        with db.engine.connect() as connection:
+            for _ in range(3):
+                with pytest.raises(OperationalError):
+                    connection.exec_driver_sql('SELECT * FROM no_such_table')
+            connection.exec_driver_sql('SELECT 1')
+            assert connection.info.get('query_started') == []
@@ -0,0 +1,23 @@
+def test_event_committed_late_with_a_lower_id_is_still_folded_in(app, seeded):
+    from app import db, ActivityEvent, Notification, Post, aggregate_activity
+    
+    with app.app_context():
+        aggregate_activity()
+        post = db.session.query(Post).order_by(Post.id).first()
+        last_id = db.session.query(db.func.max(ActivityEvent.id)).scalar() or 0
+        
+        db.session.add(ActivityEvent(id=last_id + 10, kind='like', recipient_id=post.user_id,
+                                     actor_id=seeded, post_id=post.id))
+        db.session.commit()
+        assert aggregate_activity() == 1
+        
+        # Took its id before the event above but committed after the batch was folded
+        db.session.add(ActivityEvent(id=last_id + 5, kind='comment', recipient_id=post.user_id,
+                                     actor_id=seeded, post_id=post.id))
+        db.session.commit()
+        assert aggregate_activity() == 1
+        assert aggregate_activity() == 0
+        
+        kinds = {kind for (kind,) in db.session.query(Notification.kind)
+                 .filter_by(user_id=post.user_id, post_id=post.id, actor_id=seeded)}
+        assert kinds == {'like', 'comment'}
@@ -0,0 +1,3 @@
+def test_default_hash_bound_leaves_most_view_threads_free(app):
+    in_flight = app.config['PASSWORD_HASH_WORKERS'] + app.config['PASSWORD_HASH_QUEUE']
+    assert in_flight <= app.config['ASGI_THREADS'] // 4
@@ -0,0 +1,40 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+
+@contextmanager
+def count_statements(app):
+    """Counts the SQL statements run on the primary database inside the block"""
+    from app import db
+    
+    with app.app_context():
+        engine = db.engine
+    statements = []
+    
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+@pytest.mark.parametrize('path', ['/', '/explore', '/api/feed'])
+def test_feed_query_count_does_not_grow_with_page_size(app, client, path):
+    counts = {}
+    for page_size in (5, 20, 50):
+        app.config['FEED_PAGE_SIZE'] = page_size
+        try:
+            assert client.get(path).status_code == 200  # Warms per-process caches
+            with count_statements(app) as statements:
+                response = client.get(path)
+        finally:
+            app.config['FEED_PAGE_SIZE'] = 10
+        assert response.status_code == 200
+        assert response.get_data(as_text=True).count('/post/') >= page_size
+        counts[page_size] = len(statements)
+    assert len(set(counts.values())) == 1, f'statements per page size: {counts}'
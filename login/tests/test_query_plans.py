@@ -0,0 +1,8 @@
+def test_hot_queries_are_answered_from_indexes(app, seeded):
+    from app import db, explain_hot_queries
+    
+    with app.app_context():
+        # Plans on a database with statistics, as a long-running one has
+        db.session.execute(db.text('ANALYZE'))
+        problems = {name: plan for name, (plan, found) in explain_hot_queries().items() if found}
+    assert not problems, problems
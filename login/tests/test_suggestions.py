@@ -0,0 +1,21 @@
+from test_queries import count_statements
+
+
+def test_suggestions_are_reused_until_the_user_follows_someone(app, seeded):
+    from app import db, User, suggested_users, invalidate_follow
+    
+    with app.app_context():
+        newcomer = User(username='newcomer', email='newcomer@example.com', password_hash='!')
+        db.session.add(newcomer)
+        db.session.commit()
+        first = [(user.id, mutual) for user, mutual in suggested_users(newcomer.id)]
+        
+        with count_statements(app) as statements:
+            again = [(user.id, mutual) for user, mutual in suggested_users(newcomer.id)]
+        assert again == first
+        assert len(statements) == 1  # Only the users themselves
+        
+        invalidate_follow(newcomer.id, first[0][0])
+        with count_statements(app) as statements:
+            suggested_users(newcomer.id)
+        assert len(statements) > 1
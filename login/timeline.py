@@ -0,0 +1,164 @@
+"""Materialized home timelines for fan-out-on-write feeds.
+
+A timeline is the list of (created_at, post_id) keys a user would see on their
+home feed, newest first. Both stores share one interface so app.py can switch
+between them with the TIMELINE_BACKEND setting:
+
+- SqlTimelineStore keeps entries in the timeline_entry table, so a page of the
+  feed is one range scan over the (user_id, created_at, post_id) index.
+- MemoryTimelineStore keeps capped sorted lists in this process. It stands in
+  for a shared store such as Redis during local development and tests.
+  Changes are applied when the session commits, so a rolled-back post never
+  shows up. The lists start out empty in every new process; has() tells
+  app.py which timelines it must load() from the database before reading.
+"""
+from bisect import bisect_left, insort
+from threading import Lock
+
+from sqlalchemy import and_, event, insert, literal, or_, select
+
+
+class SqlTimelineStore:
+    def __init__(self, session, model):
+        self.session = session
+        self.model = model
+
+    def push(self, owner_ids, post_id, author_id, created_at):
+        """Adds a post to the timeline of every user id selected by `owner_ids`"""
+        entry = self.model
+        rows = select(
+            owner_ids.subquery().c[0],
+            literal(post_id),
+            literal(author_id),
+            literal(created_at)
+        )
+        self.session.execute(
+            insert(entry).from_select(
+                [entry.user_id, entry.post_id, entry.author_id, entry.created_at], rows
+            )
+        )
+
+    def backfill(self, owner_id, posts):
+        """Adds existing posts to one user's timeline, skipping ones already there"""
+        entry = self.model
+        existing = {post_id for (post_id,) in self.session.query(entry.post_id).filter(
+            entry.user_id == owner_id,
+            entry.post_id.in_([post.id for post in posts])
+        )}
+        self.session.add_all([
+            entry(user_id=owner_id, post_id=post.id, author_id=post.user_id, created_at=post.created_at)
+            for post in posts if post.id not in existing
+        ])
+
+    def prune(self, owner_id, author_id):
+        """Removes one author's posts from a user's timeline"""
+        self.model.query.filter_by(user_id=owner_id, author_id=author_id) \
+            .delete(synchronize_session=False)
+
+    def has(self, owner_id):
+        return True  # Timelines live in the database with the posts they list
+
+    def load(self, owner_id, posts):
+        """Replaces one user's timeline with posts"""
+        self.clear(owner_id)
+        self.backfill(owner_id, posts)
+
+    def page(self, owner_id, before=None, limit=10):
+        """Returns up to `limit` (created_at, post_id) keys older than `before`"""
+        entry = self.model
+        query = self.session.query(entry.created_at, entry.post_id).filter(entry.user_id == owner_id)
+        if before:
+            created_at, post_id = before
+            query = query.filter(or_(
+                entry.created_at < created_at,
+                and_(entry.created_at == created_at, entry.post_id < post_id)
+            ))
+        query = query.order_by(entry.created_at.desc(), entry.post_id.desc()).limit(limit)
+        return [tuple(row) for row in query]
+
+    def clear(self, owner_id=None):
+        query = self.model.query
+        if owner_id is not None:
+            query = query.filter_by(user_id=owner_id)
+        query.delete(synchronize_session=False)
+
+
+class MemoryTimelineStore:
+    def __init__(self, session, max_entries=800):
+        self.session = session
+        self.max_entries = max_entries
+        self.timelines = {}  # owner id -> ascending list of (created_at, post_id, author_id)
+        self.loaded = set()  # owners whose whole timeline has been loaded in this process
+        self.lock = Lock()
+        event.listen(session, 'after_commit', self._commit)
+        event.listen(session, 'after_transaction_end', self._end)
+
+    def _defer(self, change):
+        """Runs change() once the current transaction commits; a rollback drops it"""
+        self.session.info.setdefault('timeline_changes', []).append(change)
+
+    def _commit(self, session):
+        changes = session.info.pop('timeline_changes', [])
+        with self.lock:
+            for change in changes:
+                change()
+
+    def _end(self, session, transaction):
+        if transaction.parent is None:
+            session.info.pop('timeline_changes', None)
+
+    def _add(self, owner_id, key):
+        timeline = self.timelines.setdefault(owner_id, [])
+        if key in timeline:
+            return
+        insort(timeline, key)
+        if len(timeline) > self.max_entries:
+            del timeline[:len(timeline) - self.max_entries]
+
+    def push(self, owner_ids, post_id, author_id, created_at):
+        owners = [owner_id for (owner_id,) in self.session.execute(owner_ids)]
+
+        def change():
+            for owner_id in owners:
+                self._add(owner_id, (created_at, post_id, author_id))
+        self._defer(change)
+
+    def backfill(self, owner_id, posts):
+        keys = [(post.created_at, post.id, post.user_id) for post in posts]
+
+        def change():
+            for key in keys:
+                self._add(owner_id, key)
+        self._defer(change)
+
+    def prune(self, owner_id, author_id):
+        def change():
+            timeline = self.timelines.get(owner_id, [])
+            timeline[:] = [key for key in timeline if key[2] != author_id]
+        self._defer(change)
+
+    def has(self, owner_id):
+        return owner_id in self.loaded
+
+    def load(self, owner_id, posts):
+        """Fills a timeline from committed posts, straight away; keeps entries pushed meanwhile"""
+        with self.lock:
+            for post in posts:
+                self._add(owner_id, (post.created_at, post.id, post.user_id))
+            self.loaded.add(owner_id)
+
+    def page(self, owner_id, before=None, limit=10):
+        with self.lock:
+            timeline = self.timelines.get(owner_id, [])
+            end = bisect_left(timeline, tuple(before)) if before else len(timeline)
+            start = max(end - limit, 0)
+            return [(created_at, post_id) for created_at, post_id, _ in reversed(timeline[start:end])]
+
+    def clear(self, owner_id=None):
+        with self.lock:
+            if owner_id is None:
+                self.timelines.clear()
+                self.loaded.clear()
+            else:
+                self.timelines.pop(owner_id, None)
+                self.loaded.discard(owner_id)